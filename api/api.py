@@ -1,15 +1,27 @@
 """This API is to be of use for those who wish to retrieve useful information from our database of
 earthquake data. Whether it be an amateur developer or a seasoned researcher, this service should
 be easy to make the most out of through its endpoints."""
+import base64
+from collections.abc import Iterator
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+import hashlib
+from itertools import chain
+import json
 import logging
 from os import environ as env
+import re
+import threading
+from urllib.parse import urlencode
 from dotenv import load_dotenv
 from flask import Flask, Response, jsonify, request
 import psycopg2
 import psycopg2.extras
 from psycopg2.extensions import connection, cursor
-import reverse_geocode as rg
 import pycountry_convert as pc
+from db_pool import (DEFAULT_POOL_MIN, DEFAULT_POOL_MAX, DEFAULT_POOL_TIMEOUT,
+                     ConnectionPool, PoolExhaustedError)
+from cache import DEFAULT_CACHE_MAX_BYTES, DEFAULT_CACHE_TTL, ResultCache, start_listener
 
 app = Flask(__name__)
 
@@ -21,6 +33,12 @@ EVENT_FILTER_KEY = "event_filter"
 MIN_MAGNITUDE_FILTER_KEY = "min_magnitude_filter"
 CONTINENT_FILTER_KEY = "continent_filter"
 COUNTRY_FILTER_KEY = "country_filter"
+START_FILTER_KEY = "start_filter"
+END_FILTER_KEY = "end_filter"
+MIN_LAT_FILTER_KEY = "min_lat_filter"
+MAX_LAT_FILTER_KEY = "max_lat_filter"
+MIN_LON_FILTER_KEY = "min_lon_filter"
+MAX_LON_FILTER_KEY = "max_lon_filter"
 CONTINENTS = ["North America", "South America", "Asia",
               "Africa", "Oceania", "Europe", "Antarctica"]
 CONTINENTS_TO_CODE = {
@@ -34,17 +52,117 @@ CONTINENTS_TO_CODE = {
 }
 
 FILTER_MISINPUTS = [None, ""]
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_ITERSIZE = 2000
+STREAM_CHUNK_ROWS = 100
+CACHE_MAX_AGE = 60
+POOL = {}
+POOL_LOCK = threading.Lock()
+CACHE = {}
+CACHE_LOCK = threading.Lock()
+
+# The fields that can be requested with fields=, and the column each is selected as
+FIELDS = {
+    "earthquake_id": "e.earthquake_id",
+    "magnitude": "e.magnitude",
+    "lon": "e.lon",
+    "lat": "e.lat",
+    "time": "e.time",
+    "felt": "e.felt",
+    "cdi": "e.cdi",
+    "mmi": "e.mmi",
+    "significance": "e.significance",
+    "nst": "e.nst",
+    "dmin": "e.dmin",
+    "gap": "e.gap",
+    "title": "e.title",
+    "depth": "e.depth",
+    "country_code": "e.country_code",
+    "continent_code": "e.continent_code",
+    "state": "e.state",
+    "magtype": "mt.magtype_value AS magtype",
+    "status": "s.status",
+    "cause_of_event": "t.type_value AS cause_of_event",
+    "network_name": "n.network_name",
+    "alert": "a.alert_value AS alert"
+}
+# The lookup tables, keyed by their alias. Each is only joined when a selected
+# column or a filter uses it
+JOINS = {
+    "mt": "LEFT JOIN magtypes AS mt USING(magtype_id)",
+    "s": "LEFT JOIN statuses AS s USING(status_id)",
+    "t": "LEFT JOIN types AS t USING(type_id)",
+    "n": "LEFT JOIN networks AS n USING(network_id)",
+    "a": "LEFT JOIN alerts AS a USING(alert_id)"
+}
+# Always selected for pages, as the next page's cursor is built from them
+KEY_FIELDS = ["time", "earthquake_id"]
+# Must match the expression of earthquakes_earth_idx for the index to be used
+EARTH_POINT = "ll_to_earth(e.lat::float8, e.lon::float8)"
+EARTH_ORIGIN = "ll_to_earth(%s, %s)"
+DEFAULT_NEAR_K = 20
+MAX_NEAR_K = 1000
+MAX_RADIUS_KM = 20038
+STATS_INTERVALS = ["hour", "day", "week", "month", "year"]
+DEFAULT_STATS_INTERVAL = "day"
+DEFAULT_BIN_SIZE = "1"
+MAX_BIN_SIZE = 10
+# The expression each summary groups by, its column name and the parameters it
+# uses, and the order of its rows
+STATS_GROUPS = {
+    "counts": ("date_trunc(%s, e.time)", "bucket", "bucket"),
+    "magnitudes": ("(floor(e.magnitude::numeric / %s) * %s)::float8", "min_magnitude",
+                   "min_magnitude"),
+    "networks": ("n.network_name", "network_name", "count DESC, network_name"),
+    "countries": ("e.country_code", "country_code", "count DESC, country_code")
+}
+STATS_COLUMNS = """count(*) AS count, max(e.magnitude) AS max_magnitude,
+    round(avg(e.magnitude)::numeric, 2)::float8 AS mean_magnitude, max(e.time) AS latest"""
+
+
+def get_connection_details() -> dict[str]:
+    """Return the details needed to connect to the earthquake database"""
+    return {
+        "user": env["DB_USERNAME"],
+        "password": env["DB_PASSWORD"],
+        "host": env["DB_HOST"],
+        "port": env["DB_PORT"],
+        "database": env["DB_NAME"]
+    }
+
+
+def get_pool() -> ConnectionPool:
+    """Return the process-wide connection pool, creating it on first use."""
+    with POOL_LOCK:
+        if "pool" not in POOL:
+            POOL["pool"] = ConnectionPool(
+                int(env.get("DB_POOL_MIN", DEFAULT_POOL_MIN)),
+                int(env.get("DB_POOL_MAX", DEFAULT_POOL_MAX)),
+                float(env.get("DB_POOL_TIMEOUT", DEFAULT_POOL_TIMEOUT)),
+                **get_connection_details()
+            )
+        return POOL["pool"]
+
+
+def get_cache() -> ResultCache:
+    """Return the process-wide result cache, creating it on first use."""
+    with CACHE_LOCK:
+        if "cache" not in CACHE:
+            CACHE["cache"] = ResultCache(
+                int(env.get("CACHE_MAX_BYTES", DEFAULT_CACHE_MAX_BYTES)),
+                float(env.get("CACHE_TTL_SECONDS", DEFAULT_CACHE_TTL)))
+        return CACHE["cache"]
 
 
 def get_connection() -> connection:
-    """Return a connection object associated with the earthquake database"""
-    return psycopg2.connect(
-        user=env["DB_USERNAME"],
-        password=env["DB_PASSWORD"],
-        host=env["DB_HOST"],
-        port=env["DB_PORT"],
-        database=env["DB_NAME"]
-    )
+    """Return a connection to the earthquake database, checked out of the pool"""
+    return get_pool().getconn()
+
+
+def release_connection(conn: connection) -> None:
+    """Return a connection to the pool."""
+    get_pool().putconn(conn)
 
 
 def get_cursor(conn: connection) -> cursor:
@@ -52,32 +170,198 @@ def get_cursor(conn: connection) -> cursor:
     return conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
 
-def get_filter_queries(earthquake_filters: dict[str]) -> list[str]:
-    """Return a list of WHERE command strings that can be added onto a postgreSQL query.
+def get_filter_queries(earthquake_filters: dict[str]) -> tuple[list[str], list]:
+    """Return a list of WHERE conditions that can be added onto a postgreSQL query,
+    along with the parameters they use.
     """
-    res = []
+    conditions = []
+    params = []
     logging.info("""Filters used: %s""", list(earthquake_filters.items()))
-    status = earthquake_filters[STATUS_FILTER_KEY]
-    network = earthquake_filters[NETWORK_FILTER_KEY]
-    alert = earthquake_filters[ALERT_FILTER_KEY]
-    magtype = earthquake_filters[MAG_TYPE_FILTER_KEY]
-    event = earthquake_filters[EVENT_FILTER_KEY]
-    min_magnitude = earthquake_filters[MIN_MAGNITUDE_FILTER_KEY]
-    if status not in FILTER_MISINPUTS:
-        res.append(f"s.status = '{status}'")
-    if network not in FILTER_MISINPUTS:
-        res.append(f"n.network_name = '{network}'")
-    if alert not in FILTER_MISINPUTS:
-        res.append(f"a.alert_value = '{alert}'")
-    if magtype not in FILTER_MISINPUTS:
-        res.append(f"mt.magtype_value = '{magtype}'")
-    if event not in FILTER_MISINPUTS:
-        res.append(f"t.type_value = '{event}'")
-    if min_magnitude not in FILTER_MISINPUTS:
-        res.append(f"e.magnitude >= '{min_magnitude}'")
-    if res:
-        res[0] = "WHERE "+res[0]
-    return res
+    filter_columns = {
+        STATUS_FILTER_KEY: "s.status = %s",
+        NETWORK_FILTER_KEY: "n.network_name = %s",
+        ALERT_FILTER_KEY: "a.alert_value = %s",
+        MAG_TYPE_FILTER_KEY: "mt.magtype_value = %s",
+        EVENT_FILTER_KEY: "t.type_value = %s",
+        MIN_MAGNITUDE_FILTER_KEY: "e.magnitude >= %s"
+    }
+    for filter_key, condition in filter_columns.items():
+        value = earthquake_filters.get(filter_key)
+        if value not in FILTER_MISINPUTS:
+            conditions.append(condition)
+            params.append(value)
+    country = earthquake_filters.get(COUNTRY_FILTER_KEY)
+    if country not in FILTER_MISINPUTS:
+        conditions.append("e.country_code = %s")
+        params.append(get_country_code(country))
+    continent = earthquake_filters.get(CONTINENT_FILTER_KEY)
+    if continent not in FILTER_MISINPUTS and is_continent_valid(continent.title()):
+        conditions.append("e.continent_code = %s")
+        params.append(CONTINENTS_TO_CODE[continent.title()])
+    for get_conditions in (get_time_conditions, get_box_conditions):
+        extra_conditions, extra_params = get_conditions(earthquake_filters)
+        conditions.extend(extra_conditions)
+        params.extend(extra_params)
+    return conditions, params
+
+
+def parse_time(value: str, name: str) -> datetime:
+    """Return an ISO 8601 date or time as a naive UTC datetime, matching the
+    earthquakes table, raising a ValueError if it is invalid."""
+    try:
+        parsed = datetime.fromisoformat(value.strip())
+    except ValueError as e:
+        raise ValueError(f"{name} must be an ISO 8601 date or time") from e
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def parse_coordinate(value: str, name: str, limit: float) -> float:
+    """Return a latitude or longitude, raising a ValueError if it is not a
+    number between -limit and limit."""
+    try:
+        coordinate = float(value)
+    except ValueError as e:
+        raise ValueError(f"{name} must be a number") from e
+    if not -limit <= coordinate <= limit:
+        raise ValueError(f"{name} must be between {-limit:g} and {limit:g}")
+    return coordinate
+
+
+def get_time_conditions(earthquake_filters: dict[str]) -> tuple[list[str], list]:
+    """Return the WHERE conditions and parameters for the start/end time window."""
+    conditions = []
+    params = []
+    bounds = {}
+    for filter_key, name, condition in ((START_FILTER_KEY, "start", "e.time >= %s"),
+                                        (END_FILTER_KEY, "end", "e.time <= %s")):
+        value = earthquake_filters.get(filter_key)
+        if value not in FILTER_MISINPUTS:
+            bounds[name] = parse_time(value, name)
+            conditions.append(condition)
+            params.append(bounds[name])
+    if len(bounds) == 2 and bounds["start"] > bounds["end"]:
+        raise ValueError("start must be before end")
+    return conditions, params
+
+
+def get_box_conditions(earthquake_filters: dict[str]) -> tuple[list[str], list]:
+    """Return the WHERE conditions and parameters for a bounding box. A box whose
+    min_lon is greater than its max_lon crosses the antimeridian, so matches
+    longitudes either side of it."""
+    bounds = {}
+    for filter_key, name, limit in ((MIN_LAT_FILTER_KEY, "min_lat", 90),
+                                    (MAX_LAT_FILTER_KEY, "max_lat", 90),
+                                    (MIN_LON_FILTER_KEY, "min_lon", 180),
+                                    (MAX_LON_FILTER_KEY, "max_lon", 180)):
+        value = earthquake_filters.get(filter_key)
+        if value not in FILTER_MISINPUTS:
+            bounds[name] = parse_coordinate(value, name, limit)
+    if "min_lat" in bounds and "max_lat" in bounds and bounds["min_lat"] > bounds["max_lat"]:
+        raise ValueError("min_lat must not be greater than max_lat")
+
+    conditions = []
+    params = []
+    for name, condition in (("min_lat", "e.lat >= %s"), ("max_lat", "e.lat <= %s")):
+        if name in bounds:
+            conditions.append(condition)
+            params.append(bounds[name])
+    if "min_lon" in bounds and "max_lon" in bounds and bounds["min_lon"] > bounds["max_lon"]:
+        conditions.append("(e.lon >= %s OR e.lon <= %s)")
+        params.extend([bounds["min_lon"], bounds["max_lon"]])
+    else:
+        for name, condition in (("min_lon", "e.lon >= %s"), ("max_lon", "e.lon <= %s")):
+            if name in bounds:
+                conditions.append(condition)
+                params.append(bounds[name])
+    return conditions, params
+
+
+def get_page_size(limit: str | None) -> int:
+    """Return how many earthquakes to return per page, raising a ValueError
+    if the limit requested is not a number between 1 and MAX_PAGE_SIZE."""
+    if limit in FILTER_MISINPUTS:
+        return DEFAULT_PAGE_SIZE
+    page_size = int(limit)
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return page_size
+
+
+def encode_cursor(earthquake: dict) -> str:
+    """Return an opaque cursor pointing just after the given earthquake."""
+    key = json.dumps({"time": earthquake["time"].isoformat(),
+                      "id": earthquake["earthquake_id"]})
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip("=")
+
+
+def decode_cursor(page_cursor: str) -> tuple[datetime, str]:
+    """Return the (time, earthquake_id) key a cursor points after."""
+    try:
+        key = json.loads(base64.urlsafe_b64decode(
+            page_cursor + "=" * (-len(page_cursor) % 4)))
+        return datetime.fromisoformat(key["time"]), str(key["id"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def get_fields(fields: str | None) -> list[str] | None:
+    """Return the fields requested as a comma separated list, in a fixed order so
+    equivalent requests share a query key, or None for every field. Raises a
+    ValueError for fields that are not in FIELDS."""
+    if fields in FILTER_MISINPUTS:
+        return None
+    requested = {field.strip() for field in fields.split(",")} - {""}
+    unknown = requested - FIELDS.keys()
+    if unknown or not requested:
+        raise ValueError(f"fields must be a comma separated list of {', '.join(FIELDS)}")
+    return [field for field in FIELDS if field in requested]
+
+
+def get_search_columns(fields: list[str] | None, key_fields: list[str] = ()) -> str:
+    """Return the SELECT list for the fields requested (every field if None),
+    plus any key fields needed to build a cursor."""
+    if fields is None:
+        fields = list(FIELDS)
+    return ", ".join(column for field, column in FIELDS.items()
+                     if field in fields or field in key_fields)
+
+
+def get_search_tables(*expressions: str) -> str:
+    """Return the FROM clause of a search, with only the lookup tables whose
+    aliases the expressions (selected columns, conditions, ...) use."""
+    used = " ".join(expressions)
+    joins = [join for alias, join in JOINS.items() if re.search(rf"\b{alias}\.", used)]
+    return "\n    ".join(["FROM earthquakes AS e", *joins]) + "\n    "
+
+
+def get_projection(row: dict, fields: list[str] | None) -> dict:
+    """Return a row with only the fields requested, dropping the key fields that
+    were only selected for the cursor."""
+    if fields is None:
+        return row
+    return {field: row[field] for field in fields}
+
+
+def get_page_query(conditions: list[str], params: list, after: tuple | None,
+                   limit: int | None, fields: list[str] | None = None) -> tuple[str, list]:
+    """Return the query and parameters for the next rows of a keyset paginated
+    search, newest first, starting after the (time, earthquake_id) key given.
+    A limit of None returns every remaining row."""
+    conditions = list(conditions)
+    params = list(params)
+    if after is not None:
+        conditions.append("(e.time, e.earthquake_id) < (%s, %s)")
+        params.extend(after)
+    columns = get_search_columns(fields, KEY_FIELDS)
+    query = f"SELECT {columns} {get_search_tables(columns, *conditions)}"
+    if conditions:
+        query += "WHERE " + " AND ".join(conditions)
+    query += "\n    ORDER BY e.time DESC, e.earthquake_id DESC"
+    if limit is None:
+        return query + ";", params
+    return query + " LIMIT %s;", params + [limit]
 
 
 def is_continent_valid(continent: str) -> bool:
@@ -87,79 +371,298 @@ def is_continent_valid(continent: str) -> bool:
     return True
 
 
-def filter_by_continent(fetched_data, continent: str) -> list[dict]:
-    """filter through the data extracted so far, and only keep data
-    that matches the continent being filtered."""
-    res = []
-    if not is_continent_valid(continent):
-        return fetched_data
-    continent_filter_code = CONTINENTS_TO_CODE[continent]
-    for row in fetched_data:
+def get_country_code(country: str) -> str | None:
+    """Return the ISO alpha-2 code for a country name or code, or None if the
+    country does not exist."""
+    country = country.strip()
+    if len(country) == 2 and country.isalpha():
+        return country.upper()
+    try:
+        return pc.country_name_to_country_alpha2(country.title())
+    except (KeyError, TypeError):
+        return None
+
+
+def get_earthquake_data(earthquake_filters: dict[str], page_size: int = DEFAULT_PAGE_SIZE,
+                        page_cursor: str = None,
+                        fields: list[str] | None = None) -> tuple[list[dict], str | None]:
+    """Return a page of earthquake data from the database, newest first, with only
+    the fields requested, and the cursor for the next page (None on the last page)."""
+    conditions, params = get_filter_queries(earthquake_filters)
+    after = decode_cursor(page_cursor) if page_cursor else None
+
+    conn = get_connection()
+    try:
+        with get_cursor(conn) as cur:
+            cur.execute(*get_page_query(conditions, params, after, page_size + 1, fields))
+            page = cur.fetchall()
+    finally:
+        release_connection(conn)
+
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        next_cursor = encode_cursor(page[-1])
+    logging.info("Finished retrieving earthquake data.")
+    return [get_projection(row, fields) for row in page], next_cursor
+
+
+def stream_earthquake_data(earthquake_filters: dict[str], page_cursor: str = None,
+                           fields: list[str] | None = None) -> Iterator[str]:
+    """Yield every earthquake matching the filters, newest first, as chunks of a
+    JSON array. Rows are read from a named server-side cursor, STREAM_ITERSIZE at
+    a time, so memory use does not grow with the size of the result."""
+    conditions, params = get_filter_queries(earthquake_filters)
+    after = decode_cursor(page_cursor) if page_cursor else None
+
+    conn = get_connection()
+    try:
+        with conn.cursor(name="earthquake_stream",
+                         cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            cur.itersize = STREAM_ITERSIZE
+            cur.execute(*get_page_query(conditions, params, after, None, fields))
+            yield "["
+            streamed = 0
+            chunk = []
+            for row in cur:
+                chunk.append(app.json.dumps(get_projection(row, fields)))
+                if len(chunk) == STREAM_CHUNK_ROWS:
+                    yield ("," if streamed else "") + ",".join(chunk)
+                    streamed += len(chunk)
+                    chunk = []
+            if chunk:
+                yield ("," if streamed else "") + ",".join(chunk)
+                streamed += len(chunk)
+            yield "]"
+        logging.info("%s earthquake events were streamed.", streamed)
+    finally:
+        release_connection(conn)
+
+
+def get_data_watermark() -> tuple[int, datetime | None]:
+    """Return the id and time of the latest data load. These change whenever the
+    pipeline loads new earthquakes, so they identify the current version of the data."""
+    conn = get_connection()
+    try:
+        with get_cursor(conn) as cur:
+            cur.execute("SELECT load_id, loaded_at FROM data_loads ORDER BY load_id DESC LIMIT 1;")
+            latest_load = cur.fetchone()
+    finally:
+        release_connection(conn)
+    if latest_load is None:
+        return 0, None
+    return latest_load["load_id"], latest_load["loaded_at"].replace(tzinfo=timezone.utc)
+
+
+def get_query_key(earthquake_filters: dict[str], *options) -> str:
+    """Return a normalised key for a request's query and its other options (page
+    size, cursor, ...), so equivalent requests (e.g. filtering by a country's
+    name or its code) share the same key."""
+    conditions, params = get_filter_queries(earthquake_filters)
+    return json.dumps([conditions, params, *options], default=str)
+
+
+def get_etag(load_id: int, query_key: str) -> str:
+    """Return the ETag for a query against the given version of the data."""
+    return hashlib.sha256(f"{load_id}:{query_key}".encode()).hexdigest()[:32]
+
+
+def is_not_modified(etag: str, last_modified: datetime | None) -> bool:
+    """Return whether the client's cached copy, as described by its conditional
+    headers, is still current."""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def set_cache_headers(response: Response, etag: str, last_modified: datetime | None) -> Response:
+    """Add the validators and Cache-Control headers that let clients and
+    proxies reuse a response until the next data load."""
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = CACHE_MAX_AGE
+    return response
+
+
+def get_cached_body(load_id: int, query_key: str, fetch) -> tuple[bytes, str | None]:
+    """Return the JSON body and next page cursor for a query from the result
+    cache, or from `fetch` (which returns the data and cursor) on a miss. Keys
+    include the latest data load, so results from before a load are never
+    served after it, even if its notification is missed."""
+    cache = get_cache()
+    cache_key = f"{load_id}:{query_key}"
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+    data, next_cursor = fetch()
+    logging.info("%s rows were retrieved.", len(data))
+    body = app.json.dumps(data).encode()
+    cache.set(cache_key, body, next_cursor)
+    return body, next_cursor
+
+
+def get_cached_earthquake_data(load_id: int, earthquake_filters: dict[str], page_size: int,
+                               page_cursor: str | None,
+                               fields: list[str] | None = None) -> tuple[bytes, str | None]:
+    """Return a page of earthquake data serialised as JSON, and the cursor for
+    the next page, from the result cache when the same query was made since
+    the latest data load."""
+    return get_cached_body(
+        load_id, get_query_key(earthquake_filters, page_size, page_cursor, fields),
+        lambda: get_earthquake_data(earthquake_filters, page_size, page_cursor, fields))
+
+
+def get_near_options(args) -> tuple[float, float, float | None, int]:
+    """Return the validated lat, lon, radius_km and k of a /earthquakes/near request."""
+    if args.get("lat") in FILTER_MISINPUTS or args.get("lon") in FILTER_MISINPUTS:
+        raise ValueError("lat and lon are required")
+    lat = parse_coordinate(args["lat"], "lat", 90)
+    lon = parse_coordinate(args["lon"], "lon", 180)
+    radius_km = None
+    if args.get("radius_km") not in FILTER_MISINPUTS:
         try:
-            location = rg.get((row["lat"], row["lon"]))
-            # extract country code
-            country_code = location["country_code"]
-            # get continent code from country code
-            continent_code = pc.country_alpha2_to_continent_code(country_code)
-            if continent_code == continent_filter_code:
-                res.append(row)
-        except Exception as e:  # pylint: disable=broad-exception-caught
-            logging.error("Error appending data row (continent): %s", e)
-    return res
-
-
-def filter_by_country(fetched_data, country: str) -> list[dict]:
-    """filter through the data fetched and return a list of events whose
-    coordinates match the chosen country"""
-    res = []
-    for row in fetched_data:
+            radius_km = float(args["radius_km"])
+        except ValueError as e:
+            raise ValueError("radius_km must be a number") from e
+        if not 0 < radius_km <= MAX_RADIUS_KM:
+            raise ValueError(f"radius_km must be greater than 0 and at most {MAX_RADIUS_KM}")
+    k = DEFAULT_NEAR_K
+    if args.get("k") not in FILTER_MISINPUTS:
         try:
-            location = rg.get((row["lat"], row["lon"]))
-            if location["country"] == country:
-                res.append(row)
-        except Exception as e:  # pylint: disable=broad-exception-caught
-            logging.error("Error appending data row (country): %s", e)
-    return res
-
-
-def filter_by_location(fetched_data, country: str, continent: str) -> list[dict]:
-    """filter through the data fetched and return a list of events whose
-    coordinates correspond to the chosen location"""
-    if country:
-        return filter_by_country(fetched_data, country.title())
-    if continent:
-        return filter_by_continent(fetched_data, continent.title())
-    return fetched_data
-
-
-def get_earthquake_data(earthquake_filters: dict[str]) -> list[dict]:
-    """Return a list of all earthquake data from the database."""
+            k = int(args["k"])
+        except ValueError as e:
+            raise ValueError("k must be an integer") from e
+        if not 1 <= k <= MAX_NEAR_K:
+            raise ValueError(f"k must be between 1 and {MAX_NEAR_K}")
+    return lat, lon, radius_km, k
+
+
+def get_near_query(conditions: list[str], params: list,
+                   near_options: tuple[float, float, float | None, int],
+                   fields: list[str] | None = None) -> tuple[str, list]:
+    """Return the query and parameters for the k earthquakes nearest a point,
+    nearest first, optionally within radius_km. The earth_box condition and the
+    <-> ordering are both answered by the GiST index on ll_to_earth."""
+    lat, lon, radius_km, k = near_options
+    conditions = list(conditions)
+    params = list(params)
+    if radius_km is not None:
+        conditions.append(f"earth_box({EARTH_ORIGIN}, %s) @> {EARTH_POINT}")
+        conditions.append(f"earth_distance({EARTH_ORIGIN}, {EARTH_POINT}) <= %s")
+        params.extend([lat, lon, radius_km * 1000, lat, lon, radius_km * 1000])
+    columns = get_search_columns(fields)
+    query = (f"SELECT {columns},\n    "
+             f"round((earth_distance({EARTH_ORIGIN}, {EARTH_POINT}) / 1000)::numeric, 3) "
+             f"AS distance_km {get_search_tables(columns, *conditions)}")
+    if conditions:
+        query += "WHERE " + " AND ".join(conditions)
+    query += f"\n    ORDER BY {EARTH_POINT} <-> {EARTH_ORIGIN} LIMIT %s;"
+    return query, [lat, lon] + params + [lat, lon, k]
+
+
+def get_near_earthquake_data(earthquake_filters: dict[str],
+                             near_options: tuple[float, float, float | None, int],
+                             fields: list[str] | None = None) -> list[dict]:
+    """Return the k earthquakes nearest a point, with only the fields requested
+    and their distance in km."""
+    conditions, params = get_filter_queries(earthquake_filters)
     conn = get_connection()
+    try:
+        with get_cursor(conn) as cur:
+            cur.execute(*get_near_query(conditions, params, near_options, fields))
+            return cur.fetchall()
+    finally:
+        release_connection(conn)
 
-    search_query = """SELECT e.earthquake_id,e.magnitude,e.lon,e.lat,e.time,e.felt,e.cdi,e.mmi,
-    e.significance,e.nst,e.dmin,e.gap,e.title,e.depth,
-    mt.magtype_value as magtype, s.status, t.type_value as cause_of_event, n.network_name, a.alert_value as alert FROM earthquakes AS e
-    LEFT JOIN magtypes AS mt USING(magtype_id)
-    LEFT JOIN statuses AS s USING(status_id)
-    LEFT JOIN types AS t USING(type_id)
-    LEFT JOIN networks AS n USING(network_id)
-    LEFT JOIN alerts AS a USING(alert_id)
-    """
-    if any(value is not None for value in earthquake_filters.values()):
-        query_filter_commands = get_filter_queries(earthquake_filters)
-        search_query += " AND ".join(query_filter_commands)
-
-    with get_cursor(conn) as cur:
-        cur.execute(search_query)
-        fetched_earthquakes = cur.fetchall()
-
-    conn.close()
-    continent = earthquake_filters[CONTINENT_FILTER_KEY]
-    country = earthquake_filters[COUNTRY_FILTER_KEY]
-    fetched_earthquakes = filter_by_location(
-        fetched_earthquakes, country, continent)
-    logging.info("Finished retrieving earthquake data.")
-    return fetched_earthquakes
+
+def get_stats_options(summary: str, args) -> tuple:
+    """Return the validated options of a /stats summary: the interval of the
+    time buckets for counts, and the bin size for magnitudes."""
+    if summary not in STATS_GROUPS:
+        raise ValueError(f"summary must be one of {', '.join(STATS_GROUPS)}")
+    if summary == "counts":
+        interval = args.get("interval") or DEFAULT_STATS_INTERVAL
+        if interval not in STATS_INTERVALS:
+            raise ValueError(f"interval must be one of {', '.join(STATS_INTERVALS)}")
+        return (interval,)
+    if summary == "magnitudes":
+        try:
+            bin_size = Decimal(args.get("bin_size") or DEFAULT_BIN_SIZE)
+        except InvalidOperation as e:
+            raise ValueError("bin_size must be a number") from e
+        if not 0 < bin_size <= MAX_BIN_SIZE:
+            raise ValueError(f"bin_size must be greater than 0 and at most {MAX_BIN_SIZE}")
+        return (bin_size, bin_size)
+    return ()
+
+
+def get_stats_query(summary: str, conditions: list[str], params: list,
+                    stats_options: tuple) -> tuple[str, list]:
+    """Return the query and parameters that summarise the matching earthquakes
+    per group (time bucket, magnitude bin, network or country) in the database,
+    so only one row per group is returned."""
+    group, name, order = STATS_GROUPS[summary]
+    query = (f"SELECT {group} AS {name}, {STATS_COLUMNS} "
+             f"{get_search_tables(group, *conditions)}")
+    if conditions:
+        query += "WHERE " + " AND ".join(conditions)
+    query += f"\n    GROUP BY 1 ORDER BY {order};"
+    return query, list(stats_options) + list(params)
+
+
+def get_stats_data(summary: str, earthquake_filters: dict[str],
+                   stats_options: tuple) -> list[dict]:
+    """Return a summary of the earthquakes matching the filters."""
+    conditions, params = get_filter_queries(earthquake_filters)
+    conn = get_connection()
+    try:
+        with get_cursor(conn) as cur:
+            cur.execute(*get_stats_query(summary, conditions, params, stats_options))
+            return cur.fetchall()
+    finally:
+        release_connection(conn)
+
+
+def get_next_link(next_cursor: str) -> str:
+    """Return a Link header pointing at the next page of the current request."""
+    args = request.args.to_dict()
+    args["cursor"] = next_cursor
+    return f'<{request.base_url}?{urlencode(args)}>; rel="next"'
+
+
+def get_user_filters() -> dict[str]:
+    """Return the filters given in the current request's query string."""
+    return {
+        STATUS_FILTER_KEY: request.args.get("status"),
+        NETWORK_FILTER_KEY: request.args.get("network"),
+        ALERT_FILTER_KEY: request.args.get("alert"),
+        MAG_TYPE_FILTER_KEY: request.args.get("mag_type"),
+        EVENT_FILTER_KEY: request.args.get("event"),
+        MIN_MAGNITUDE_FILTER_KEY: request.args.get("min_magnitude"),
+        CONTINENT_FILTER_KEY: request.args.get("continent"),
+        COUNTRY_FILTER_KEY: request.args.get("country"),
+        START_FILTER_KEY: request.args.get("start"),
+        END_FILTER_KEY: request.args.get("end"),
+        MIN_LAT_FILTER_KEY: request.args.get("min_lat"),
+        MAX_LAT_FILTER_KEY: request.args.get("max_lat"),
+        MIN_LON_FILTER_KEY: request.args.get("min_lon"),
+        MAX_LON_FILTER_KEY: request.args.get("max_lon")
+    }
+
+
+def get_error_response(e: Exception) -> tuple[Response, int]:
+    """Return the error response for an exception raised while handling a
+    request: a 503 when the connection pool is exhausted, otherwise a 400."""
+    if isinstance(e, PoolExhaustedError):
+        logging.error("Database connection pool exhausted: %s", e)
+        return jsonify({"error": "The service is busy, please try again shortly."}), 503, \
+            {"Retry-After": "1"}
+    logging.error(e)
+    return jsonify({"error": str(e)}), 400
 
 
 @app.route("/", methods=["GET"])
@@ -170,28 +673,94 @@ def endpoint_index() -> Response:
 
 @app.route("/earthquakes", methods=["GET"])
 def get_earthquakes() -> Response:
-    """This endpoint returns a list containing data on every earthquake in our system."""
+    """This endpoint returns a page of earthquakes in our system, newest first.
+    Further pages are linked to in the Link header. With stream=true, every
+    matching earthquake is streamed instead. Responses carry an ETag and
+    Last-Modified based on the latest data load, and conditional requests for
+    unchanged data get a 304 without querying the earthquakes."""
     try:
-        user_filters = {
-            STATUS_FILTER_KEY: request.args.get("status"),
-            NETWORK_FILTER_KEY: request.args.get("network"),
-            ALERT_FILTER_KEY: request.args.get("alert"),
-            MAG_TYPE_FILTER_KEY: request.args.get("mag_type"),
-            EVENT_FILTER_KEY: request.args.get("event"),
-            MIN_MAGNITUDE_FILTER_KEY: request.args.get("min_magnitude"),
-            CONTINENT_FILTER_KEY: request.args.get("continent"),
-            COUNTRY_FILTER_KEY: request.args.get("country")
-        }
-        earthquakes = get_earthquake_data(user_filters)
-        logging.info("%s earthquake events were retrieved.", len(earthquakes))
-        return jsonify(earthquakes), 200
+        user_filters = get_user_filters()
+        page_cursor = request.args.get("cursor")
+        stream = request.args.get("stream", "").lower() == "true"
+        page_size = None if stream else get_page_size(request.args.get("limit"))
+        fields = get_fields(request.args.get("fields"))
+        load_id, last_modified = get_data_watermark()
+        etag = get_etag(load_id, get_query_key(user_filters, page_size, page_cursor, fields))
+        if is_not_modified(etag, last_modified):
+            return set_cache_headers(Response(status=304), etag, last_modified)
+
+        if stream:
+            chunks = stream_earthquake_data(user_filters, page_cursor, fields)
+            # Start the query before sending the status, so errors still return a 400
+            first_chunk = next(chunks)
+            response = Response(chain([first_chunk], chunks), mimetype="application/json")
+            response.call_on_close(chunks.close)
+            return set_cache_headers(response, etag, last_modified), 200
+        body, next_cursor = get_cached_earthquake_data(load_id, user_filters, page_size,
+                                                       page_cursor, fields)
+        response = Response(body, mimetype="application/json")
+        if next_cursor:
+            response.headers["Link"] = get_next_link(next_cursor)
+        return set_cache_headers(response, etag, last_modified), 200
     except Exception as e:  # pylint: disable=broad-exception-caught
-        logging.error(e)
-        return jsonify({"error": str(e)}), 400
+        return get_error_response(e)
+
+
+@app.route("/earthquakes/near", methods=["GET"])
+def get_earthquakes_near() -> Response:
+    """This endpoint returns the k earthquakes nearest to a point, nearest first
+    and optionally within radius_km, with each one's distance_km. It accepts the
+    same filters as /earthquakes."""
+    try:
+        user_filters = get_user_filters()
+        near_options = get_near_options(request.args)
+        fields = get_fields(request.args.get("fields"))
+        load_id, last_modified = get_data_watermark()
+        query_key = get_query_key(user_filters, "near", *near_options, fields)
+        etag = get_etag(load_id, query_key)
+        if is_not_modified(etag, last_modified):
+            return set_cache_headers(Response(status=304), etag, last_modified)
+
+        body, _ = get_cached_body(load_id, query_key, lambda: (
+            get_near_earthquake_data(user_filters, near_options, fields), None))
+        response = Response(body, mimetype="application/json")
+        return set_cache_headers(response, etag, last_modified), 200
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        return get_error_response(e)
+
+
+@app.route("/stats/<summary>", methods=["GET"])
+def get_stats(summary: str) -> Response:
+    """This endpoint returns the count, max and mean magnitude and latest time of
+    the earthquakes matching the /earthquakes filters, per time bucket (counts),
+    magnitude bin (magnitudes), network (networks) or country (countries)."""
+    try:
+        user_filters = get_user_filters()
+        stats_options = get_stats_options(summary, request.args)
+        load_id, last_modified = get_data_watermark()
+        query_key = get_query_key(user_filters, "stats", summary, *stats_options)
+        etag = get_etag(load_id, query_key)
+        if is_not_modified(etag, last_modified):
+            return set_cache_headers(Response(status=304), etag, last_modified)
+
+        body, _ = get_cached_body(load_id, query_key, lambda: (
+            get_stats_data(summary, user_filters, stats_options), None))
+        response = Response(body, mimetype="application/json")
+        return set_cache_headers(response, etag, last_modified), 200
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        return get_error_response(e)
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics() -> Response:
+    """This endpoint returns the API's connection pool and result cache metrics."""
+    return {"db_pool": POOL["pool"].get_metrics() if "pool" in POOL else None,
+            "cache": get_cache().get_metrics()}, 200
 
 
 if __name__ == "__main__":
     load_dotenv()
     logging.basicConfig(format="%(asctime)s %(message)s", datefmt="%d/%m/%Y %H:%M:%S",
                         encoding='utf-8', level=logging.INFO)
+    start_listener(lambda: psycopg2.connect(**get_connection_details()), get_cache())
     app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,133 @@
+"""An in-process cache of query results for the API. Entries are evicted least
+recently used first once the cache's byte budget is spent and expire after a TTL.
+The API keys entries by data load, so results from an older load are never
+served; when the pipeline announces a new load they are also dropped, freeing
+their memory sooner than eviction or expiry would."""
+from collections import OrderedDict
+import logging
+import select
+import threading
+import time
+from typing import Callable
+from psycopg2.extensions import connection
+
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_CACHE_TTL = 60.0
+DATA_LOAD_CHANNEL = "data_loads"
+LISTEN_POLL_SECONDS = 5.0
+LISTEN_RETRY_SECONDS = 5.0
+
+
+class ResultCache:
+    """A thread-safe LRU cache of serialised responses, bounded by their total
+    size in bytes."""
+
+    def __init__(self, max_bytes: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0,
+                      "expirations": 0, "invalidations": 0}
+
+    def get(self, key: str) -> tuple[bytes, str | None] | None:
+        """Return the cached body and next page cursor for a key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                self.remove(key)
+                self.stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1], entry[2]
+
+    def set(self, key: str, body: bytes, next_cursor: str | None) -> None:
+        """Cache a body, evicting the least recently used entries to make room.
+        Bodies larger than the whole cache are not stored."""
+        entry_size = len(key) + len(body) + len(next_cursor or "")
+        if entry_size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            while self.size + entry_size > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+            self.entries[key] = (self.clock() + self.ttl, body, next_cursor, entry_size)
+            self.size += entry_size
+
+    def remove(self, key: str) -> None:
+        """Drop an entry. The caller must hold the lock."""
+        self.size -= self.entries.pop(key)[3]
+
+    def clear(self) -> None:
+        """Drop every entry, e.g. because new data has been loaded."""
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.stats["invalidations"] += 1
+
+    def get_metrics(self) -> dict:
+        """Return the cache's hit and miss ratios and memory use."""
+        with self.lock:
+            metrics = dict(self.stats)
+            metrics["entries"] = len(self.entries)
+            metrics["bytes"] = self.size
+        lookups = metrics["hits"] + metrics["misses"]
+        metrics["max_bytes"] = self.max_bytes
+        metrics["hit_ratio"] = metrics["hits"] / lookups if lookups else 0.0
+        metrics["miss_ratio"] = metrics["misses"] / lookups if lookups else 0.0
+        return metrics
+
+
+def wait_for_notifications(conn: connection, cache: ResultCache, stop: threading.Event) -> None:
+    """Clear the cache whenever a data load is announced on the connection,
+    until the stop event is set, to free the memory held by results from
+    older loads."""
+    while not stop.is_set():
+        if select.select([conn], [], [], LISTEN_POLL_SECONDS) == ([], [], []):
+            continue
+        conn.poll()
+        if conn.notifies:
+            logging.info("Data load %s announced, freeing the result cache.",
+                         conn.notifies[-1].payload)
+            conn.notifies.clear()
+            cache.clear()
+
+
+def listen_for_loads(connect: Callable[[], connection], cache: ResultCache,
+                     stop: threading.Event) -> None:
+    """LISTEN for the pipeline's data load notifications, reconnecting after
+    errors. The cache is cleared on every (re)connect to free any results left
+    from loads announced while not listening. Correctness does not depend on
+    this, as cache keys include the data load."""
+    while not stop.is_set():
+        conn = None
+        try:
+            conn = connect()
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {DATA_LOAD_CHANNEL};")
+            cache.clear()
+            wait_for_notifications(conn, cache, stop)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.error("Result cache listener failed: %s", e)
+            stop.wait(LISTEN_RETRY_SECONDS)
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+def start_listener(connect: Callable[[], connection], cache: ResultCache) -> threading.Event:
+    """Start listening for data loads on a daemon thread, returning the event
+    that stops it."""
+    stop = threading.Event()
+    threading.Thread(target=listen_for_loads, args=(connect, cache, stop),
+                     name="result-cache-listener", daemon=True).start()
+    return stop
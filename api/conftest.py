@@ -1,5 +1,7 @@
 # pylint: skip-file
 import pytest
+from datetime import datetime, timezone
+from unittest.mock import patch
 from api import app
 
 
@@ -10,6 +12,25 @@ def client():
         yield client
 
 
+@pytest.fixture(autouse=True)
+def mock_release_connection():
+    with patch("api.release_connection") as mock:
+        yield mock
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    with patch.dict("api.CACHE", clear=True):
+        yield
+
+
+@pytest.fixture(autouse=True)
+def mock_data_watermark():
+    with patch("api.get_data_watermark",
+               return_value=(3, datetime(2024, 6, 24, 12, 23, tzinfo=timezone.utc))) as mock:
+        yield mock
+
+
 @pytest.fixture()
 def example_api_response():
     return [
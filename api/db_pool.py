@@ -0,0 +1,124 @@
+"""A process-wide pool of database connections for the API, so requests reuse
+connections instead of paying for a new connection and login each time."""
+from collections import deque
+from contextlib import contextmanager
+import logging
+import threading
+import time
+import psycopg2
+from psycopg2.extensions import connection
+
+DEFAULT_POOL_MIN = 1
+DEFAULT_POOL_MAX = 10
+DEFAULT_POOL_TIMEOUT = 5.0
+
+
+class PoolExhaustedError(Exception):
+    """Raised when no connection becomes free within the pool's timeout."""
+
+
+def is_healthy(conn: connection) -> bool:
+    """Return whether a connection is open and able to run a query."""
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        return True
+    except psycopg2.Error as e:
+        logging.error("Pooled connection failed its health check: %s", e)
+        return False
+
+
+class ConnectionPool:
+    """A thread-safe connection pool. Up to `max_size` connections are opened and
+    kept, checkouts wait up to `timeout` seconds for a free connection and are
+    health checked before being handed out."""
+
+    def __init__(self, min_size: int, max_size: int, timeout: float, **connect_kwargs):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError("Pool sizes must satisfy 0 <= min <= max and max >= 1")
+        self.max_size = max_size
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs
+        self.idle = deque(psycopg2.connect(**connect_kwargs) for _ in range(min_size))
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        self.stats = {"checkouts": 0, "timeouts": 0, "health_check_failures": 0,
+                      "in_use": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+
+    def getconn(self) -> connection:
+        """Return a healthy connection, raising PoolExhaustedError if none is
+        free within the timeout."""
+        start = time.monotonic()
+        if not self.slots.acquire(timeout=self.timeout):  # pylint: disable=consider-using-with
+            with self.lock:
+                self.stats["timeouts"] += 1
+            raise PoolExhaustedError(
+                f"No database connection became free within {self.timeout}s")
+        try:
+            conn = self.get_idle_connection()
+            if conn is None:
+                conn = psycopg2.connect(**self.connect_kwargs)
+            elif not is_healthy(conn):
+                with self.lock:
+                    self.stats["health_check_failures"] += 1
+                conn.close()
+                conn = psycopg2.connect(**self.connect_kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        wait = time.monotonic() - start
+        with self.lock:
+            self.stats["checkouts"] += 1
+            self.stats["in_use"] += 1
+            self.stats["wait_seconds_total"] += wait
+            self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], wait)
+        return conn
+
+    def get_idle_connection(self) -> connection | None:
+        """Return the most recently used idle connection, if there is one."""
+        with self.lock:
+            return self.idle.pop() if self.idle else None
+
+    def putconn(self, conn: connection) -> None:
+        """Return a connection to the pool, ending any open transaction, or
+        discard it if it was closed or is unusable."""
+        try:
+            if not conn.closed:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                with self.lock:
+                    self.idle.append(conn)
+        except psycopg2.Error as e:
+            logging.error("Discarding a pooled connection: %s", e)
+            conn.close()
+        finally:
+            with self.lock:
+                self.stats["in_use"] -= 1
+            self.slots.release()
+
+    @contextmanager
+    def checkout(self):
+        """Check out a connection for the duration of a with block."""
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def get_metrics(self) -> dict:
+        """Return the pool's checkout wait and utilisation metrics."""
+        with self.lock:
+            metrics = dict(self.stats)
+        metrics["max_size"] = self.max_size
+        metrics["utilisation"] = metrics["in_use"] / self.max_size
+        metrics["wait_seconds_average"] = (metrics["wait_seconds_total"] / metrics["checkouts"]
+                                           if metrics["checkouts"] else 0.0)
+        return metrics
+
+    def close(self) -> None:
+        """Close every connection in the pool."""
+        with self.lock:
+            while self.idle:
+                self.idle.pop().close()
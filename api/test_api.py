@@ -1,7 +1,38 @@
 # pylint: skip-file
 import pytest
-from api import STATUS_FILTER_KEY, NETWORK_FILTER_KEY, ALERT_FILTER_KEY, MAG_TYPE_FILTER_KEY, EVENT_FILTER_KEY, MIN_MAGNITUDE_FILTER_KEY, CONTINENT_FILTER_KEY, COUNTRY_FILTER_KEY, get_filter_queries, filter_by_continent, filter_by_country, filter_by_location, is_continent_valid, get_earthquake_data
-from unittest.mock import patch
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+import json
+import psycopg2
+from api import STATUS_FILTER_KEY, NETWORK_FILTER_KEY, ALERT_FILTER_KEY, MAG_TYPE_FILTER_KEY, EVENT_FILTER_KEY, MIN_MAGNITUDE_FILTER_KEY, CONTINENT_FILTER_KEY, COUNTRY_FILTER_KEY, get_filter_queries, is_continent_valid, get_country_code, get_earthquake_data
+from api import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, get_page_size, encode_cursor, decode_cursor, get_page_query
+from api import STREAM_ITERSIZE, POOL, app, stream_earthquake_data
+from api import get_data_watermark, get_query_key, get_etag
+from api import DEFAULT_NEAR_K, get_near_options, get_near_query
+from api import get_stats_options, get_stats_query
+from api import FIELDS, get_fields, get_search_columns, get_search_tables
+from api import (START_FILTER_KEY, END_FILTER_KEY, MIN_LAT_FILTER_KEY, MAX_LAT_FILTER_KEY,
+                 MIN_LON_FILTER_KEY, MAX_LON_FILTER_KEY, parse_time, get_time_conditions,
+                 get_box_conditions)
+import os
+from db_pool import PoolExhaustedError
+from unittest.mock import patch, MagicMock
+
+
+def make_earthquakes(count, lat=38.8, lon=-122.8):
+    return [{"earthquake_id": f"nc{i:04d}", "time": datetime(2024, 6, 21, 20, 0, count - i),
+             "lat": lat, "lon": lon} for i in range(count)]
+
+
+def get_filters(**filters):
+    earthquake_filters = {STATUS_FILTER_KEY: None, NETWORK_FILTER_KEY: None, ALERT_FILTER_KEY: None,
+                          MAG_TYPE_FILTER_KEY: None, EVENT_FILTER_KEY: None,
+                          MIN_MAGNITUDE_FILTER_KEY: None, CONTINENT_FILTER_KEY: None,
+                          COUNTRY_FILTER_KEY: None, START_FILTER_KEY: None, END_FILTER_KEY: None,
+                          MIN_LAT_FILTER_KEY: None, MAX_LAT_FILTER_KEY: None,
+                          MIN_LON_FILTER_KEY: None, MAX_LON_FILTER_KEY: None}
+    earthquake_filters.update(filters)
+    return earthquake_filters
 
 
 def test_endpoint_index(client):
@@ -12,10 +43,29 @@ def test_endpoint_index(client):
 
 @patch("api.get_earthquake_data")
 def test_endpoint_get_earthquakes(mock_all_earthquakes, client):
-    mock_all_earthquakes.return_value = [{"test": "output"}]
+    mock_all_earthquakes.return_value = ([{"test": "output"}], None)
     response = client.get("/earthquakes")
     assert response.status_code == 200
     assert isinstance(response.json, list)
+    assert "Link" not in response.headers
+
+
+@patch("api.get_earthquake_data")
+def test_endpoint_get_earthquakes_next_link(mock_all_earthquakes, client):
+    mock_all_earthquakes.return_value = ([{"test": "output"}], "abc")
+    response = client.get("/earthquakes?limit=1&status=reviewed&cursor=old")
+    assert response.status_code == 200
+    assert response.headers["Link"] == \
+        '<http://localhost/earthquakes?limit=1&status=reviewed&cursor=abc>; rel="next"'
+    assert mock_all_earthquakes.call_args[0][1:] == (1, "old", None)
+
+
+@pytest.mark.parametrize("query", ["limit=0", "limit=1001", "limit=ten", "cursor=!!!"])
+def test_endpoint_get_earthquakes_invalid_page(query, client):
+    with patch("api.get_connection"):
+        response = client.get(f"/earthquakes?{query}")
+    assert response.status_code == 400
+    assert "error" in response.json
 
 
 @patch("api.get_earthquake_data")
@@ -29,8 +79,7 @@ def test_endpoint_get_earthquakes_error_handling(mock_all_earthquakes, client):
 @patch("api.get_connection")
 @patch("api.get_filter_queries")
 @patch("api.get_cursor")
-@patch("api.filter_by_location")
-def test_get_earthquake_data_function_calls(mock_location_filter, mock_cursor, mock_filter_queries, mock_connection):
+def test_get_earthquake_data_function_calls(mock_cursor, mock_filter_queries, mock_connection):
     test_filter_dict = {
         STATUS_FILTER_KEY: "status",
         NETWORK_FILTER_KEY: "net",
@@ -41,8 +90,8 @@ def test_get_earthquake_data_function_calls(mock_location_filter, mock_cursor, m
         CONTINENT_FILTER_KEY: "continent",
         COUNTRY_FILTER_KEY: "country"
     }
+    mock_filter_queries.return_value = ([], [])
     get_earthquake_data(test_filter_dict)
-    mock_location_filter.assert_called_once == True
     mock_cursor.assert_called_once == True
     mock_filter_queries.assert_called_once == True
     mock_connection.assert_called_once == True
@@ -56,18 +105,20 @@ def test_get_filter_queries():
         MAG_TYPE_FILTER_KEY: "magtype",
         EVENT_FILTER_KEY: "type",
         MIN_MAGNITUDE_FILTER_KEY: "min mag",
-        CONTINENT_FILTER_KEY: "continent",
-        COUNTRY_FILTER_KEY: "country"
+        CONTINENT_FILTER_KEY: "asia",
+        COUNTRY_FILTER_KEY: "japan"
     }
 
-    assert get_filter_queries(test_filter_dict) == [
-        "WHERE s.status = 'status'",
-        "n.network_name = 'net'",
-        "a.alert_value = 'alert'",
-        "mt.magtype_value = 'magtype'",
-        "t.type_value = 'type'",
-        "e.magnitude >= 'min mag'"
-    ]
+    assert get_filter_queries(test_filter_dict) == ([
+        "s.status = %s",
+        "n.network_name = %s",
+        "a.alert_value = %s",
+        "mt.magtype_value = %s",
+        "t.type_value = %s",
+        "e.magnitude >= %s",
+        "e.country_code = %s",
+        "e.continent_code = %s"
+    ], ["status", "net", "alert", "magtype", "type", "min mag", "JP", "AS"])
 
 
 def test_get_filter_queries_alert_is_first_filter():
@@ -78,46 +129,159 @@ def test_get_filter_queries_alert_is_first_filter():
         MAG_TYPE_FILTER_KEY: "magtype",
         EVENT_FILTER_KEY: "type",
         MIN_MAGNITUDE_FILTER_KEY: "min mag",
-        CONTINENT_FILTER_KEY: "continent",
-        COUNTRY_FILTER_KEY: "country"
+        CONTINENT_FILTER_KEY: None,
+        COUNTRY_FILTER_KEY: None
     }
 
-    assert get_filter_queries(test_filter_dict) == [
-        "WHERE a.alert_value = 'alert'",
-        "mt.magtype_value = 'magtype'",
-        "t.type_value = 'type'",
-        "e.magnitude >= 'min mag'"
-    ]
+    assert get_filter_queries(test_filter_dict) == ([
+        "a.alert_value = %s",
+        "mt.magtype_value = %s",
+        "t.type_value = %s",
+        "e.magnitude >= %s"
+    ], ["alert", "magtype", "type", "min mag"])
+
+
+def test_get_filter_queries_invalid_location():
+    assert get_filter_queries(get_filters(**{CONTINENT_FILTER_KEY: "Coney Island",
+                                             COUNTRY_FILTER_KEY: "Atlantis"})) == (
+        ["e.country_code = %s"], [None])
+
+
+@pytest.mark.parametrize("country, expected", [("United States", "US"), ("united kingdom", "GB"),
+                                               ("jp", "JP"), (" Japan ", "JP"), ("Atlantis", None)])
+def test_get_country_code(country, expected):
+    assert get_country_code(country) == expected
+
+
+def test_get_filter_queries_are_parameterised():
+    conditions, params = get_filter_queries(get_filters(**{STATUS_FILTER_KEY: "x' OR '1'='1"}))
+
+    assert conditions == ["s.status = %s"]
+    assert params == ["x' OR '1'='1"]
+
+
+@pytest.mark.parametrize("limit, expected", [(None, DEFAULT_PAGE_SIZE), ("", DEFAULT_PAGE_SIZE),
+                                             ("1", 1), (str(MAX_PAGE_SIZE), MAX_PAGE_SIZE)])
+def test_get_page_size(limit, expected):
+    assert get_page_size(limit) == expected
+
+
+@pytest.mark.parametrize("limit", ["0", "-5", str(MAX_PAGE_SIZE + 1), "many"])
+def test_get_page_size_invalid(limit):
+    with pytest.raises(ValueError):
+        get_page_size(limit)
+
+
+def test_cursor_round_trip():
+    earthquake = make_earthquakes(1)[0]
+
+    page_cursor = encode_cursor(earthquake)
+
+    assert "=" not in page_cursor
+    assert decode_cursor(page_cursor) == (earthquake["time"], earthquake["earthquake_id"])
+
+
+@pytest.mark.parametrize("page_cursor", ["!!!", "bm90IGpzb24", "e30"])
+def test_decode_cursor_invalid(page_cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        decode_cursor(page_cursor)
+
 
+def test_get_page_query():
+    after = (datetime(2024, 6, 21), "nc0001")
 
-def test_filter_by_continent(example_api_response):
-    assert filter_by_continent(example_api_response, "Africa") == []
-    assert filter_by_continent(
-        example_api_response, "North America") == example_api_response
+    query, params = get_page_query(["s.status = %s"], ["reviewed"], after, 101)
 
+    assert "WHERE s.status = %s AND (e.time, e.earthquake_id) < (%s, %s)" in query
+    assert query.endswith("ORDER BY e.time DESC, e.earthquake_id DESC LIMIT %s;")
+    assert params == ["reviewed", after[0], "nc0001", 101]
 
-def test_filter_by_continent_invalid_continent(example_api_response):
-    assert filter_by_continent(
-        example_api_response, "Coney Island") == example_api_response
 
+def test_get_page_query_first_page():
+    query, params = get_page_query([], [], None, 11)
 
-def test_filter_by_continent_error_handling(caplog):
-    error_data = [{}, {}]
-    filter_by_continent(error_data, "Africa")
-    assert "Error appending data row (continent): " in caplog.text
+    assert "WHERE" not in query
+    assert params == [11]
 
 
-def test_filter_by_country_error_handling(caplog):
-    error_data = [{}, {}]
-    filter_by_country(error_data, "Ecuador")
-    assert "Error appending data row (country): " in caplog.text
+@pytest.mark.parametrize("fields, expected", [
+    (None, None),
+    ("", None),
+    ("time,lat, lon,magnitude", ["magnitude", "lon", "lat", "time"]),
+    ("alert,alert", ["alert"])])
+def test_get_fields(fields, expected):
+    assert get_fields(fields) == expected
 
 
-def test_filter_by_country(example_api_response):
-    assert filter_by_country(example_api_response,
-                             "China") == []
-    assert filter_by_country(example_api_response,
-                             "United States") == example_api_response
+@pytest.mark.parametrize("fields", ["lat,password", ",", "e.lat"])
+def test_get_fields_invalid(fields):
+    with pytest.raises(ValueError, match="fields must be a comma separated list of"):
+        get_fields(fields)
+
+
+def test_get_search_columns():
+    assert get_search_columns(["magnitude", "lon", "lat"], ["time", "earthquake_id"]) == \
+        "e.earthquake_id, e.magnitude, e.lon, e.lat, e.time"
+    assert get_search_columns(["alert"]) == "a.alert_value AS alert"
+    assert get_search_columns(None) == ", ".join(FIELDS.values())
+
+
+def test_get_search_tables_only_joins_tables_used():
+    assert get_search_tables("e.lon, e.lat") == "FROM earthquakes AS e\n    "
+    assert get_search_tables("e.lon, a.alert_value AS alert") == \
+        "FROM earthquakes AS e\n    LEFT JOIN alerts AS a USING(alert_id)\n    "
+    assert get_search_tables("mt.magtype_value AS magtype", "s.status = %s") == \
+        ("FROM earthquakes AS e\n    LEFT JOIN magtypes AS mt USING(magtype_id)\n"
+         "    LEFT JOIN statuses AS s USING(status_id)\n    ")
+
+
+def test_get_page_query_with_fields():
+    query, _ = get_page_query(["a.alert_value = %s"], ["red"], None, 11, ["lon", "lat"])
+
+    assert query.startswith("SELECT e.earthquake_id, e.lon, e.lat, e.time FROM earthquakes AS e")
+    assert "LEFT JOIN alerts AS a" in query
+    assert query.count("LEFT JOIN") == 1
+
+
+@patch("api.get_connection")
+@patch("api.get_cursor")
+def test_get_earthquake_data_pages(mock_cursor, mock_connection, mock_release_connection):
+    cur = mock_cursor.return_value.__enter__.return_value
+    earthquakes = make_earthquakes(3)
+    cur.fetchall.return_value = earthquakes
+
+    page, next_cursor = get_earthquake_data(get_filters(), 2)
+
+    assert page == earthquakes[:2]
+    assert decode_cursor(next_cursor) == (earthquakes[1]["time"], "nc0001")
+    assert cur.execute.call_args[0][1] == [3]
+    mock_release_connection.assert_called_once_with(mock_connection.return_value)
+
+
+@patch("api.get_connection")
+@patch("api.get_cursor")
+def test_get_earthquake_data_last_page(mock_cursor, mock_connection):
+    cur = mock_cursor.return_value.__enter__.return_value
+    cur.fetchall.return_value = make_earthquakes(2)
+
+    page, next_cursor = get_earthquake_data(get_filters(), 2, encode_cursor(make_earthquakes(3)[0]))
+
+    assert len(page) == 2
+    assert next_cursor is None
+    assert "(e.time, e.earthquake_id) < (%s, %s)" in cur.execute.call_args[0][0]
+
+
+@patch("api.get_connection")
+@patch("api.get_cursor")
+def test_get_earthquake_data_with_fields(mock_cursor, mock_connection):
+    cur = mock_cursor.return_value.__enter__.return_value
+    earthquakes = make_earthquakes(3)
+    cur.fetchall.return_value = earthquakes
+
+    page, next_cursor = get_earthquake_data(get_filters(), 2, None, ["lat", "lon"])
+
+    assert page == [{"lat": 38.8, "lon": -122.8}] * 2
+    assert decode_cursor(next_cursor) == (earthquakes[1]["time"], "nc0001")
 
 
 def test_is_continent_valid():
@@ -128,12 +292,581 @@ def test_is_continent_invalid():
     assert is_continent_valid("Three") == False
 
 
-@patch("api.filter_by_country")
-@patch("api.filter_by_continent")
-@pytest.mark.parametrize("inputs, expect", [(("china", "africa"), (True, False)),
-                                            ((None, "africa"), (False, True)),
-                                            (("china", None), (True, False)),
-                                            ((None, None), (False, False))])
-def test_filter_by_location(mock_continent_filter, mock_country_filter, inputs, expect):
-    filter_by_location([{}, {}], inputs[0], inputs[1])
-    mock_continent_filter.assert_called_once, mock_country_filter.assert_called_once == expect
+def make_stream_connection(mock_connection, rows):
+    cur = mock_connection.return_value.cursor.return_value.__enter__.return_value
+    cur.__iter__.return_value = iter(rows)
+    return cur
+
+
+@patch("api.STREAM_CHUNK_ROWS", 2)
+@patch("api.get_connection")
+def test_stream_earthquake_data(mock_connection, mock_release_connection):
+    earthquakes = make_earthquakes(5)
+    cur = make_stream_connection(mock_connection, earthquakes)
+
+    chunks = list(stream_earthquake_data(get_filters(**{STATUS_FILTER_KEY: "reviewed"})))
+
+    assert chunks[0] == "[" and chunks[-1] == "]"
+    assert len(chunks) == 5
+    assert [row["earthquake_id"] for row in json.loads("".join(chunks))] == [
+        earthquake["earthquake_id"] for earthquake in earthquakes]
+    assert mock_connection.return_value.cursor.call_args[1]["name"] == "earthquake_stream"
+    assert cur.itersize == STREAM_ITERSIZE
+    query, params = cur.execute.call_args[0]
+    assert "LIMIT" not in query
+    assert params == ["reviewed"]
+    mock_release_connection.assert_called_once_with(mock_connection.return_value)
+
+
+@patch("api.get_connection")
+def test_stream_earthquake_data_empty(mock_connection):
+    make_stream_connection(mock_connection, [])
+
+    assert "".join(stream_earthquake_data(get_filters())) == "[]"
+
+
+@patch("api.get_connection")
+def test_stream_earthquake_data_closes_early(mock_connection, mock_release_connection):
+    make_stream_connection(mock_connection, make_earthquakes(3))
+
+    chunks = stream_earthquake_data(get_filters())
+    next(chunks)
+    chunks.close()
+
+    mock_release_connection.assert_called_once_with(mock_connection.return_value)
+
+
+@patch("api.get_connection")
+def test_endpoint_get_earthquakes_stream(mock_connection, client, mock_release_connection):
+    make_stream_connection(mock_connection, make_earthquakes(3))
+
+    response = client.get("/earthquakes?stream=true")
+
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert len(response.json) == 3
+    assert "Link" not in response.headers
+    mock_release_connection.assert_called_once_with(mock_connection.return_value)
+
+
+@patch("api.get_connection")
+def test_endpoint_get_earthquakes_stream_error(mock_connection, client):
+    mock_connection.side_effect = psycopg2.OperationalError("database unavailable")
+
+    response = client.get("/earthquakes?stream=true")
+
+    assert response.status_code == 400
+    assert response.json == {"error": "database unavailable"}
+
+
+@patch("api.get_earthquake_data")
+def test_endpoint_get_earthquakes_pool_exhausted(mock_all_earthquakes, client):
+    mock_all_earthquakes.side_effect = PoolExhaustedError("No database connection became free")
+
+    response = client.get("/earthquakes")
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert "busy" in response.json["error"]
+
+
+@patch.dict("api.POOL", {"pool": MagicMock()})
+def test_endpoint_metrics(client):
+    POOL["pool"].get_metrics.return_value = {"in_use": 1}
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.json["db_pool"] == {"in_use": 1}
+
+
+def test_endpoint_metrics_before_pool(client):
+    assert client.get("/metrics").json["db_pool"] is None
+
+
+@patch("api.get_earthquake_data")
+def test_endpoint_get_earthquakes_cached(mock_all_earthquakes, client):
+    mock_all_earthquakes.return_value = ([{"test": "output"}], "abc")
+
+    first = client.get("/earthquakes?country=japan")
+    second = client.get("/earthquakes?country=JP")
+    client.get("/earthquakes?country=JP&limit=5")
+
+    assert first.json == second.json == [{"test": "output"}]
+    assert second.headers["Link"].endswith('cursor=abc>; rel="next"')
+    assert mock_all_earthquakes.call_count == 2
+    metrics = client.get("/metrics").json["cache"]
+    assert (metrics["hits"], metrics["misses"], metrics["entries"]) == (1, 2, 2)
+    assert metrics["hit_ratio"] == pytest.approx(1 / 3)
+    assert metrics["bytes"] > 0
+
+
+@patch("api.get_earthquake_data")
+def test_endpoint_get_earthquakes_cache_keyed_by_data_load(mock_all_earthquakes, client,
+                                                          mock_data_watermark):
+    mock_all_earthquakes.return_value = ([{"test": "output"}], None)
+    client.get("/earthquakes?country=JP")
+    mock_data_watermark.return_value = (4, datetime(2024, 6, 24, 13, 23, tzinfo=timezone.utc))
+    mock_all_earthquakes.return_value = ([{"test": "newer"}], None)
+
+    response = client.get("/earthquakes?country=JP")
+
+    assert response.json == [{"test": "newer"}]
+    assert mock_all_earthquakes.call_count == 2
+
+
+@patch("api.get_near_earthquake_data", return_value=[])
+@patch("api.get_stats_data", return_value=[])
+def test_endpoint_near_and_stats_cache_keyed_by_data_load(mock_stats, mock_near, client,
+                                                          mock_data_watermark):
+    client.get("/earthquakes/near?lat=53.4&lon=-2.9")
+    client.get("/stats/networks")
+    mock_data_watermark.return_value = (4, datetime(2024, 6, 24, 13, 23, tzinfo=timezone.utc))
+    client.get("/earthquakes/near?lat=53.4&lon=-2.9")
+    client.get("/stats/networks")
+
+    assert mock_near.call_count == 2
+    assert mock_stats.call_count == 2
+
+
+@patch("api.get_earthquake_data")
+def test_endpoint_get_earthquakes_stream_not_cached(mock_all_earthquakes, client):
+    with patch("api.stream_earthquake_data", return_value=iter(["[", "]"])):
+        client.get("/earthquakes?stream=true")
+
+    assert client.get("/metrics").json["cache"]["entries"] == 0
+
+
+@patch("api.get_connection")
+@patch("api.get_cursor")
+def test_get_data_watermark(mock_cursor, mock_connection, mock_release_connection):
+    mock_cursor.return_value.__enter__.return_value.fetchone.return_value = {
+        "load_id": 12, "loaded_at": datetime(2024, 6, 24, 12, 23, 5)}
+
+    load_id, last_modified = get_data_watermark()
+
+    assert load_id == 12
+    assert last_modified.isoformat() == "2024-06-24T12:23:05+00:00"
+    mock_release_connection.assert_called_once_with(mock_connection.return_value)
+
+
+@patch("api.get_connection")
+@patch("api.get_cursor")
+def test_get_data_watermark_before_first_load(mock_cursor, mock_connection):
+    mock_cursor.return_value.__enter__.return_value.fetchone.return_value = None
+
+    assert get_data_watermark() == (0, None)
+
+
+def test_get_query_key_is_normalised():
+    by_name = get_query_key(get_filters(**{COUNTRY_FILTER_KEY: "japan"}), 100, None)
+
+    assert by_name == get_query_key(get_filters(**{COUNTRY_FILTER_KEY: "JP", STATUS_FILTER_KEY: ""}), 100, None)
+    assert by_name != get_query_key(get_filters(**{COUNTRY_FILTER_KEY: "JP"}), 10, None)
+
+
+def test_get_etag_changes_with_each_load():
+    query_key = get_query_key(get_filters(), 100, None)
+
+    assert get_etag(1, query_key) == get_etag(1, query_key)
+    assert get_etag(1, query_key) != get_etag(2, query_key)
+
+
+@patch("api.get_earthquake_data")
+def test_endpoint_get_earthquakes_cache_headers(mock_all_earthquakes, client):
+    mock_all_earthquakes.return_value = ([{"test": "output"}], None)
+
+    response = client.get("/earthquakes?country=japan")
+
+    assert response.headers["ETag"] == f'"{get_etag(3, get_query_key(get_filters(**{COUNTRY_FILTER_KEY: "japan"}), 100, None, None))}"'
+    assert response.headers["Last-Modified"] == "Mon, 24 Jun 2024 12:23:00 GMT"
+    assert response.headers["Cache-Control"] in ("public, max-age=60", "max-age=60, public")
+
+
+@patch("api.get_earthquake_data")
+def test_endpoint_get_earthquakes_if_none_match(mock_all_earthquakes, client):
+    mock_all_earthquakes.return_value = ([{"test": "output"}], None)
+    etag = client.get("/earthquakes?country=japan").headers["ETag"]
+    mock_all_earthquakes.reset_mock()
+
+    response = client.get("/earthquakes?country=JP", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.data == b""
+    assert response.headers["ETag"] == etag
+    mock_all_earthquakes.assert_not_called()
+
+
+@patch("api.get_earthquake_data")
+def test_endpoint_get_earthquakes_changed_after_load(mock_all_earthquakes, client, mock_data_watermark):
+    mock_all_earthquakes.return_value = ([{"test": "output"}], None)
+    etag = client.get("/earthquakes").headers["ETag"]
+    mock_data_watermark.return_value = (4, datetime(2024, 6, 24, 12, 24, tzinfo=timezone.utc))
+
+    response = client.get("/earthquakes", headers={"If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+@pytest.mark.parametrize("since, status", [("Mon, 24 Jun 2024 12:23:00 GMT", 304),
+                                           ("Mon, 24 Jun 2024 12:22:59 GMT", 200)])
+@patch("api.get_earthquake_data")
+def test_endpoint_get_earthquakes_if_modified_since(mock_all_earthquakes, since, status, client):
+    mock_all_earthquakes.return_value = ([{"test": "output"}], None)
+
+    response = client.get("/earthquakes", headers={"If-Modified-Since": since})
+
+    assert response.status_code == status
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("2024-06-24", datetime(2024, 6, 24)),
+    ("2024-06-24T12:30:00Z", datetime(2024, 6, 24, 12, 30)),
+    ("2024-06-24T13:30:00+01:00", datetime(2024, 6, 24, 12, 30))])
+def test_parse_time(value, expected):
+    assert parse_time(value, "start") == expected
+
+
+def test_parse_time_invalid():
+    with pytest.raises(ValueError, match="start must be an ISO 8601 date or time"):
+        parse_time("yesterday", "start")
+
+
+def test_get_time_conditions():
+    assert get_time_conditions(get_filters(**{START_FILTER_KEY: "2024-06-23T12:00:00Z",
+                                              END_FILTER_KEY: "2024-06-24T12:00:00Z"})) == (
+        ["e.time >= %s", "e.time <= %s"], [datetime(2024, 6, 23, 12), datetime(2024, 6, 24, 12)])
+
+
+def test_get_time_conditions_reversed():
+    with pytest.raises(ValueError, match="start must be before end"):
+        get_time_conditions(get_filters(**{START_FILTER_KEY: "2024-06-24", END_FILTER_KEY: "2024-06-23"}))
+
+
+def test_get_box_conditions():
+    assert get_box_conditions(get_filters(**{MIN_LAT_FILTER_KEY: "30", MAX_LAT_FILTER_KEY: "45",
+                                             MIN_LON_FILTER_KEY: "-125", MAX_LON_FILTER_KEY: "-110"})) == (
+        ["e.lat >= %s", "e.lat <= %s", "e.lon >= %s", "e.lon <= %s"], [30, 45, -125, -110])
+
+
+def test_get_box_conditions_crossing_antimeridian():
+    assert get_box_conditions(get_filters(**{MIN_LON_FILTER_KEY: "170", MAX_LON_FILTER_KEY: "-170"})) == (
+        ["(e.lon >= %s OR e.lon <= %s)"], [170, -170])
+
+
+def test_get_box_conditions_open_sided():
+    assert get_box_conditions(get_filters(**{MIN_LAT_FILTER_KEY: "-10.5", MAX_LON_FILTER_KEY: "20"})) == (
+        ["e.lat >= %s", "e.lon <= %s"], [-10.5, 20])
+
+
+@pytest.mark.parametrize("filters, message", [
+    ({MIN_LAT_FILTER_KEY: "north"}, "min_lat must be a number"),
+    ({MAX_LAT_FILTER_KEY: "91"}, "max_lat must be between -90 and 90"),
+    ({MIN_LON_FILTER_KEY: "-180.5"}, "min_lon must be between -180 and 180"),
+    ({MAX_LON_FILTER_KEY: "nan"}, "max_lon must be between -180 and 180"),
+    ({MIN_LAT_FILTER_KEY: "10", MAX_LAT_FILTER_KEY: "5"}, "min_lat must not be greater than max_lat")])
+def test_get_box_conditions_invalid(filters, message):
+    with pytest.raises(ValueError, match=message):
+        get_box_conditions(get_filters(**filters))
+
+
+@patch("api.get_earthquake_data")
+def test_endpoint_get_earthquakes_time_and_box(mock_all_earthquakes, client):
+    mock_all_earthquakes.return_value = ([], None)
+
+    response = client.get("/earthquakes?start=2024-06-23T12:00:00Z&min_lat=30&max_lat=45"
+                          "&min_lon=170&max_lon=-170")
+
+    assert response.status_code == 200
+    conditions, params = get_filter_queries(mock_all_earthquakes.call_args[0][0])
+    assert conditions == ["e.time >= %s", "e.lat >= %s", "e.lat <= %s", "(e.lon >= %s OR e.lon <= %s)"]
+    assert params == [datetime(2024, 6, 23, 12), 30, 45, 170, -170]
+
+
+def test_endpoint_get_earthquakes_invalid_box(client):
+    response = client.get("/earthquakes?min_lat=95")
+
+    assert response.status_code == 400
+    assert response.json == {"error": "min_lat must be between -90 and 90"}
+
+
+@pytest.mark.parametrize("args, expected", [
+    ({"lat": "35.6", "lon": "139.7"}, (35.6, 139.7, None, DEFAULT_NEAR_K)),
+    ({"lat": "35.6", "lon": "139.7", "radius_km": "100", "k": "5"}, (35.6, 139.7, 100, 5))])
+def test_get_near_options(args, expected):
+    assert get_near_options(args) == expected
+
+
+@pytest.mark.parametrize("args, message", [
+    ({"lat": "35.6"}, "lat and lon are required"),
+    ({"lat": "95", "lon": "0"}, "lat must be between -90 and 90"),
+    ({"lat": "0", "lon": "0", "radius_km": "0"}, "radius_km must be greater than 0"),
+    ({"lat": "0", "lon": "0", "radius_km": "far"}, "radius_km must be a number"),
+    ({"lat": "0", "lon": "0", "k": "1001"}, "k must be between 1 and 1000")])
+def test_get_near_options_invalid(args, message):
+    with pytest.raises(ValueError, match=message):
+        get_near_options(args)
+
+
+def test_get_near_query():
+    query, params = get_near_query(["s.status = %s"], ["reviewed"], (35.6, 139.7, 100, 20))
+
+    assert "earth_box(ll_to_earth(%s, %s), %s) @> ll_to_earth(e.lat::float8, e.lon::float8)" in query
+    assert "earth_distance(ll_to_earth(%s, %s), ll_to_earth(e.lat::float8, e.lon::float8)) <= %s" in query
+    assert query.endswith("ORDER BY ll_to_earth(e.lat::float8, e.lon::float8) <-> ll_to_earth(%s, %s) LIMIT %s;")
+    assert query.count("%s") == len(params)
+    assert params == [35.6, 139.7, "reviewed", 35.6, 139.7, 100000, 35.6, 139.7, 100000,
+                      35.6, 139.7, 20]
+
+
+def test_get_near_query_with_fields():
+    query, _ = get_near_query(["n.network_name = %s"], ["us"], (35.6, 139.7, None, 5),
+                              ["magnitude"])
+
+    assert query.startswith("SELECT e.magnitude,")
+    assert "AS distance_km FROM earthquakes AS e\n    LEFT JOIN networks AS n USING(network_id)" in query
+    assert query.count("LEFT JOIN") == 1
+
+
+def test_get_near_query_without_radius():
+    query, params = get_near_query([], [], (35.6, 139.7, None, 5))
+
+    assert "WHERE" not in query
+    assert params == [35.6, 139.7, 35.6, 139.7, 5]
+
+
+@patch("api.get_connection")
+@patch("api.get_cursor")
+def test_endpoint_get_earthquakes_near(mock_cursor, mock_connection, client, mock_release_connection):
+    cur = mock_cursor.return_value.__enter__.return_value
+    cur.fetchall.return_value = [{"earthquake_id": "a", "distance_km": 1.5}]
+
+    response = client.get("/earthquakes/near?lat=35.6&lon=139.7&radius_km=100&k=5&status=reviewed")
+    client.get("/earthquakes/near?lat=35.6&lon=139.7&radius_km=100&k=5&status=reviewed")
+
+    assert response.status_code == 200
+    assert response.json == [{"earthquake_id": "a", "distance_km": 1.5}]
+    assert "ETag" in response.headers
+    query, params = cur.execute.call_args[0]
+    assert "s.status = %s" in query
+    assert params[-1] == 5
+    cur.execute.assert_called_once()
+    mock_release_connection.assert_called_once_with(mock_connection.return_value)
+
+
+def test_endpoint_get_earthquakes_near_if_none_match(client):
+    with patch("api.get_near_earthquake_data", return_value=[]) as mock_near:
+        etag = client.get("/earthquakes/near?lat=35.6&lon=139.7").headers["ETag"]
+        response = client.get("/earthquakes/near?lat=35.6&lon=139.7", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    mock_near.assert_called_once()
+
+
+def test_endpoint_get_earthquakes_near_invalid(client):
+    response = client.get("/earthquakes/near?lon=139.7")
+
+    assert response.status_code == 400
+    assert response.json == {"error": "lat and lon are required"}
+
+
+@pytest.mark.parametrize("summary, args, expected", [
+    ("counts", {}, ("day",)),
+    ("counts", {"interval": "month"}, ("month",)),
+    ("magnitudes", {}, (Decimal("1"), Decimal("1"))),
+    ("magnitudes", {"bin_size": "0.5"}, (Decimal("0.5"), Decimal("0.5"))),
+    ("networks", {"interval": "month"}, ()),
+    ("countries", {}, ())])
+def test_get_stats_options(summary, args, expected):
+    assert get_stats_options(summary, args) == expected
+
+
+@pytest.mark.parametrize("summary, args, message", [
+    ("regions", {}, "summary must be one of counts, magnitudes, networks, countries"),
+    ("counts", {"interval": "minute"}, "interval must be one of hour, day, week, month, year"),
+    ("magnitudes", {"bin_size": "big"}, "bin_size must be a number"),
+    ("magnitudes", {"bin_size": "0"}, "bin_size must be greater than 0 and at most 10")])
+def test_get_stats_options_invalid(summary, args, message):
+    with pytest.raises(ValueError, match=message):
+        get_stats_options(summary, args)
+
+
+def test_get_stats_query():
+    query, params = get_stats_query("magnitudes", ["s.status = %s"], ["reviewed"],
+                                    (Decimal("0.5"), Decimal("0.5")))
+
+    assert query.startswith("SELECT (floor(e.magnitude::numeric / %s) * %s)::float8 AS min_magnitude,")
+    assert "WHERE s.status = %s" in query
+    assert query.endswith("GROUP BY 1 ORDER BY min_magnitude;")
+    assert query.count("%s") == len(params)
+    assert params == [Decimal("0.5"), Decimal("0.5"), "reviewed"]
+
+
+def test_get_stats_query_without_filters():
+    query, params = get_stats_query("countries", [], [], ())
+
+    assert query.startswith("SELECT e.country_code AS country_code, count(*) AS count,")
+    assert "WHERE" not in query
+    assert query.endswith("GROUP BY 1 ORDER BY count DESC, country_code;")
+    assert params == []
+
+
+@patch("api.get_connection")
+@patch("api.get_cursor")
+def test_endpoint_get_stats(mock_cursor, mock_connection, client, mock_release_connection):
+    cur = mock_cursor.return_value.__enter__.return_value
+    cur.fetchall.return_value = [{"network_name": "us", "count": 3, "max_magnitude": 5.1}]
+
+    response = client.get("/stats/networks?min_magnitude=4")
+    client.get("/stats/networks?min_magnitude=4")
+
+    assert response.status_code == 200
+    assert response.json == [{"network_name": "us", "count": 3, "max_magnitude": 5.1}]
+    assert "ETag" in response.headers
+    query, params = cur.execute.call_args[0]
+    assert "e.magnitude >= %s" in query
+    assert params == ["4"]
+    cur.execute.assert_called_once()
+    mock_release_connection.assert_called_once_with(mock_connection.return_value)
+
+
+@patch("api.get_stats_data", return_value=[])
+def test_endpoint_get_stats_options_are_cached_separately(mock_stats, client):
+    client.get("/stats/counts?interval=day")
+    client.get("/stats/counts?interval=week")
+    client.get("/stats/counts?interval=week")
+
+    assert [call.args[2] for call in mock_stats.call_args_list] == [("day",), ("week",)]
+
+
+def test_endpoint_get_stats_if_none_match(client):
+    with patch("api.get_stats_data", return_value=[]) as mock_stats:
+        etag = client.get("/stats/countries").headers["ETag"]
+        response = client.get("/stats/countries", headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    mock_stats.assert_called_once()
+
+
+@patch("api.get_connection")
+@patch("api.get_cursor")
+def test_endpoint_get_earthquakes_with_fields(mock_cursor, mock_connection, client):
+    cur = mock_cursor.return_value.__enter__.return_value
+    cur.fetchall.return_value = make_earthquakes(2)
+
+    response = client.get("/earthquakes?fields=lat,lon&limit=1")
+
+    assert response.status_code == 200
+    assert response.json == [{"lat": 38.8, "lon": -122.8}]
+    assert "Link" in response.headers
+    query = cur.execute.call_args[0][0]
+    assert query.startswith("SELECT e.earthquake_id, e.lon, e.lat, e.time FROM earthquakes AS e")
+    assert "LEFT JOIN" not in query
+
+
+@patch("api.get_connection")
+def test_endpoint_stream_earthquakes_with_fields(mock_connection, client):
+    make_stream_connection(mock_connection, make_earthquakes(3))
+
+    response = client.get("/earthquakes?stream=true&fields=earthquake_id")
+
+    assert response.json == [{"earthquake_id": "nc0000"}, {"earthquake_id": "nc0001"},
+                             {"earthquake_id": "nc0002"}]
+
+
+def test_endpoint_get_earthquakes_invalid_fields(client):
+    response = client.get("/earthquakes?fields=lat,secret")
+
+    assert response.status_code == 400
+    assert response.json["error"].startswith("fields must be a comma separated list of")
+
+
+def test_endpoint_get_stats_invalid(client):
+    response = client.get("/stats/counts?interval=minute")
+
+    assert response.status_code == 400
+    assert response.json == {"error": "interval must be one of hour, day, week, month, year"}
+
+
+def get_plan_nodes(plan: dict) -> list[dict]:
+    nodes = [plan]
+    for child in plan.get("Plans", []):
+        nodes.extend(get_plan_nodes(child))
+    return nodes
+
+
+def explain_on_scratch_schema(get_query) -> list[dict]:
+    """Loads the schema and 200,000 earthquakes into a scratch schema and returns
+    the plan nodes of the query. Everything happens in one transaction, which is
+    rolled back."""
+    conn = psycopg2.connect(os.environ["TEST_DATABASE_URL"])
+    try:
+        with conn.cursor() as cur:
+            cur.execute("CREATE SCHEMA explain_test; SET LOCAL search_path TO explain_test, public;")
+            with open(os.path.join(os.path.dirname(__file__), "..", "database", "schema.sql"),
+                      encoding="utf-8") as schema:
+                # Without the DROPs, so nothing outside the scratch schema is touched
+                cur.execute("".join(line for line in schema if not line.startswith("DROP ")))
+            cur.execute("""INSERT INTO earthquakes (earthquake_id, magnitude, lon, lat, time, status_id,
+                               significance, network_id, magtype_id, type_id, title, depth)
+                           SELECT 'eq' || i, (i % 70) / 10.0, (i * 7919 % 360000) / 1000.0 - 180,
+                                  (i * 104729 % 180000) / 1000.0 - 90,
+                                  LOCALTIMESTAMP - make_interval(secs => i * 30),
+                                  1, 100, 1, 1, 1, 'M test', 10
+                           FROM generate_series(1, 200000) AS i;
+                           ANALYZE earthquakes;""")
+            query, params = get_query()
+            cur.execute("EXPLAIN (FORMAT JSON) " + query.rstrip(";"), params)
+            return get_plan_nodes(cur.fetchone()[0][0]["Plan"])
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+requires_database = pytest.mark.skipif(
+    "TEST_DATABASE_URL" not in os.environ,
+    reason="set TEST_DATABASE_URL to a scratch Postgres database to run EXPLAIN tests")
+
+
+@requires_database
+@pytest.mark.parametrize("min_lon, max_lon", [("-125", "-110"), ("170", "-170")])
+def test_time_and_box_query_uses_indexes(min_lon, max_lon):
+    start = (datetime.now(timezone.utc) - timedelta(hours=24)).isoformat()
+    conditions, params = get_filter_queries(get_filters(**{
+        START_FILTER_KEY: start, MIN_LAT_FILTER_KEY: "30", MAX_LAT_FILTER_KEY: "45",
+        MIN_LON_FILTER_KEY: min_lon, MAX_LON_FILTER_KEY: max_lon}))
+
+    nodes = explain_on_scratch_schema(lambda: get_page_query(conditions, params, None, 101))
+
+    assert not any(node["Node Type"] == "Seq Scan" and node.get("Relation Name") == "earthquakes"
+                   for node in nodes)
+    assert {node.get("Index Name") for node in nodes} & {"earthquakes_time_id_idx",
+                                                         "earthquakes_lat_lon_idx"}
+
+
+@requires_database
+@pytest.mark.parametrize("radius_km", [None, 100])
+def test_near_query_uses_earth_index(radius_km):
+    conditions, params = get_filter_queries(get_filters(**{MIN_MAGNITUDE_FILTER_KEY: "2"}))
+
+    nodes = explain_on_scratch_schema(
+        lambda: get_near_query(conditions, params, (35.6, 139.7, radius_km, 20)))
+
+    assert not any(node["Node Type"] == "Seq Scan" and node.get("Relation Name") == "earthquakes"
+                   for node in nodes)
+    assert "earthquakes_earth_idx" in {node.get("Index Name") for node in nodes}
+
+
+@requires_database
+@pytest.mark.parametrize("summary, filters, index_name", [
+    ("counts", {START_FILTER_KEY: (datetime.now(timezone.utc) - timedelta(hours=24)).isoformat()},
+     "earthquakes_time_id_idx"),
+    ("magnitudes", {COUNTRY_FILTER_KEY: "JP"}, "earthquakes_country_time_idx")])
+def test_stats_query_uses_indexes(summary, filters, index_name):
+    conditions, params = get_filter_queries(get_filters(**filters))
+
+    nodes = explain_on_scratch_schema(lambda: get_stats_query(
+        summary, conditions, params, get_stats_options(summary, {})))
+
+    assert index_name in {node.get("Index Name") for node in nodes}
@@ -0,0 +1,130 @@
+import threading
+from unittest.mock import MagicMock, patch
+import pytest
+from cache import ResultCache, listen_for_loads, wait_for_notifications
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def test_cache_hit_and_miss(clock):
+    cache = ResultCache(1000, 60, clock)
+
+    assert cache.get("a") is None
+    cache.set("a", b"[1]", "next")
+
+    assert cache.get("a") == (b"[1]", "next")
+    metrics = cache.get_metrics()
+    assert (metrics["hits"], metrics["misses"]) == (1, 1)
+    assert metrics["hit_ratio"] == metrics["miss_ratio"] == 0.5
+    assert metrics["bytes"] == len("a") + len(b"[1]") + len("next")
+
+
+def test_cache_evicts_least_recently_used(clock):
+    cache = ResultCache(25, 60, clock)
+    cache.set("a", b"x" * 9, None)
+    cache.set("b", b"x" * 9, None)
+    cache.get("a")
+
+    cache.set("c", b"x" * 9, None)
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.get_metrics()["evictions"] == 1
+    assert cache.get_metrics()["bytes"] == 20
+
+
+def test_cache_skips_entries_larger_than_budget(clock):
+    cache = ResultCache(10, 60, clock)
+
+    cache.set("a", b"x" * 20, None)
+
+    assert cache.get_metrics()["entries"] == 0
+
+
+def test_cache_replaces_entries(clock):
+    cache = ResultCache(100, 60, clock)
+    cache.set("a", b"old", None)
+
+    cache.set("a", b"newer", None)
+
+    assert cache.get("a") == (b"newer", None)
+    assert cache.get_metrics()["bytes"] == 6
+
+
+def test_cache_expires_entries(clock):
+    cache = ResultCache(100, 60, clock)
+    cache.set("a", b"[]", None)
+
+    clock.now = 59.9
+    assert cache.get("a") is not None
+    clock.now = 60
+    assert cache.get("a") is None
+    assert cache.get_metrics()["expirations"] == 1
+    assert cache.get_metrics()["bytes"] == 0
+
+
+def test_cache_clear(clock):
+    cache = ResultCache(100, 60, clock)
+    cache.set("a", b"[]", None)
+
+    cache.clear()
+
+    assert cache.get("a") is None
+    assert cache.get_metrics()["invalidations"] == 1
+
+
+def make_notify(payload):
+    notify = MagicMock()
+    notify.payload = payload
+    return notify
+
+
+def test_wait_for_notifications_clears_cache(clock):
+    cache = ResultCache(100, 60, clock)
+    cache.set("a", b"[]", None)
+    conn = MagicMock()
+    conn.notifies = []
+    stop = threading.Event()
+
+    def poll():
+        conn.notifies.append(make_notify("7"))
+        stop.set()
+    conn.poll.side_effect = poll
+
+    with patch("cache.select.select", return_value=([conn], [], [])):
+        wait_for_notifications(conn, cache, stop)
+
+    assert cache.get("a") is None
+    assert conn.notifies == []
+
+
+def test_listen_for_loads_reconnects(clock):
+    cache = ResultCache(100, 60, clock)
+    conn = MagicMock()
+    stop = threading.Event()
+    connect = MagicMock(side_effect=[Exception("could not connect"), conn])
+
+    def wait(conn, cache, stop):
+        stop.set()
+
+    with patch("cache.wait_for_notifications", side_effect=wait), \
+            patch("cache.LISTEN_RETRY_SECONDS", 0):
+        listen_for_loads(connect, cache, stop)
+
+    assert connect.call_count == 2
+    conn.cursor.return_value.__enter__.return_value.execute.assert_called_once_with(
+        "LISTEN data_loads;")
+    assert conn.autocommit is True
+    conn.close.assert_called_once()
+    assert cache.get_metrics()["invalidations"] == 1
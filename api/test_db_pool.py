@@ -0,0 +1,140 @@
+import threading
+from unittest.mock import MagicMock, patch
+import psycopg2
+import pytest
+from db_pool import ConnectionPool, PoolExhaustedError, is_healthy
+
+
+def make_connection():
+    conn = MagicMock()
+    conn.closed = 0
+    conn.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    return conn
+
+
+@pytest.fixture
+def mock_connect():
+    with patch("psycopg2.connect", side_effect=lambda *args, **kwargs: make_connection()) as mock:
+        yield mock
+
+
+def test_pool_opens_min_connections(mock_connect):
+    ConnectionPool(2, 4, 1, host="db")
+
+    assert mock_connect.call_count == 2
+    assert mock_connect.call_args[1] == {"host": "db"}
+
+
+@pytest.mark.parametrize("sizes", [(3, 2), (0, 0), (-1, 2)])
+def test_pool_invalid_sizes(sizes, mock_connect):
+    with pytest.raises(ValueError):
+        ConnectionPool(*sizes, 1)
+
+
+def test_pool_reuses_connections(mock_connect):
+    pool = ConnectionPool(1, 2, 1)
+
+    with pool.checkout() as first:
+        pass
+    with pool.checkout() as second:
+        pass
+
+    assert first is second
+    assert mock_connect.call_count == 1
+    assert pool.get_metrics()["checkouts"] == 2
+
+
+def test_pool_times_out_when_exhausted(mock_connect):
+    pool = ConnectionPool(0, 1, 0.05)
+    conn = pool.getconn()
+
+    with pytest.raises(PoolExhaustedError):
+        pool.getconn()
+
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+    assert pool.get_metrics()["timeouts"] == 1
+
+
+def test_pool_waits_for_a_free_connection(mock_connect):
+    pool = ConnectionPool(0, 1, 2)
+    conn = pool.getconn()
+    threading.Timer(0.05, pool.putconn, args=(conn,)).start()
+
+    assert pool.getconn() is conn
+    assert pool.get_metrics()["wait_seconds_max"] >= 0.05
+
+
+def test_pool_replaces_unhealthy_connections(mock_connect):
+    pool = ConnectionPool(1, 2, 1)
+    broken = pool.getconn()
+    broken.cursor.return_value.__enter__.return_value.execute.side_effect = \
+        psycopg2.OperationalError("server closed the connection")
+    pool.putconn(broken)
+
+    conn = pool.getconn()
+
+    assert conn is not broken
+    broken.close.assert_called_once()
+    assert pool.get_metrics()["health_check_failures"] == 1
+
+
+def test_pool_discards_closed_connections(mock_connect):
+    pool = ConnectionPool(0, 1, 1)
+    conn = pool.getconn()
+    conn.closed = 1
+
+    pool.putconn(conn)
+
+    assert pool.getconn() is not conn
+
+
+def test_pool_releases_slot_when_connecting_fails(mock_connect):
+    pool = ConnectionPool(0, 1, 0.05)
+    mock_connect.side_effect = psycopg2.OperationalError("could not connect")
+
+    for _ in range(2):
+        with pytest.raises(psycopg2.OperationalError):
+            pool.getconn()
+
+    assert pool.get_metrics()["timeouts"] == 0
+
+
+def test_pool_metrics(mock_connect):
+    pool = ConnectionPool(0, 4, 1)
+    pool.getconn()
+
+    metrics = pool.get_metrics()
+
+    assert metrics["in_use"] == 1
+    assert metrics["max_size"] == 4
+    assert metrics["utilisation"] == 0.25
+    assert metrics["wait_seconds_average"] == metrics["wait_seconds_total"]
+
+
+def test_is_healthy():
+    conn = make_connection()
+    assert is_healthy(conn)
+    conn.closed = 1
+    assert not is_healthy(conn)
+
+
+def test_pool_rolls_back_open_transactions(mock_connect):
+    pool = ConnectionPool(0, 1, 1)
+    conn = pool.getconn()
+    conn.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+    pool.putconn(conn)
+
+    conn.rollback.assert_called_once()
+    assert pool.getconn() is conn
+
+
+def test_pool_close(mock_connect):
+    pool = ConnectionPool(2, 2, 1)
+    idle = list(pool.idle)
+
+    pool.close()
+
+    for conn in idle:
+        conn.close.assert_called_once()
@@ -0,0 +1,364 @@
+"""bulk imports subscriptions for a partner organisation from a CSV or JSON
+file with email, phone_number, lat, lon and magnitude columns, e.g.
+python3 bulk_import.py partners.csv --report outcomes.csv"""
+import argparse
+import csv
+import json
+import logging
+from os import environ
+from dotenv import load_dotenv
+import psycopg2.extras
+from pages.notifications import (get_connection, get_sns_client, get_topic_location,
+                                 get_topic_name, get_topic_grid_km, get_magnitude_tier)
+from publisher import (TokenBucket, call_with_retry, get_error_code, map_concurrently,
+                       DEFAULT_BASE_DELAY)
+
+DEFAULT_MAX_WORKERS = 10
+DEFAULT_SNS_RATE = 20.0
+DEFAULT_MAX_RETRIES = 5
+PENDING_CONFIRMATION = 'pending confirmation'
+REPORT_FIELDS = ['row', 'email', 'phone_number', 'status', 'topic_arn', 'error']
+
+
+def read_rows(path: str) -> list[dict]:
+    """reads the rows to import from a CSV file or a JSON list of objects"""
+    with open(path, encoding='utf-8', newline='') as file:
+        if path.lower().endswith('.json'):
+            return json.load(file)
+        return list(csv.DictReader(file))
+
+
+def parse_row(row: dict) -> dict:
+    """validates and normalises an imported row, raising ValueError if it is invalid"""
+    email = str(row.get('email') or '').strip().lower()
+    phone_number = str(row.get('phone_number') or '').strip().replace(' ', '')
+    if '@' not in email:
+        raise ValueError('missing or invalid email')
+    if not phone_number.lstrip('+').isdigit():
+        raise ValueError('missing or invalid phone number')
+    try:
+        lat, lon, magnitude = float(row['lat']), float(row['lon']), float(row['magnitude'])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError('missing or invalid lat, lon or magnitude') from e
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180 and 0 <= magnitude <= 10):
+        raise ValueError('lat, lon or magnitude out of range')
+    return {'email': email, 'phone_number': phone_number,
+            'selected_lat': lat, 'selected_lon': lon, 'magnitude': magnitude}
+
+
+def check_partner_identity(user_info: dict, identities: dict) -> None:
+    """raises ValueError if the row's email or phone number was already used
+        with a different partner earlier in the file"""
+    email, phone_number = user_info['email'], user_info['phone_number']
+    if identities.setdefault(('email', email), phone_number) != phone_number or \
+            identities.setdefault(('phone_number', phone_number), email) != email:
+        raise ValueError('email or phone number is used with a different partner')
+
+
+def get_topic_key(topic_location: dict) -> tuple:
+    """returns the key a snapped topic location is deduplicated on, rounded so
+        a real min_magnitude read back from the database matches its snapped value"""
+    return (round(float(topic_location['magnitude']), 6), round(float(topic_location['lat']), 6),
+            round(float(topic_location['lon']), 6))
+
+
+def plan_import(rows: list[dict], grid_km: float, tier: float) -> tuple[list[dict], list[dict]]:
+    """returns an outcome for every row and the unique subscriptions to make.
+        rows repeating an earlier subscription, or reusing an email or phone
+        number with a different partner, are resolved here without any calls"""
+    outcomes, subscriptions, seen, identities = [], [], {}, {}
+    for number, row in enumerate(rows, start=1):
+        outcome = {'row': number, 'email': row.get('email'),
+                   'phone_number': row.get('phone_number'),
+                   'status': None, 'topic_arn': None, 'error': None}
+        outcomes.append(outcome)
+        try:
+            user_info = parse_row(row)
+            check_partner_identity(user_info, identities)
+        except ValueError as e:
+            outcome.update(status='invalid', error=str(e))
+            continue
+        topic_location = get_topic_location(user_info, grid_km, tier)
+        key = (user_info['email'], user_info['phone_number'], get_topic_key(topic_location))
+        if key in seen:
+            outcome.update(status='duplicate', error=f'duplicate of row {seen[key]}')
+            continue
+        seen[key] = number
+        subscriptions.append({'email': user_info['email'],
+                              'phone_number': user_info['phone_number'],
+                              'topic_location': topic_location, 'outcome': outcome})
+    return outcomes, subscriptions
+
+
+def plan_dry_run(rows: list[dict], grid_km: float, tier: float) -> list[dict]:
+    """validates and deduplicates the rows without any calls, marking the
+        subscriptions which would be made as planned"""
+    outcomes, subscriptions = plan_import(rows, grid_km, tier)
+    for subscription in subscriptions:
+        subscription['outcome']['status'] = 'planned'
+    return outcomes
+
+
+def format_error(error: Exception) -> str:
+    """returns an SNS error's code and message, or the error itself if it
+        did not come from SNS"""
+    code = get_error_code(error)
+    if code is None:
+        return str(error)
+    return f"{code}: {error.response['Error'].get('Message')}"
+
+
+def run_sns_calls(function, requests: list[dict], max_workers: int = None,
+                  rate: float = None, max_retries: int = None) -> list[tuple]:
+    """makes SNS calls through the pipeline publisher's bounded thread pool,
+        rate limiter and retries, returning a (response, error) pair for each
+        request in order"""
+    if not requests:
+        return []
+    max_workers = max_workers or int(environ.get('SNS_MAX_WORKERS', DEFAULT_MAX_WORKERS))
+    rate_limiter = TokenBucket(rate or float(environ.get('SNS_RATE', DEFAULT_SNS_RATE)))
+    max_retries = max_retries if max_retries is not None else int(
+        environ.get('SNS_MAX_RETRIES', DEFAULT_MAX_RETRIES))
+    outcomes = map_concurrently(
+        lambda request: call_with_retry(function, request, rate_limiter,
+                                        max_retries, DEFAULT_BASE_DELAY),
+        requests, max_workers)
+    return [(outcome['response'], None) if outcome['error'] is None
+            else (None, format_error(outcome['error'])) for outcome in outcomes]
+
+
+def get_existing_users(conn, emails: list[str], phone_numbers: list[str]) -> list[dict]:
+    """returns the users already registered with any of the emails or phone numbers"""
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as curr:
+        curr.execute("""select user_id, email_address, phone_number from users
+                        where email_address = any(%s) or phone_number = any(%s);""",
+                     (emails, phone_numbers))
+        return curr.fetchall()
+
+
+def insert_users(conn, users: list[tuple]) -> list[dict]:
+    """inserts new (email, phone_number) users in one statement"""
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as curr:
+        return psycopg2.extras.execute_values(
+            curr, """insert into users (email_address, phone_number) values %s
+                     on conflict do nothing
+                     returning user_id, email_address, phone_number;""", users, fetch=True)
+
+
+def get_existing_topics(conn, topic_keys: list[tuple]) -> list[dict]:
+    """returns the grid topics already created for any of the (magnitude, lat, lon)
+        keys, leaving out region, intensity and rule topics at the same point"""
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as curr:
+        return psycopg2.extras.execute_values(
+            curr, """select t.topic_id, t.topic_arn, t.min_magnitude, t.lat, t.lon
+                     from topics as t
+                     join (values %s) as k (min_magnitude, lat, lon)
+                     on t.min_magnitude = k.min_magnitude::real
+                     and t.lat = k.lat::decimal and t.lon = k.lon::decimal
+                     where t.region is null and t.min_intensity is null
+                     and t.rules = '{}';""",
+            topic_keys, fetch=True)
+
+
+def insert_topics(conn, topics: list[tuple]) -> list[dict]:
+    """inserts new (topic_arn, magnitude, lat, lon) topics in one statement"""
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as curr:
+        return psycopg2.extras.execute_values(
+            curr, """insert into topics (topic_arn, min_magnitude, lat, lon) values %s
+                     on conflict (topic_arn) do update set topic_arn = excluded.topic_arn
+                     returning topic_id, topic_arn, min_magnitude, lat, lon;""",
+            topics, fetch=True)
+
+
+def get_existing_assignments(conn, user_ids: list[int]) -> set[tuple]:
+    """returns the (user_id, topic_id) subscriptions the users already have"""
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as curr:
+        curr.execute("""select user_id, topic_id from user_topic_assignments
+                        where user_id = any(%s);""", (user_ids,))
+        return {(row['user_id'], row['topic_id']) for row in curr.fetchall()}
+
+
+def insert_assignments(conn, assignments: list[tuple]) -> None:
+    """inserts (user_id, topic_id, email_arn, sms_arn) subscriptions in one statement"""
+    with conn.cursor() as curr:
+        psycopg2.extras.execute_values(
+            curr, """insert into user_topic_assignments
+                     (user_id, topic_id, email_subscription_arn, sms_subscription_arn)
+                     values %s;""", assignments)
+
+
+def resolve_users(conn, subscriptions: list[dict]) -> dict[str, int]:
+    """returns the user_id of every importable email, creating new users and
+        failing subscriptions which clash with an existing user"""
+    wanted = {subscription['email']: subscription['phone_number'] for subscription in subscriptions}
+    user_ids, taken_phones = {}, {}
+    for user in get_existing_users(conn, list(wanted), list(wanted.values())):
+        taken_phones[user['phone_number']] = user['email_address']
+        if wanted.get(user['email_address']) == user['phone_number']:
+            user_ids[user['email_address']] = user['user_id']
+    new_users = [(email, phone_number) for email, phone_number in wanted.items()
+                 if email not in user_ids and phone_number not in taken_phones]
+    if new_users:
+        user_ids.update((user['email_address'], user['user_id'])
+                        for user in insert_users(conn, new_users))
+    for subscription in subscriptions:
+        if subscription['email'] not in user_ids:
+            subscription['outcome'].update(
+                status='failed', error='email or phone number belongs to another user')
+    return user_ids
+
+
+def resolve_topics(conn, client, subscriptions: list[dict], **pool_options) -> dict[tuple, dict]:
+    """returns the topic for every snapped location, creating missing SNS
+        topics through the worker pool and inserting them in one statement"""
+    locations = {get_topic_key(subscription['topic_location']): subscription['topic_location']
+                 for subscription in subscriptions}
+    topics = {get_topic_key({'magnitude': topic['min_magnitude'], 'lat': topic['lat'],
+                             'lon': topic['lon']}): topic
+              for topic in get_existing_topics(conn, list(locations))}
+    missing = [key for key in locations if key not in topics]
+    responses = run_sns_calls(client.create_topic,
+                              [{'Name': get_topic_name(locations[key])} for key in missing],
+                              **pool_options)
+    created = {response['TopicArn']: key for key, (response, _) in zip(missing, responses)
+               if response is not None}
+    if created:
+        for topic in insert_topics(conn, [(arn, key[0], key[1], key[2])
+                                          for arn, key in created.items()]):
+            topics[created[topic['topic_arn']]] = topic
+    for key, (response, error) in zip(missing, responses):
+        if response is None:
+            for subscription in subscriptions:
+                if get_topic_key(subscription['topic_location']) == key:
+                    subscription['outcome'].update(status='failed',
+                                                   error=f'could not create topic: {error}')
+    return topics
+
+
+def unsubscribe_all(client, subscription_arns: list[str], **pool_options) -> None:
+    """unsubscribes through the worker pool, logging any which fail"""
+    requests = [{'SubscriptionArn': arn} for arn in subscription_arns]
+    for request, (_, error) in zip(requests, run_sns_calls(client.unsubscribe, requests,
+                                                           **pool_options)):
+        if error is not None:
+            logging.error("Error unsubscribing %s: %s", request['SubscriptionArn'], error)
+
+
+def subscribe_all(client, pending: list[dict], **pool_options) -> list[tuple]:
+    """subscribes each pending user's email and phone number to their topic,
+        returning the assignments for the subscriptions which fully succeeded.
+        the half made subscriptions of any which failed are unsubscribed"""
+    requests = []
+    for subscription in pending:
+        requests.append({'TopicArn': subscription['topic']['topic_arn'],
+                         'Protocol': 'email', 'Endpoint': subscription['email']})
+        requests.append({'TopicArn': subscription['topic']['topic_arn'],
+                         'Protocol': 'sms', 'Endpoint': subscription['phone_number']})
+    responses = run_sns_calls(client.subscribe, requests, **pool_options)
+
+    assignments, half_made = [], []
+    for index, subscription in enumerate(pending):
+        (email_response, email_error), (sms_response, sms_error) = \
+            responses[2 * index:2 * index + 2]
+        if email_response is None or sms_response is None:
+            half_made.extend(response['SubscriptionArn'] for response in (email_response,
+                                                                          sms_response)
+                             if response and response['SubscriptionArn'] != PENDING_CONFIRMATION)
+            subscription['outcome'].update(status='failed', error=email_error or sms_error)
+            continue
+        assignments.append((subscription['user_id'], subscription['topic']['topic_id'],
+                            email_response['SubscriptionArn'], sms_response['SubscriptionArn']))
+        subscription['outcome'].update(status='subscribed')
+    unsubscribe_all(client, half_made, **pool_options)
+    return assignments
+
+
+def get_pending_subscriptions(subscriptions: list[dict], user_ids: dict[str, int],
+                              topics: dict[tuple, dict], existing: set[tuple]) -> list[dict]:
+    """fills in the user and topic of every subscription still to be made,
+        returning those the user does not already have"""
+    pending = []
+    for subscription in subscriptions:
+        if subscription['outcome']['status'] is not None:
+            continue
+        subscription['user_id'] = user_ids[subscription['email']]
+        subscription['topic'] = topics[get_topic_key(subscription['topic_location'])]
+        subscription['outcome']['topic_arn'] = subscription['topic']['topic_arn']
+        if (subscription['user_id'], subscription['topic']['topic_id']) in existing:
+            subscription['outcome']['status'] = 'already subscribed'
+        else:
+            pending.append(subscription)
+    return pending
+
+
+def write_subscriptions(conn, client, subscriptions: list[dict], **pool_options) -> None:
+    """creates the users, topics and SNS subscriptions for the planned
+        subscriptions, leaving the transaction for the caller to commit"""
+    user_ids = resolve_users(conn, subscriptions)
+    subscriptions = [subscription for subscription in subscriptions
+                     if subscription['outcome']['status'] is None]
+    topics = resolve_topics(conn, client, subscriptions, **pool_options)
+    existing = get_existing_assignments(conn, list(set(user_ids.values())))
+    assignments = subscribe_all(
+        client, get_pending_subscriptions(subscriptions, user_ids, topics, existing),
+        **pool_options)
+    if assignments:
+        insert_assignments(conn, assignments)
+
+
+def import_subscriptions(conn, client, rows: list[dict], grid_km: float, tier: float,
+                         **pool_options) -> list[dict]:
+    """imports every row, deduplicating users and topics in memory, making SNS
+        calls through a rate limited worker pool and writing users, topics and
+        subscriptions with set-based inserts in one transaction. returns the
+        outcome of each row"""
+    outcomes, subscriptions = plan_import(rows, grid_km, tier)
+    if not subscriptions:
+        return outcomes
+    try:
+        write_subscriptions(conn, client, subscriptions, **pool_options)
+        conn.commit()
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logging.error("Error importing subscriptions: %s", e)
+        conn.rollback()
+        for outcome in outcomes:
+            if outcome['status'] in (None, 'subscribed'):
+                outcome.update(status='failed', error=str(e))
+    return outcomes
+
+
+def summarise_outcomes(outcomes: list[dict]) -> dict[str, int]:
+    """counts the row outcomes by status"""
+    summary = {}
+    for outcome in outcomes:
+        summary[outcome['status']] = summary.get(outcome['status'], 0) + 1
+    return summary
+
+
+def write_report(path: str, outcomes: list[dict]) -> None:
+    """writes the outcome of every row to a CSV file"""
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(outcomes)
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path", help="CSV or JSON file of subscriptions")
+    parser.add_argument("--report", help="CSV file to write each row's outcome to")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only validate and deduplicate the rows")
+    args = parser.parse_args()
+    if args.dry_run:
+        import_outcomes = plan_dry_run(read_rows(args.path), get_topic_grid_km(),
+                                       get_magnitude_tier())
+    else:
+        import_outcomes = import_subscriptions(get_connection(), get_sns_client(),
+                                               read_rows(args.path), get_topic_grid_km(),
+                                               get_magnitude_tier())
+    if args.report:
+        write_report(args.report, import_outcomes)
+    logging.info("Import summary: %s", summarise_outcomes(import_outcomes))
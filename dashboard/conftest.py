@@ -0,0 +1,10 @@
+# pylint: skip-file
+
+import sys
+from os import path
+
+# bulk_import uses the pipeline's publisher, which the dashboard image copies in
+# next to it, and the tests share the pipeline's stub SNS server
+sys.path.append(path.join(path.dirname(__file__), '..', 'pipeline'))
+
+from stub_sns import stub_sns, stub_sns_client
@@ -0,0 +1,183 @@
+"""batch job which snaps existing topics onto the subscription grid, merging
+topics which fall in the same grid cell and magnitude tier into one"""
+import argparse
+import logging
+from dotenv import load_dotenv
+import psycopg2.extras
+from pages.notifications import (get_connection, get_sns_client, get_topic_location,
+                                 get_topic_grid_km, get_magnitude_tier,
+                                 subscribe_to_topic, unsubscribe_user_from_topic)
+
+PENDING_CONFIRMATION = 'pending confirmation'
+
+
+def get_all_topics(conn) -> list[dict]:
+    """returns every grid topic in the database, leaving out region, intensity
+        and rule topics which only share their lat and lon with the grid"""
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as curr:
+        curr.execute("""select topic_id, topic_arn, min_magnitude, lon, lat
+                        from topics
+                        where region is null and min_intensity is null and rules = '{}'
+                        order by topic_id;""")
+        return curr.fetchall()
+
+
+def is_grid_topic(topic: dict) -> bool:
+    """checks a topic is a plain grid topic with no region, intensity or rules"""
+    return (topic.get('region') is None and topic.get('min_intensity') is None
+            and not topic.get('rules'))
+
+
+def group_topics_by_cell(topics: list[dict], grid_km: float, tier: float) -> dict[tuple, list]:
+    """groups grid topics by the grid cell and magnitude tier they snap to"""
+    groups = {}
+    for topic in filter(is_grid_topic, topics):
+        location = get_topic_location({'selected_lat': topic['lat'],
+                                       'selected_lon': topic['lon'],
+                                       'magnitude': topic['min_magnitude']}, grid_km, tier)
+        key = (location['magnitude'], location['lat'], location['lon'])
+        groups.setdefault(key, []).append(topic)
+    return groups
+
+
+def get_topic_assignments(conn, topic_id: int) -> list[dict]:
+    """returns the users subscribed to a topic along with their subscription arns"""
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as curr:
+        curr.execute("""select uta.assignment_id, uta.user_id, uta.sms_subscription_arn,
+                            uta.email_subscription_arn, u.email_address, u.phone_number
+                        from user_topic_assignments as uta
+                        join users as u on u.user_id = uta.user_id
+                        where uta.topic_id = %s;""", (topic_id,))
+        return curr.fetchall()
+
+
+def unsubscribe_assignment(client, assignment) -> None:
+    """unsubscribes an assignment's email and sms subscriptions, skipping
+        emails which were never confirmed and so have no subscription arn"""
+    if assignment['email_subscription_arn'] == PENDING_CONFIRMATION:
+        client.unsubscribe(SubscriptionArn=assignment['sms_subscription_arn'])
+    else:
+        unsubscribe_user_from_topic(client, assignment['email_subscription_arn'],
+                                    assignment['sms_subscription_arn'])
+
+
+def move_assignments(conn, client, canonical_topic, merged_topic,
+                     new_assignments: list[dict]) -> list[dict]:
+    """points every assignment on a merged topic at the canonical topic,
+        subscribing the user to it first, and returns the merged topic's old
+        assignments to unsubscribe once the move is committed. users already
+        subscribed to the canonical topic just lose their merged assignment.
+        new subscriptions are added to new_assignments so they can be undone
+        if the move fails. moved email subscriptions have to be confirmed
+        again by the user"""
+    canonical_users = {assignment['user_id']
+                       for assignment in get_topic_assignments(conn, canonical_topic['topic_id'])}
+    old_assignments = get_topic_assignments(conn, merged_topic['topic_id'])
+    for assignment in old_assignments:
+        with conn.cursor() as curr:
+            if assignment['user_id'] in canonical_users:
+                curr.execute("""delete from user_topic_assignments
+                                where assignment_id = %s;""", (assignment['assignment_id'],))
+                continue
+            email_subscription, sms_subscription = subscribe_to_topic(
+                client, canonical_topic['topic_arn'],
+                {'email': assignment['email_address'], 'phone_number': assignment['phone_number']})
+            new_assignments.append({'email_subscription_arn': email_subscription['SubscriptionArn'],
+                                    'sms_subscription_arn': sms_subscription['SubscriptionArn']})
+            curr.execute("""update user_topic_assignments
+                            set topic_id = %s, email_subscription_arn = %s,
+                                sms_subscription_arn = %s
+                            where assignment_id = %s;""",
+                         (canonical_topic['topic_id'], email_subscription['SubscriptionArn'],
+                          sms_subscription['SubscriptionArn'], assignment['assignment_id']))
+        canonical_users.add(assignment['user_id'])
+    return old_assignments
+
+
+def delete_topic(conn, topic) -> None:
+    """removes a merged topic from the database, along with its alert history"""
+    with conn.cursor() as curr:
+        curr.execute("delete from alert_deliveries where topic_id = %s;", (topic['topic_id'],))
+        curr.execute("delete from alert_digests where topic_id = %s;", (topic['topic_id'],))
+        curr.execute("delete from topics where topic_id = %s;", (topic['topic_id'],))
+
+
+def undo_subscriptions(client, assignments: list[dict]) -> None:
+    """unsubscribes assignments made by a move which was not committed, carrying
+        on past failures so that as many as possible are undone"""
+    for assignment in assignments:
+        try:
+            unsubscribe_assignment(client, assignment)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.error("Error undoing subscription %s: %s",
+                          assignment['sms_subscription_arn'], e)
+
+
+def remove_merged_topic(client, topic, old_assignments: list[dict]) -> None:
+    """unsubscribes a merged topic's old assignments and deletes it from sns.
+        the database no longer refers to it, so a failure is only logged for
+        the topic to be removed by hand"""
+    try:
+        for assignment in old_assignments:
+            unsubscribe_assignment(client, assignment)
+        client.delete_topic(TopicArn=topic['topic_arn'])
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        logging.error("Error removing merged topic %s from sns: %s", topic['topic_arn'], e)
+
+
+def migrate_topic_group(conn, client, key: tuple, topics: list[dict]) -> int:
+    """snaps the oldest topic in a group onto its grid cell and merges the rest
+        into it, returning how many users were moved. new subscriptions are
+        undone if the database changes fail, and the merged topics are only
+        removed from sns once the changes are committed"""
+    canonical_topic, *merged_topics = topics
+    magnitude, lat, lon = key
+    new_assignments, old_assignments = [], {}
+    try:
+        with conn.cursor() as curr:
+            curr.execute("""update topics set min_magnitude = %s, lat = %s, lon = %s
+                            where topic_id = %s;""",
+                         (magnitude, lat, lon, canonical_topic['topic_id']))
+        for merged_topic in merged_topics:
+            old_assignments[merged_topic['topic_id']] = move_assignments(
+                conn, client, canonical_topic, merged_topic, new_assignments)
+            delete_topic(conn, merged_topic)
+        conn.commit()
+    except Exception:
+        undo_subscriptions(client, new_assignments)
+        raise
+    for merged_topic in merged_topics:
+        remove_merged_topic(client, merged_topic, old_assignments[merged_topic['topic_id']])
+    return len(new_assignments)
+
+
+def migrate_topics(conn, client, grid_km: float, tier: float, dry_run: bool = False) -> dict:
+    """snaps every topic onto the grid, one committed group at a time. a group
+        which fails is rolled back with its new subscriptions undone, so the
+        job can be re-run for it; merged topics which could not be removed
+        from sns after their group was committed are logged"""
+    topics = get_all_topics(conn)
+    groups = group_topics_by_cell(topics, grid_km, tier)
+    summary = {'topics': len(topics), 'cells': len(groups),
+               'merged_topics': len(topics) - len(groups), 'moved_users': 0}
+    if not dry_run:
+        for key, group in groups.items():
+            try:
+                summary['moved_users'] += migrate_topic_group(conn, client, key, group)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logging.error("Error migrating topics %s: %s",
+                              [topic['topic_id'] for topic in group], e)
+                conn.rollback()
+    logging.info("Topic migration summary: %s", summary)
+    return summary
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only report how many topics would be merged")
+    args = parser.parse_args()
+    migrate_topics(get_connection(), get_sns_client(),
+                   get_topic_grid_km(), get_magnitude_tier(), args.dry_run)
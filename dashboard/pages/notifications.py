@@ -1,5 +1,7 @@
 """create the notification subscription page for the dashboard"""
 from os import environ
+from decimal import Decimal, ROUND_FLOOR
+import math
 import streamlit as st
 from streamlit_folium import st_folium
 import folium
@@ -10,6 +12,11 @@ import psycopg2.extras
 
 DEFAULT_LAT = 51.5072
 DEFAULT_LON = 0.1276
+DEFAULT_TOPIC_GRID_KM = 1.0
+DEFAULT_MAGNITUDE_TIER = 1.0
+KM_PER_DEGREE_LAT = 111.19
+MAGNITUDE_TOLERANCE = 0.001
+TOPIC_NAME_PREFIX = "c11-poseidon"
 
 
 def get_connection():
@@ -31,10 +38,59 @@ def get_sns_client():
         region_name='eu-west-2')
 
 
-def create_topic(client):
+def get_topic_grid_km() -> float:
+    """returns the size of the grid cells subscriptions are snapped to"""
+    return float(environ.get('TOPIC_GRID_KM', DEFAULT_TOPIC_GRID_KM))
+
+
+def get_magnitude_tier() -> float:
+    """returns the size of the magnitude tiers subscriptions are snapped to"""
+    return float(environ.get('TOPIC_MAGNITUDE_TIER', DEFAULT_MAGNITUDE_TIER))
+
+
+def snap_to_grid(lat: float, lon: float, grid_km: float) -> tuple[float, float]:
+    """snaps a location to the centre of its grid cell, so nearby
+        subscriptions share a topic. cells are roughly grid_km wide"""
+    lat_step = grid_km / KM_PER_DEGREE_LAT
+    snapped_lat = max(-90.0, min(90.0, round(float(lat) / lat_step) * lat_step))
+    lon_step = min(lat_step / max(math.cos(math.radians(snapped_lat)), 1e-6), 360.0)
+    snapped_lon = round(float(lon) / lon_step) * lon_step
+    snapped_lon = (snapped_lon + 180.0) % 360.0 - 180.0
+    return round(snapped_lat, 6), round(snapped_lon, 6)
+
+
+def snap_magnitude(magnitude: float, tier: float) -> float:
+    """snaps a minimum magnitude down to the start of its tier. decimals are
+        used so tiers like 0.1 do not snap 4.3 down to 4.2, and the magnitude
+        is rounded first so a real read back from the database, e.g.
+        4.19999980926, still snaps to 4.2"""
+    tier = Decimal(str(tier))
+    magnitude = Decimal(str(round(float(magnitude), 6)))
+    tiers = (magnitude / tier).to_integral_value(rounding=ROUND_FLOOR)
+    return float(tiers * tier)
+
+
+def get_topic_location(user_info, grid_km: float = None, tier: float = None) -> dict:
+    """returns the snapped magnitude, latitude and longitude of a subscription"""
+    grid_km = grid_km or get_topic_grid_km()
+    tier = tier or get_magnitude_tier()
+    lat, lon = snap_to_grid(user_info['selected_lat'], user_info['selected_lon'], grid_km)
+    return {'magnitude': snap_magnitude(user_info['magnitude'], tier), 'lat': lat, 'lon': lon}
+
+
+def get_topic_name(topic_location) -> str:
+    """returns the sns topic name for a snapped location, which is the same
+        for every subscription in the same cell and magnitude tier"""
+    parts = [f"{topic_location['magnitude']:g}",
+             f"{topic_location['lat']:.6f}", f"{topic_location['lon']:.6f}"]
+    return "-".join([TOPIC_NAME_PREFIX] + [part.replace('-', 'm').replace('.', 'p')
+                                           for part in parts])
+
+
+def create_topic(client, topic_location):
     """creates sns topic for particular longitude, latitude and magnitude"""
     response = client.create_topic(
-        Name="c11-poseidon-test-3"
+        Name=get_topic_name(topic_location)
     )
     return response
 
@@ -55,12 +111,21 @@ def subscribe_to_topic(client, topic_arn, user_info):
 
 
 def check_if_topic_exists(conn, user_info):
-    """checks if given topic already exists"""
+    """checks if a topic already exists for the grid cell and magnitude tier
+        of the given subscription. min_magnitude is a real, so it is compared
+        with a tolerance rather than exactly"""
+    topic_location = get_topic_location(user_info)
     with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as curr:
-        curr.execute(f"""select topic_id, topic_arn from topics
-                            where min_magnitude='{user_info['magnitude']}'
-                            and lon='{user_info['selected_lon']}'
-                            and lat='{user_info['selected_lat']}';""")
+        curr.execute("""select topic_id, topic_arn from topics
+                            where abs(min_magnitude - %s) < %s
+                            and lon=%s
+                            and lat=%s
+                            and region is null
+                            and min_intensity is null
+                            and rules = '{}';""", (topic_location['magnitude'],
+                                                   MAGNITUDE_TOLERANCE,
+                                                   topic_location['lon'],
+                                                   topic_location['lat']))
         result = curr.fetchall()
     if len(result) == 1:
         return result
@@ -88,15 +153,15 @@ def check_if_user_exists(conn, user_info):
     return None
 
 
-def upload_topic_to_database(conn, user_info, topic_info):
+def upload_topic_to_database(conn, topic_location, topic_info):
     """uploads new topic to topics table in database"""
     with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as curr:
         curr.execute("""insert into topics (topic_arn, min_magnitude, lon, lat)
                        values (%s, %s, %s, %s)
                        returning topic_id;""", (topic_info['TopicArn'],
-                                                user_info['magnitude'],
-                                                user_info['selected_lon'],
-                                                user_info['selected_lat']))
+                                                topic_location['magnitude'],
+                                                topic_location['lon'],
+                                                topic_location['lat']))
         return curr.fetchone()['topic_id']
 
 
@@ -249,13 +314,22 @@ def create_notifications_page():
     conn = get_connection()
     update_email_subscriptions_arn(conn, client)
     if user_info != []:
-        if check_if_user_exists(conn, user_info) is None:
+        existing_user = check_if_user_exists(conn, user_info)
+        if existing_user is None:
             user_id = upload_user_to_database(conn, user_info)
-        if check_if_topic_exists(conn, user_info) is None:
-            topic_info = create_topic(client)
-            topic_id = upload_topic_to_database(conn, user_info, topic_info)
+        else:
+            user_id = existing_user[0]['user_id']
+        existing_topic = check_if_topic_exists(conn, user_info)
+        if existing_topic is None:
+            topic_location = get_topic_location(user_info)
+            topic_arn = create_topic(client, topic_location)['TopicArn']
+            topic_id = upload_topic_to_database(
+                conn, topic_location, {'TopicArn': topic_arn})
+        else:
+            topic_id = existing_topic[0]['topic_id']
+            topic_arn = existing_topic[0]['topic_arn']
         email_subscription, sms_subscription = subscribe_to_topic(
-            client, topic_info['TopicArn'], user_info)
+            client, topic_arn, user_info)
         upload_user_subscription_to_database(
             conn, user_id, topic_id, email_subscription, sms_subscription)
         conn.commit()
@@ -1,6 +1,7 @@
 from unittest.mock import MagicMock
 import pytest
-from notifications import check_if_topic_exists, check_if_user_exists
+from notifications import (check_if_topic_exists, check_if_user_exists, snap_to_grid,
+                           snap_magnitude, get_topic_location, get_topic_name, create_topic)
 
 
 def test_check_if_user_exists():
@@ -30,6 +31,53 @@ def test_check_if_topic_exists():
 
     call_args = mock_cursor.execute.call_args[0]
     assert "select topic_id, topic_arn from topics" in call_args[0]
-    assert "where min_magnitude=" in call_args[0]
+    assert "where abs(min_magnitude - %s) < %s" in call_args[0]
     assert "and lon=" in call_args[0]
     assert "and lat=" in call_args[0]
+    assert "region is null" in call_args[0]
+    assert "min_intensity is null" in call_args[0]
+    assert "rules = '{}'" in call_args[0]
+    assert call_args[1] == (3.0, 0.001, 133.99645, 22.996672)
+
+
+def test_snap_to_grid_nearby_locations_share_a_cell():
+    assert snap_to_grid(53.4076, -2.9649, 1) == snap_to_grid(53.4061, -2.9680, 1)
+
+
+def test_snap_to_grid_distant_locations_do_not_share_a_cell():
+    assert snap_to_grid(53.4076, -2.9649, 1) != snap_to_grid(53.4176, -2.9649, 1)
+
+
+@pytest.mark.parametrize("lat, lon", [(0, 0), (53.4076, -2.9649), (-33.87, 151.21), (70.1, 25.3)])
+def test_snap_to_grid_stays_within_cell(lat, lon):
+    snapped_lat, snapped_lon = snap_to_grid(lat, lon, 1)
+
+    assert abs(snapped_lat - lat) * 111.19 <= 0.5
+    assert abs(snapped_lon - lon) <= 0.5 / 111.19 / 0.3
+
+
+def test_snap_to_grid_wraps_longitude():
+    assert -180 <= snap_to_grid(10, 180, 50)[1] < 180
+
+
+@pytest.mark.parametrize("magnitude, tier, expected", [('4', 1, 4), (4.7, 1, 4), (4.7, 0.5, 4.5), (0, 1, 0),
+                                                       (4.3, 0.1, 4.3), (2.9, 0.1, 2.9),
+                                                       ('2.9', 0.2, 2.8), (5.05, 0.1, 5.0),
+                                                       (4.199999809265137, 0.1, 4.2)])
+def test_snap_magnitude(magnitude, tier, expected):
+    assert snap_magnitude(magnitude, tier) == expected
+
+
+def test_get_topic_name():
+    location = get_topic_location({'selected_lat': 53.407624, 'selected_lon': -2.964996,
+                                   'magnitude': '4'}, 1, 1)
+
+    assert get_topic_name(location) == "c11-poseidon-4-53p404083-m2p971886"
+
+
+def test_create_topic():
+    client = MagicMock()
+
+    create_topic(client, {'magnitude': 3.0, 'lat': 23.003867, 'lon': 134.007435})
+
+    client.create_topic.assert_called_once_with(Name="c11-poseidon-3-23p003867-134p007435")
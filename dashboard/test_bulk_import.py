@@ -0,0 +1,228 @@
+import json
+import time
+from decimal import Decimal
+from unittest.mock import MagicMock, patch
+import pytest
+from bulk_import import (read_rows, parse_row, get_topic_key, plan_import, plan_dry_run, run_sns_calls,
+                         get_existing_topics, subscribe_all, import_subscriptions,
+                         summarise_outcomes, write_report)
+
+
+def make_row(number, lat=53.4076, lon=-2.9649, magnitude=4):
+    return {'email': f'user{number}@partner.com', 'phone_number': f'4477000{number:05d}',
+            'lat': lat, 'lon': lon, 'magnitude': magnitude}
+
+
+def fake_insert_users(conn, users):
+    return [{'user_id': 100 + index, 'email_address': email, 'phone_number': phone_number}
+            for index, (email, phone_number) in enumerate(users)]
+
+
+def fake_insert_topics(conn, topics):
+    return [{'topic_id': 200 + index, 'topic_arn': arn, 'min_magnitude': magnitude,
+             'lat': Decimal(str(lat)), 'lon': Decimal(str(lon))}
+            for index, (arn, magnitude, lat, lon) in enumerate(topics)]
+
+
+@pytest.fixture
+def fake_database():
+    with patch('bulk_import.get_existing_users', return_value=[]) as existing_users, \
+            patch('bulk_import.insert_users', side_effect=fake_insert_users) as insert_users, \
+            patch('bulk_import.get_existing_topics', return_value=[]) as existing_topics, \
+            patch('bulk_import.insert_topics', side_effect=fake_insert_topics) as insert_topics, \
+            patch('bulk_import.get_existing_assignments',
+                  return_value=set()) as existing_assignments, \
+            patch('bulk_import.insert_assignments') as insert_assignments:
+        yield {'existing_users': existing_users, 'insert_users': insert_users,
+               'existing_topics': existing_topics, 'insert_topics': insert_topics,
+               'existing_assignments': existing_assignments,
+               'insert_assignments': insert_assignments}
+
+
+def test_read_rows_csv_and_json(tmp_path):
+    csv_path = tmp_path / 'partners.csv'
+    csv_path.write_text("email,phone_number,lat,lon,magnitude\na@b.com,447700,53.4,-2.9,4\n")
+    json_path = tmp_path / 'partners.json'
+    json_path.write_text(json.dumps([make_row(1)]))
+
+    assert read_rows(str(csv_path)) == [{'email': 'a@b.com', 'phone_number': '447700',
+                                         'lat': '53.4', 'lon': '-2.9',
+                                         'magnitude': '4'}]
+    assert read_rows(str(json_path)) == [make_row(1)]
+
+
+def test_parse_row():
+    user_info = parse_row({**make_row(1), 'email': ' User1@Partner.com ',
+                           'phone_number': '+44 7700'})
+
+    assert user_info == {'email': 'user1@partner.com', 'phone_number': '+447700',
+                         'selected_lat': 53.4076, 'selected_lon': -2.9649, 'magnitude': 4.0}
+
+
+@pytest.mark.parametrize("changes", [{'email': 'not-an-email'}, {'phone_number': ''},
+                                     {'lat': 'north'}, {'lat': 95}, {'magnitude': None}])
+def test_parse_row_invalid(changes):
+    with pytest.raises(ValueError):
+        parse_row({**make_row(1), **changes})
+
+
+def test_get_topic_key_matches_real_magnitudes():
+    assert get_topic_key({'magnitude': 4.199999809265137, 'lat': Decimal('53.404083'),
+                          'lon': Decimal('-2.971886')}) == get_topic_key(
+        {'magnitude': 4.2, 'lat': 53.404083, 'lon': -2.971886})
+
+
+def test_plan_import_dedupes_users_and_topics():
+    rows = [make_row(1), make_row(1, lat=53.4070), make_row(2), make_row(1, magnitude=6),
+            {**make_row(3), 'phone_number': make_row(2)['phone_number']}, {'email': 'bad'}]
+
+    outcomes, subscriptions = plan_import(rows, 1, 1)
+
+    assert [outcome['status'] for outcome in outcomes] == [
+        None, 'duplicate', None, None, 'invalid', 'invalid']
+    assert outcomes[1]['error'] == 'duplicate of row 1'
+    assert len(subscriptions) == 3
+    assert len({subscription['email'] for subscription in subscriptions}) == 2
+
+
+def test_run_sns_calls_limits_rate(stub_sns, stub_sns_client):
+    start = time.monotonic()
+
+    run_sns_calls(stub_sns_client.create_topic, [{'Name': f'topic-{i}'} for i in range(30)],
+                  max_workers=5, rate=20, max_retries=0)
+
+    assert time.monotonic() - start >= 0.45
+
+
+def test_run_sns_calls_bounded_and_retried(stub_sns, stub_sns_client):
+    stub_sns['latency'] = 0.02
+    stub_sns['throttle_every'] = 4
+    requests = [{'Name': f'topic-{i}'} for i in range(30)]
+
+    results = run_sns_calls(stub_sns_client.create_topic, requests,
+                            max_workers=5, rate=1000, max_retries=5)
+
+    assert all(error is None for _, error in results)
+    assert [response['TopicArn'].rsplit(':', 1)[1] for response, _ in results] == [
+        f'topic-{i}' for i in range(30)]
+    assert stub_sns['max_in_flight'] <= 5
+    assert stub_sns['requests'] > 30
+
+
+def test_run_sns_calls_reports_errors(stub_sns, stub_sns_client):
+    stub_sns['rejected_endpoints'] = {'bad'}
+
+    results = run_sns_calls(stub_sns_client.subscribe,
+                            [{'TopicArn': 'arn:topic', 'Protocol': 'sms', 'Endpoint': 'bad'}],
+                            max_workers=2, rate=100, max_retries=0)
+
+    assert results == [(None, 'InvalidParameter: Invalid parameter: Endpoint')]
+
+
+def test_get_existing_topics_leaves_out_region_intensity_and_rule_topics():
+    conn = MagicMock()
+
+    with patch('bulk_import.psycopg2.extras.execute_values') as mock_execute_values:
+        get_existing_topics(conn, [(4.0, 53.404083, -2.971886)])
+
+    query = mock_execute_values.call_args[0][1]
+    assert "where t.region is null and t.min_intensity is null" in query
+    assert "t.rules = '{}'" in query
+
+
+def test_subscribe_all_unsubscribes_half_made_subscriptions(caplog):
+    client = MagicMock()
+    client.subscribe.side_effect = lambda **request: {
+        'SubscriptionArn': f"arn:{request['Protocol']}:{request['Endpoint']}"}
+    client.unsubscribe.side_effect = Exception('unsubscribe failed')
+    pending = [{'email': 'a@b.com', 'phone_number': '4477', 'user_id': 1,
+                'topic': {'topic_id': 5, 'topic_arn': 'arn:topic'}, 'outcome': {}}]
+
+    with patch('bulk_import.run_sns_calls', side_effect=[
+            [({'SubscriptionArn': 'arn:email'}, None), (None, 'InvalidParameter: Endpoint')],
+            [(None, 'unsubscribe failed')]]) as mock_calls:
+        assignments = subscribe_all(client, pending, rate=1000)
+
+    assert assignments == []
+    assert pending[0]['outcome'] == {'status': 'failed', 'error': 'InvalidParameter: Endpoint'}
+    assert mock_calls.call_args_list[1][0][1] == [{'SubscriptionArn': 'arn:email'}]
+    assert mock_calls.call_args_list[1][1] == {'rate': 1000}
+    assert "Error unsubscribing arn:email: unsubscribe failed" in caplog.text
+
+
+def test_import_subscriptions(stub_sns, stub_sns_client, fake_database):
+    conn = MagicMock()
+    rows = [make_row(1), make_row(2), make_row(1), make_row(3, lat=51.5072, lon=0.1276),
+            {'email': 'bad'}]
+
+    outcomes = import_subscriptions(conn, stub_sns_client, rows, 1, 1,
+                                    max_workers=4, rate=1000, max_retries=2)
+
+    assert [outcome['status'] for outcome in outcomes] == [
+        'subscribed', 'subscribed', 'duplicate', 'subscribed', 'invalid']
+    actions = [call['Action'] for call in stub_sns['calls']]
+    assert actions.count('CreateTopic') == 2
+    assert actions.count('Subscribe') == 6
+    fake_database['insert_users'].assert_called_once()
+    fake_database['insert_topics'].assert_called_once()
+    assignments = fake_database['insert_assignments'].call_args[0][1]
+    assert len(assignments) == 3
+    assert assignments[0][2] == 'pending confirmation'
+    assert outcomes[0]['topic_arn'] == outcomes[1]['topic_arn'] != outcomes[3]['topic_arn']
+    conn.commit.assert_called_once()
+
+
+def test_import_subscriptions_reuses_existing_rows(stub_sns, stub_sns_client, fake_database):
+    fake_database['existing_users'].return_value = [
+        {'user_id': 1, 'email_address': 'user1@partner.com', 'phone_number': '447700000001'},
+        {'user_id': 2, 'email_address': 'other@partner.com', 'phone_number': '447700000002'}]
+    fake_database['existing_topics'].return_value = [
+        {'topic_id': 5, 'topic_arn': 'arn:existing', 'min_magnitude': 4.0,
+         'lat': Decimal('53.404083'), 'lon': Decimal('-2.971886')}]
+    fake_database['existing_assignments'].return_value = {(1, 5)}
+
+    outcomes = import_subscriptions(MagicMock(), stub_sns_client, [make_row(1), make_row(2)],
+                                    1, 1, max_workers=2, rate=1000)
+
+    assert [outcome['status'] for outcome in outcomes] == ['already subscribed', 'failed']
+    assert outcomes[1]['error'] == 'email or phone number belongs to another user'
+    assert stub_sns['calls'] == []
+    fake_database['insert_users'].assert_not_called()
+
+
+def test_import_subscriptions_failed_subscribe(stub_sns, stub_sns_client, fake_database):
+    stub_sns['rejected_endpoints'] = {make_row(2)['phone_number']}
+
+    outcomes = import_subscriptions(MagicMock(), stub_sns_client, [make_row(1), make_row(2)],
+                                    1, 1, max_workers=2, rate=1000, max_retries=0)
+
+    assert [outcome['status'] for outcome in outcomes] == ['subscribed', 'failed']
+    assert outcomes[1]['error'].startswith('InvalidParameter')
+    assert len(fake_database['insert_assignments'].call_args[0][1]) == 1
+
+
+def test_import_subscriptions_rolls_back(stub_sns_client, fake_database):
+    conn = MagicMock()
+    fake_database['insert_users'].side_effect = Exception('database unavailable')
+
+    outcomes = import_subscriptions(conn, stub_sns_client, [make_row(1)], 1, 1)
+
+    assert outcomes[0]['status'] == 'failed'
+    conn.rollback.assert_called_once()
+    conn.commit.assert_not_called()
+
+
+def test_plan_dry_run():
+    outcomes = plan_dry_run([make_row(1), make_row(1)], 1, 1)
+
+    assert summarise_outcomes(outcomes) == {'planned': 1, 'duplicate': 1}
+
+
+def test_write_report(tmp_path):
+    path = tmp_path / 'report.csv'
+
+    write_report(str(path), [{'row': 1, 'email': 'a@b.com', 'phone_number': '4477',
+                              'status': 'subscribed', 'topic_arn': 'arn', 'error': None}])
+
+    assert path.read_text().splitlines() == ['row,email,phone_number,status,topic_arn,error',
+                                             '1,a@b.com,4477,subscribed,arn,']
@@ -0,0 +1,156 @@
+from decimal import Decimal
+from unittest.mock import MagicMock, patch
+import pytest
+from migrate_topics import (get_all_topics, group_topics_by_cell, move_assignments, migrate_topics,
+                            migrate_topic_group, unsubscribe_assignment)
+
+
+def make_topic(topic_id, lat, lon, magnitude=4.0):
+    return {'topic_id': topic_id, 'topic_arn': f'arn:aws:sns:eu-west-2:123456789012:topic-{topic_id}',
+            'min_magnitude': magnitude, 'lat': Decimal(str(lat)), 'lon': Decimal(str(lon))}
+
+
+def make_assignment(assignment_id, user_id, email_arn='arn:email'):
+    return {'assignment_id': assignment_id, 'user_id': user_id, 'sms_subscription_arn': 'arn:sms',
+            'email_subscription_arn': email_arn, 'email_address': f'user{user_id}@test.com',
+            'phone_number': f'44{user_id}'}
+
+
+def test_group_topics_by_cell():
+    topics = [make_topic(1, 53.4076, -2.9649), make_topic(2, 53.4061, -2.9680),
+              make_topic(3, 53.4076, -2.9649, 4.5), make_topic(4, 51.5072, 0.1276)]
+
+    groups = group_topics_by_cell(topics, 1, 1)
+
+    assert sorted([topic['topic_id'] for topic in group] for group in groups.values()) == [[1, 2, 3], [4]]
+
+
+def test_get_all_topics_leaves_out_region_intensity_and_rule_topics():
+    conn = MagicMock()
+    cursor = conn.cursor.return_value.__enter__.return_value
+
+    get_all_topics(conn)
+
+    query = cursor.execute.call_args[0][0]
+    assert "where region is null and min_intensity is null and rules = '{}'" in query
+
+
+def test_group_topics_by_cell_skips_region_intensity_and_rule_topics():
+    topics = [make_topic(1, 53.4076, -2.9649), {**make_topic(2, 53.4076, -2.9649), 'region': 'uk'},
+              {**make_topic(3, 53.4076, -2.9649), 'min_intensity': 4.0},
+              {**make_topic(4, 53.4076, -2.9649), 'rules': {'max_depth_km': 10}}]
+
+    groups = group_topics_by_cell(topics, 1, 1)
+
+    assert [[topic['topic_id'] for topic in group] for group in groups.values()] == [[1]]
+
+
+def test_unsubscribe_assignment_skips_pending_email():
+    client = MagicMock()
+
+    unsubscribe_assignment(client, make_assignment(1, 1, 'pending confirmation'))
+
+    client.unsubscribe.assert_called_once_with(SubscriptionArn='arn:sms')
+
+
+@patch('migrate_topics.subscribe_to_topic', return_value=({'SubscriptionArn': 'pending confirmation'},
+                                                          {'SubscriptionArn': 'arn:new-sms'}))
+@patch('migrate_topics.get_topic_assignments')
+def test_move_assignments(mock_assignments, mock_subscribe):
+    conn = MagicMock()
+    cursor = conn.cursor.return_value.__enter__.return_value
+    client = MagicMock()
+    canonical, merged = make_topic(1, 53.4076, -2.9649), make_topic(2, 53.4061, -2.9680)
+    mock_assignments.side_effect = [[make_assignment(10, 7)],
+                                    [make_assignment(11, 7), make_assignment(12, 8)]]
+    new_assignments = []
+
+    old_assignments = move_assignments(conn, client, canonical, merged, new_assignments)
+
+    assert [assignment['assignment_id'] for assignment in old_assignments] == [11, 12]
+    assert new_assignments == [{'email_subscription_arn': 'pending confirmation',
+                                'sms_subscription_arn': 'arn:new-sms'}]
+    mock_subscribe.assert_called_once_with(client, canonical['topic_arn'],
+                                           {'email': 'user8@test.com', 'phone_number': '448'})
+    queries = [call[0][0] for call in cursor.execute.call_args_list]
+    assert "delete from user_topic_assignments" in queries[0]
+    assert "update user_topic_assignments" in queries[1]
+    assert cursor.execute.call_args_list[1][0][1] == (1, 'pending confirmation', 'arn:new-sms', 12)
+    client.unsubscribe.assert_not_called()
+
+
+def move_two_assignments(conn, client, canonical_topic, merged_topic, new_assignments):
+    new_assignments.extend([{'email_subscription_arn': 'pending confirmation',
+                             'sms_subscription_arn': f'arn:new-sms-{index}'} for index in range(2)])
+    return [make_assignment(11, 7)]
+
+
+@patch('migrate_topics.move_assignments', side_effect=move_two_assignments)
+@patch('migrate_topics.get_all_topics')
+def test_migrate_topics(mock_topics, mock_move):
+    conn = MagicMock()
+    client = MagicMock()
+    mock_topics.return_value = [make_topic(1, 53.4076, -2.9649), make_topic(2, 53.4061, -2.9680),
+                                make_topic(3, 51.5072, 0.1276)]
+
+    summary = migrate_topics(conn, client, 1, 1)
+
+    assert summary == {'topics': 3, 'cells': 2, 'merged_topics': 1, 'moved_users': 2}
+    client.delete_topic.assert_called_once_with(TopicArn=mock_topics.return_value[1]['topic_arn'])
+    assert client.unsubscribe.call_count == 2
+    assert conn.commit.call_count == 2
+
+
+@patch('migrate_topics.move_assignments', side_effect=move_two_assignments)
+def test_migrate_topic_group_removes_merged_topic_after_commit(mock_move):
+    conn = MagicMock()
+    client = MagicMock()
+    calls = MagicMock()
+    calls.attach_mock(conn.commit, 'commit')
+    calls.attach_mock(client.delete_topic, 'delete_topic')
+    topics = [make_topic(1, 53.4076, -2.9649), make_topic(2, 53.4061, -2.9680)]
+
+    migrate_topic_group(conn, client, (4.0, 53.4, -2.96), topics)
+
+    assert [call[0] for call in calls.mock_calls] == ['commit', 'delete_topic']
+
+
+@patch('migrate_topics.move_assignments', side_effect=move_two_assignments)
+def test_migrate_topic_group_undoes_subscriptions_when_commit_fails(mock_move):
+    conn = MagicMock()
+    conn.commit.side_effect = Exception("Commit failed")
+    client = MagicMock()
+    topics = [make_topic(1, 53.4076, -2.9649), make_topic(2, 53.4061, -2.9680)]
+
+    with pytest.raises(Exception, match="Commit failed"):
+        migrate_topic_group(conn, client, (4.0, 53.4, -2.96), topics)
+
+    assert [call.kwargs['SubscriptionArn'] for call in client.unsubscribe.call_args_list] == [
+        'arn:new-sms-0', 'arn:new-sms-1']
+    client.delete_topic.assert_not_called()
+
+
+@patch('migrate_topics.move_assignments', side_effect=move_two_assignments)
+def test_migrate_topic_group_logs_merged_topic_left_in_sns(mock_move, caplog):
+    conn = MagicMock()
+    client = MagicMock()
+    client.delete_topic.side_effect = Exception("Delete failed")
+    topics = [make_topic(1, 53.4076, -2.9649), make_topic(2, 53.4061, -2.9680)]
+
+    assert migrate_topic_group(conn, client, (4.0, 53.4, -2.96), topics) == 2
+
+    conn.commit.assert_called_once()
+    assert "Error removing merged topic arn:aws:sns:eu-west-2:123456789012:topic-2" in caplog.text
+
+
+@patch('migrate_topics.get_all_topics')
+def test_migrate_topics_dry_run(mock_topics):
+    conn = MagicMock()
+    client = MagicMock()
+    mock_topics.return_value = [make_topic(1, 53.4076, -2.9649), make_topic(2, 53.4061, -2.9680)]
+
+    summary = migrate_topics(conn, client, 1, 1, dry_run=True)
+
+    assert summary['merged_topics'] == 1
+    client.delete_topic.assert_not_called()
+    conn.commit.assert_not_called()
@@ -1,4 +1,5 @@
 DROP TABLE IF EXISTS earthquakes CASCADE;
+DROP TABLE IF EXISTS data_loads CASCADE;
 DROP TABLE IF EXISTS alerts CASCADE;
 DROP TABLE IF EXISTS statuses CASCADE;
 DROP TABLE IF EXISTS magtypes CASCADE;
@@ -7,6 +8,11 @@ DROP TABLE IF EXISTS types CASCADE;
 DROP TABLE IF EXISTS user_topic_assignments CASCADE;
 DROP TABLE IF EXISTS users CASCADE;
 DROP TABLE IF EXISTS topics CASCADE;
+DROP TABLE IF EXISTS alert_deliveries CASCADE;
+DROP TABLE IF EXISTS alert_digests CASCADE;
+
+CREATE EXTENSION IF NOT EXISTS cube;
+CREATE EXTENSION IF NOT EXISTS earthdistance;
 
 CREATE TABLE alerts (
     alert_id SMALLINT GENERATED ALWAYS AS IDENTITY,
@@ -58,6 +64,9 @@ CREATE TABLE earthquakes (
     type_id SMALLINT NOT NULL,
     title TEXT NOT NULL,
     depth REAL NOT NULL,
+    country_code CHAR(2),
+    continent_code CHAR(2),
+    state VARCHAR(100),
     FOREIGN KEY (alert_id) REFERENCES alerts(alert_id),
     FOREIGN KEY (status_id) REFERENCES statuses(status_id),
     FOREIGN KEY (network_id) REFERENCES networks(network_id),
@@ -65,6 +74,19 @@ CREATE TABLE earthquakes (
     FOREIGN KEY (magtype_id) REFERENCES magtypes(magtype_id)
 );
 
+CREATE INDEX earthquakes_time_id_idx ON earthquakes (time DESC, earthquake_id DESC);
+CREATE INDEX earthquakes_country_time_idx ON earthquakes (country_code, time DESC, earthquake_id DESC);
+CREATE INDEX earthquakes_continent_time_idx ON earthquakes (continent_code, time DESC, earthquake_id DESC);
+CREATE INDEX earthquakes_lat_lon_idx ON earthquakes (lat, lon);
+CREATE INDEX earthquakes_earth_idx ON earthquakes USING gist (ll_to_earth(lat::float8, lon::float8));
+
+CREATE TABLE data_loads (
+    load_id INT GENERATED ALWAYS AS IDENTITY,
+    loaded_at TIMESTAMP NOT NULL DEFAULT (CURRENT_TIMESTAMP AT TIME ZONE 'UTC'),
+    earthquake_count INT NOT NULL,
+    PRIMARY KEY (load_id)
+);
+
 CREATE TABLE users (
     user_id SMALLINT GENERATED ALWAYS AS IDENTITY,
     email_address VARCHAR(100) UNIQUE NOT NULL,
@@ -78,9 +100,40 @@ CREATE TABLE topics (
     min_magnitude REAL NOT NULL,
     lon DECIMAL(9, 6) NOT NULL,
     lat DECIMAL(8, 6) NOT NULL,
+    rules JSONB NOT NULL DEFAULT '{}',
+    region TEXT,
+    min_intensity REAL CHECK (min_intensity >= 2),
+    PRIMARY KEY (topic_id)
+);
+
+CREATE INDEX topics_lat_lon_idx ON topics (lat, lon);
+CREATE INDEX topics_region_idx ON topics (min_magnitude) WHERE region IS NOT NULL;
+
+CREATE TABLE alert_deliveries (
+    earthquake_id VARCHAR(20) NOT NULL,
+    topic_id SMALLINT NOT NULL,
+    magnitude REAL NOT NULL,
+    event_time TIMESTAMP NOT NULL,
+    detected_at TIMESTAMP NOT NULL,
+    -- NULL while the alert is held back for a digest which has not been published
+    published_at TIMESTAMP,
+    FOREIGN KEY (topic_id) REFERENCES topics(topic_id),
+    PRIMARY KEY (earthquake_id, topic_id)
+);
+
+CREATE TABLE alert_digests (
+    topic_id SMALLINT NOT NULL,
+    topic_arn VARCHAR(100) NOT NULL,
+    window_start TIMESTAMP NOT NULL,
+    largest_magnitude REAL NOT NULL,
+    immediate_count SMALLINT NOT NULL,
+    pending JSONB NOT NULL DEFAULT '[]',
+    FOREIGN KEY (topic_id) REFERENCES topics(topic_id),
     PRIMARY KEY (topic_id)
 );
 
+CREATE INDEX alert_digests_window_start_idx ON alert_digests (window_start);
+
 CREATE TABLE user_topic_assignments (
     assignment_id SMALLINT GENERATED ALWAYS AS IDENTITY,
     user_id SMALLINT NOT NULL,
@@ -0,0 +1,72 @@
+# pylint: disable=W0718, W1203
+
+"""This script fills in the country code, continent code and state of
+earthquakes loaded before region enrichment, one batch at a time."""
+
+import argparse
+import logging
+import psycopg2.extras
+from load import (DB_HOST, DB_NAME, DB_USERNAME, DB_PASSWORD, DB_PORT,
+                  get_connection, get_cursor, get_regions, record_data_load)
+
+DEFAULT_BATCH_SIZE = 5000
+
+
+def get_unenriched_batch(cursor, after_id: str | None, batch_size: int) -> list[dict]:
+    """
+    Gets the next batch of earthquakes without a country code, ordered by id
+    """
+    cursor.execute("""SELECT earthquake_id, lat, lon FROM earthquakes
+                      WHERE country_code IS NULL AND earthquake_id > %s
+                      ORDER BY earthquake_id LIMIT %s;""", (after_id or "", batch_size))
+    return cursor.fetchall()
+
+
+def update_regions(cursor, earthquakes: list[dict], regions: list[dict]) -> None:
+    """
+    Writes the regions for a batch of earthquakes in one statement
+    """
+    psycopg2.extras.execute_values(
+        cursor,
+        """UPDATE earthquakes AS e
+           SET country_code = r.country_code, continent_code = r.continent_code, state = r.state
+           FROM (VALUES %s) AS r (earthquake_id, country_code, continent_code, state)
+           WHERE e.earthquake_id = r.earthquake_id;""",
+        [(earthquake["earthquake_id"], region["country_code"], region["continent_code"],
+          region["state"]) for earthquake, region in zip(earthquakes, regions)],
+        page_size=len(earthquakes))
+
+
+def backfill_regions(conn, batch_size: int = DEFAULT_BATCH_SIZE) -> int:
+    """
+    Enriches every earthquake without a country code, committing after each
+    batch so the job can be stopped and resumed, then records a data load so
+    API caches see the change. Returns how many were updated.
+    """
+    cursor = get_cursor(conn)
+    updated = 0
+    after_id = None
+    try:
+        while earthquakes := get_unenriched_batch(cursor, after_id, batch_size):
+            update_regions(cursor, earthquakes, get_regions(earthquakes))
+            conn.commit()
+            updated += len(earthquakes)
+            after_id = earthquakes[-1]["earthquake_id"]
+            logging.info(f"Backfilled regions for {updated} earthquakes")
+    except Exception as e:
+        logging.error(f"An unexpected error occurred while backfilling regions: {e}")
+        conn.rollback()
+    if updated:
+        record_data_load(conn, cursor, updated)
+    cursor.close()
+    return updated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill earthquake regions")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    arguments = parser.parse_args()
+    connection = get_connection(DB_HOST, DB_NAME, DB_USERNAME, DB_PASSWORD, DB_PORT)
+    if connection:
+        backfill_regions(connection, arguments.batch_size)
+        connection.close()
@@ -0,0 +1,170 @@
+"""Benchmarks for the alert matching paths, run locally with e.g.
+python3 benchmark.py rules --topics 100000
+python3 benchmark.py geofences --topics 5000
+python3 benchmark.py intensity --topics 100000
+python3 benchmark.py sharding --topics 300000 --earthquakes 500"""
+
+import argparse
+import time
+import numpy as np
+import shapely
+from transform import PAGER_ALERT_LEVELS
+from rules import RuleIndex
+from geofence import GeofenceIndex
+from intensity import match_intensity
+from sharding import ShardCoordinator
+from sns import find_alert_matches, get_notification_distance
+
+EARTHQUAKE_TYPES = ['earthquake', 'explosion', 'quarry blast']
+
+
+def time_call(function, *arguments) -> tuple[float, object]:
+    """times a single call, returning the seconds taken and its result"""
+    start = time.perf_counter()
+    result = function(*arguments)
+    return time.perf_counter() - start, result
+
+
+def get_random_earthquakes(rng: np.random.Generator, count: int) -> list[dict]:
+    """generates earthquakes spread over the whole globe"""
+    return [{'earthquake_id': f'eq{i}',
+             'magnitude': round(float(rng.uniform(2, 7.5)), 1),
+             'lat': float(rng.uniform(-60, 70)), 'lon': float(rng.uniform(-180, 180)),
+             'depth': float(rng.uniform(0, 300)), 'felt': int(rng.integers(0, 500)),
+             'mmi': float(rng.uniform(1, 9)),
+             'alert': PAGER_ALERT_LEVELS[rng.integers(0, len(PAGER_ALERT_LEVELS))],
+             'earthquake_type': EARTHQUAKE_TYPES[rng.integers(0, len(EARTHQUAKE_TYPES))],
+             'title': f'M 5.0 - benchmark earthquake {i}'} for i in range(count)]
+
+
+def get_random_rules(rng: np.random.Generator) -> dict:
+    """generates a random mix of subscription rules, a third of topics having none"""
+    rules = {}
+    if rng.random() < 0.4:
+        rules['max_depth'] = float(rng.choice([10, 70, 300]))
+    if rng.random() < 0.3:
+        rules['min_alert'] = PAGER_ALERT_LEVELS[rng.integers(0, len(PAGER_ALERT_LEVELS))]
+    if rng.random() < 0.2:
+        rules['min_felt'] = int(rng.choice([1, 10, 100]))
+    if rng.random() < 0.2:
+        rules['min_mmi'] = float(rng.integers(2, 7))
+    if rng.random() < 0.3:
+        rules['types'] = ['earthquake']
+    return rules
+
+
+def get_random_topics(rng: np.random.Generator, count: int) -> list[dict]:
+    """generates topics with random subscription rules spread over the whole globe"""
+    return [{'topic_id': i, 'topic_arn': f'arn:aws:sns:eu-west-2:000000000000:topic-{i}',
+             'min_magnitude': float(rng.integers(0, 7)),
+             'lat': float(rng.uniform(-60, 70)), 'lon': float(rng.uniform(-180, 180)),
+             'rules': get_random_rules(rng)} for i in range(count)]
+
+
+def benchmark_rules(topic_count: int, earthquake_count: int, seed: int) -> dict:
+    """compares the compiled rule index against checking every topic"""
+    rng = np.random.default_rng(seed)
+    earthquakes = get_random_earthquakes(rng, earthquake_count)
+    topics = get_random_topics(rng, topic_count)
+    radii = [get_notification_distance(earthquake['magnitude']) for earthquake in earthquakes]
+
+    build_time, index = time_call(RuleIndex, topics)
+    match_time, matches = time_call(index.match, earthquakes, radii)
+    brute_force_time, _ = time_call(find_alert_matches, earthquakes, topics)
+    return {'topics': topic_count, 'earthquakes': earthquake_count,
+            'predicates': len(index.predicates), 'buckets': len(index.buckets),
+            'matches': len(matches), 'index_build_s': round(build_time, 3),
+            'index_match_s': round(match_time, 4),
+            'brute_force_match_s (no rules)': round(brute_force_time, 4)}
+
+
+def get_random_region(rng: np.random.Generator, vertices: int = 256) -> str:
+    """generates either a jagged star-shaped service area or a winding
+    rail corridor, both with hundreds of vertices, as WKT"""
+    lat, lon = float(rng.uniform(-60, 70)), float(rng.uniform(-175, 175))
+    if rng.random() < 0.5:
+        angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+        radii = rng.uniform(0.3, 1.0, vertices) * float(rng.uniform(0.2, 2))
+        return shapely.Polygon(zip(lon + radii * np.cos(angles),
+                                   lat + radii * np.sin(angles))).wkt
+    steps = rng.normal(0, 0.05, (vertices // 8, 2)).cumsum(axis=0)
+    return shapely.LineString(steps + [lon, lat]).buffer(0.02, quad_segs=2).wkt
+
+
+def benchmark_geofences(topic_count: int, earthquake_count: int, seed: int) -> dict:
+    """compares the STRtree geofence index against testing every polygon"""
+    rng = np.random.default_rng(seed)
+    earthquakes = get_random_earthquakes(rng, earthquake_count)
+    topics = [{**topic, 'region': get_random_region(rng), 'rules': {}}
+              for topic in get_random_topics(rng, topic_count)]
+
+    build_time, index = time_call(GeofenceIndex, topics)
+    match_time, matches = time_call(index.match, earthquakes)
+
+    def match_every_polygon():
+        return [(earthquake, topic)
+                for earthquake in earthquakes
+                for topic, geometry in zip(index.topics, index.geometries)
+                if earthquake['magnitude'] >= topic['min_magnitude'] and geometry.covers(
+                    shapely.Point(earthquake['lon'], earthquake['lat']))]
+    brute_force_time, brute_force_matches = time_call(match_every_polygon)
+    return {'topics': topic_count, 'earthquakes': earthquake_count,
+            'vertices': int(shapely.get_num_coordinates(index.geometries).sum()),
+            'matches': len(matches), 'index_build_s': round(build_time, 3),
+            'index_match_s': round(match_time, 4),
+            'every_polygon_match_s': round(brute_force_time, 4),
+            'same_matches': len(brute_force_matches) == len(matches)}
+
+
+def benchmark_intensity(topic_count: int, earthquake_count: int, seed: int) -> dict:
+    """times predicting intensity at every topic for every earthquake, i.e.
+    without the bounding-box prefilter get_topics applies"""
+    rng = np.random.default_rng(seed)
+    earthquakes = get_random_earthquakes(rng, earthquake_count)
+    topics = [{**topic, 'min_intensity': float(rng.choice([3, 4, 5, 6])), 'rules': {}}
+              for topic in get_random_topics(rng, topic_count)]
+
+    match_time, matches = time_call(match_intensity, earthquakes, topics)
+    return {'topics': topic_count, 'earthquakes': earthquake_count,
+            'predictions': topic_count * earthquake_count, 'matches': len(matches),
+            'match_s': round(match_time, 4),
+            'per_earthquake_ms': round(1000 * match_time / earthquake_count, 2)}
+
+
+def benchmark_sharding(topic_count: int, earthquake_count: int, seed: int,
+                       worker_counts: tuple = (1, 2, 4, 8)) -> dict:
+    """times matching through the shard coordinator for each worker count.
+    Speed-ups are bounded by the number of CPU cores available."""
+    rng = np.random.default_rng(seed)
+    earthquakes = get_random_earthquakes(rng, earthquake_count)
+    topics = [{**topic, 'min_intensity': float(rng.choice([3, 4, 5])) if i % 10 == 0 else None}
+              for i, topic in enumerate(get_random_topics(rng, topic_count))]
+
+    results = {'topics': topic_count, 'earthquakes': earthquake_count}
+    for worker_count in worker_counts:
+        coordinator = ShardCoordinator(topics, worker_count)
+        start_time, _ = time_call(coordinator.start)
+        try:
+            match_time, matches = time_call(coordinator.match, earthquakes)
+        finally:
+            coordinator.close()
+        results[f'{worker_count}_workers'] = {'start_s': round(start_time, 3),
+                                              'match_s': round(match_time, 4),
+                                              'matches': len(matches)}
+    return results
+
+
+BENCHMARKS = {'rules': benchmark_rules, 'geofences': benchmark_geofences,
+              'intensity': benchmark_intensity, 'sharding': benchmark_sharding}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmark", choices=BENCHMARKS)
+    parser.add_argument("--topics", type=int, default=100_000)
+    parser.add_argument("--earthquakes", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=36)
+    args = parser.parse_args()
+    for name, value in BENCHMARKS[args.benchmark](
+            args.topics, args.earthquakes, args.seed).items():
+        print(f"{name}: {value}")
@@ -3,6 +3,7 @@
 from datetime import datetime, timezone, timedelta
 import pytest
 from unittest.mock import MagicMock, patch
+from stub_sns import stub_sns, stub_sns_client
 
 
 @pytest.fixture
@@ -602,7 +603,3 @@ def example_users():
         'lon': -2.964996, 
         'lat': 53.407624
         }]
-
-
-
-
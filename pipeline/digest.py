@@ -0,0 +1,222 @@
+# pylint: disable=W0718, W1203
+
+"""This script batches alerts during aftershock swarms into a single digest per topic"""
+
+from datetime import datetime, timedelta
+import logging
+from psycopg2.extensions import connection
+import psycopg2.extras
+
+MAX_DIGEST_EVENTS = 50
+
+
+class MemoryDigestStore:
+    """
+    Keeps per-topic digest state in memory, for when the alert system
+    runs as a long lived process
+    """
+
+    def __init__(self):
+        self.states = {}
+
+    def load(self, topic_ids: set[int]) -> dict[int, dict]:
+        """Gets the open digest windows for the topics"""
+        return {topic_id: self.states[topic_id]
+                for topic_id in topic_ids if topic_id in self.states}
+
+    def load_expired(self, opened_before: datetime) -> dict[int, dict]:
+        """Gets every digest window opened before the given time"""
+        return {topic_id: state for topic_id, state in self.states.items()
+                if state['window_start'] < opened_before}
+
+    def save(self, states: dict[int, dict]) -> None:
+        """Saves the digest windows"""
+        self.states.update(states)
+
+    def delete(self, topic_ids: set[int]) -> None:
+        """Closes the digest windows for the topics"""
+        for topic_id in topic_ids:
+            self.states.pop(topic_id, None)
+
+
+class DatabaseDigestStore:
+    """
+    Keeps per-topic digest state in the alert_digests table, for when the
+    alert system runs in a short lived Lambda
+    """
+
+    def __init__(self, conn: connection):
+        self.conn = conn
+
+    def fetch_states(self, condition: str, params: tuple) -> dict[int, dict]:
+        """Gets the digest windows matching a WHERE condition"""
+        try:
+            with self.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+                cur.execute(f"""SELECT topic_id, topic_arn, window_start, largest_magnitude,
+                                       immediate_count, pending
+                                FROM alert_digests WHERE {condition};""", params)
+                return {row['topic_id']: dict(row) for row in cur.fetchall()}
+        except Exception as e:
+            logging.error(f"An unexpected error occurred fetching alert digests: {e}")
+            return {}
+
+    def load(self, topic_ids: set[int]) -> dict[int, dict]:
+        """Gets the open digest windows for the topics"""
+        if not topic_ids:
+            return {}
+        return self.fetch_states("topic_id = ANY(%s)", (list(topic_ids),))
+
+    def load_expired(self, opened_before: datetime) -> dict[int, dict]:
+        """Gets every digest window opened before the given time"""
+        return self.fetch_states("window_start < %s", (opened_before,))
+
+    def save(self, states: dict[int, dict]) -> None:
+        """Saves the digest windows in one statement"""
+        if not states:
+            return
+        try:
+            with self.conn.cursor() as cur:
+                psycopg2.extras.execute_values(cur, """
+                    INSERT INTO alert_digests
+                        (topic_id, topic_arn, window_start, largest_magnitude, immediate_count, pending)
+                    VALUES %s
+                    ON CONFLICT (topic_id) DO UPDATE SET
+                        topic_arn = EXCLUDED.topic_arn,
+                        window_start = EXCLUDED.window_start,
+                        largest_magnitude = EXCLUDED.largest_magnitude,
+                        immediate_count = EXCLUDED.immediate_count,
+                        pending = EXCLUDED.pending;
+                    """, [(state['topic_id'], state['topic_arn'], state['window_start'],
+                           state['largest_magnitude'], state['immediate_count'],
+                           psycopg2.extras.Json(state['pending']))
+                          for state in states.values()])
+            self.conn.commit()
+        except Exception as e:
+            logging.error(f"An unexpected error occurred saving alert digests: {e}")
+            self.conn.rollback()
+
+    def delete(self, topic_ids: set[int]) -> None:
+        """Closes the digest windows for the topics"""
+        if not topic_ids:
+            return
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute("DELETE FROM alert_digests WHERE topic_id = ANY(%s);",
+                            (list(topic_ids),))
+            self.conn.commit()
+        except Exception as e:
+            logging.error(f"An unexpected error occurred deleting alert digests: {e}")
+            self.conn.rollback()
+
+
+def open_digest_window(match: dict, now: datetime) -> dict:
+    """
+    Starts a new digest window for a topic after it is sent an immediate alert
+    """
+    return {'topic_id': match['topic']['topic_id'],
+            'topic_arn': match['topic']['topic_arn'],
+            'window_start': now,
+            'largest_magnitude': match['earthquake']['magnitude'],
+            'immediate_count': 1,
+            'pending': []}
+
+
+def add_pending_event(state: dict, match: dict) -> None:
+    """
+    Adds an earthquake to a topic's digest, replacing an earlier
+    version of the same event
+    """
+    earthquake = match['earthquake']
+    state['pending'] = [event for event in state['pending']
+                        if event['earthquake_id'] != earthquake['earthquake_id']]
+    state['pending'].append({'earthquake_id': earthquake['earthquake_id'],
+                             'magnitude': earthquake['magnitude'],
+                             'title': earthquake['title'],
+                             'distance': match['distance']})
+    state['pending'] = state['pending'][-MAX_DIGEST_EVENTS:]
+
+
+def apply_digest(matches: list[dict], states: dict[int, dict], now: datetime,
+                 max_immediate: int) -> tuple[list[dict], list[dict]]:
+    """
+    Splits matches into those alerted immediately and those held for the digest.
+    A topic gets an immediate alert for the first earthquake in its window, and
+    for any larger earthquake until it has had max_immediate alerts; everything
+    else is suppressed into the topic's digest. Updates states in place.
+    """
+    immediate_matches = []
+    suppressed_matches = []
+    for match in matches:
+        topic_id = match['topic']['topic_id']
+        magnitude = match['earthquake']['magnitude']
+        state = states.get(topic_id)
+        if state is None:
+            states[topic_id] = open_digest_window(match, now)
+            immediate_matches.append(match)
+        elif magnitude > state['largest_magnitude'] and state['immediate_count'] < max_immediate:
+            state['largest_magnitude'] = magnitude
+            state['immediate_count'] += 1
+            immediate_matches.append(match)
+        else:
+            add_pending_event(state, match)
+            suppressed_matches.append(match)
+    return immediate_matches, suppressed_matches
+
+
+def run_digest(store, matches: list[dict], now: datetime, window_minutes: float,
+               max_immediate: int) -> tuple[list[dict], list[dict], list[dict], dict[int, dict]]:
+    """
+    Finds the expired digest windows and applies digest mode to the matches,
+    opening new windows for topics whose window has expired. Returns the
+    matches to alert immediately, the expired windows which have events to
+    send as a digest, the suppressed matches and the open windows. Expired
+    windows with events stay in the store until close_digests is told their
+    digest was published.
+    """
+    expired = store.load_expired(now - timedelta(minutes=window_minutes))
+    store.delete({topic_id for topic_id, state in expired.items() if not state['pending']})
+    digests = [state for state in expired.values() if state['pending']]
+
+    states = store.load({match['topic']['topic_id'] for match in matches} - set(expired))
+    immediate_matches, suppressed_matches = apply_digest(matches, states, now, max_immediate)
+
+    logging.info(f"Digest mode suppressed {len(suppressed_matches)} alerts and closed "
+                 f"{len(digests)} digests")
+    return immediate_matches, digests, suppressed_matches, states
+
+
+def get_delivered_digests(results: list[dict]) -> set[int]:
+    """
+    Gets the topics whose digest was published, from the publish results
+    """
+    return {result['key'][1] for result in results
+            if result['delivered'] and result['key'][0] == 'digest'}
+
+
+def close_digests(store, digests: list[dict], states: dict[int, dict],
+                  delivered_topic_ids: set[int]) -> int:
+    """
+    Saves the open windows and removes the digests which were published,
+    returning how many were published.
+    A digest which failed to publish is kept to be sent again: its events
+    are carried into the topic's new window if one was opened, otherwise
+    its expired window is left in the store for the next run.
+    """
+    published = set()
+    for digest in digests:
+        topic_id = digest['topic_id']
+        if topic_id in delivered_topic_ids:
+            published.add(topic_id)
+        elif topic_id in states:
+            logging.error(f"Digest for topic {topic_id} was not published, "
+                          f"carrying its events into the new window")
+            state = states[topic_id]
+            revised = {event['earthquake_id'] for event in state['pending']}
+            state['pending'] = ([event for event in digest['pending']
+                                 if event['earthquake_id'] not in revised]
+                                + state['pending'])[-MAX_DIGEST_EVENTS:]
+        else:
+            logging.error(f"Digest for topic {topic_id} was not published, keeping it to retry")
+    store.delete(published - set(states))
+    store.save(states)
+    return len(published)
@@ -0,0 +1,70 @@
+# pylint: disable=W0718, W1203
+
+"""This script orders alert work by priority and tracks how quickly alerts go out"""
+
+from datetime import datetime, timezone
+import heapq
+import logging
+import math
+
+EARTHQUAKE_TIME_FORMAT = "%Y/%m/%d %H:%M:%S"
+LATENCY_PERCENTILES = (50, 95, 99)
+
+
+def get_event_time(earthquake: dict) -> datetime | None:
+    """
+    Gets the USGS origin time of a transformed earthquake as a UTC datetime
+    """
+    try:
+        return datetime.strptime(earthquake['time'], EARTHQUAKE_TIME_FORMAT).replace(
+            tzinfo=timezone.utc)
+    except Exception as e:
+        logging.error(f"Error getting earthquake origin time: {e}")
+        return None
+
+
+def get_alert_priority(magnitude: float, distance: float) -> tuple:
+    """
+    Gets the sort key for an alert: highest magnitude first, then closest distance
+    """
+    return (-magnitude, distance)
+
+
+def prioritise_messages(messages: list[dict]) -> list[dict]:
+    """
+    Orders messages through a priority queue using their 'priority' key,
+    keeping the original order for equal priorities. Messages without a
+    priority go last.
+    """
+    queue = []
+    for position, message in enumerate(messages):
+        priority = message.get('priority', (math.inf,))
+        heapq.heappush(queue, (priority, position, message))
+    return [heapq.heappop(queue)[2] for _ in range(len(queue))]
+
+
+def get_percentile(sorted_values: list[float], percentile: float) -> float | None:
+    """
+    Gets the nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return None
+    rank = math.ceil(percentile / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def summarise_latencies(results: list[dict]) -> dict:
+    """
+    Gets the end-to-end latency percentiles, in seconds, from earthquake
+    origin time to publish for the delivered alerts
+    """
+    latencies = sorted(result['latency'] for result in results
+                       if result.get('latency') is not None)
+    summary = {f"p{percentile}": get_percentile(latencies, percentile)
+               for percentile in LATENCY_PERCENTILES}
+    summary['count'] = len(latencies)
+    summary['max'] = latencies[-1] if latencies else None
+    if latencies:
+        logging.info(f"Alert latency p50={summary['p50']:.1f}s p95={summary['p95']:.1f}s "
+                     f"p99={summary['p99']:.1f}s over {len(latencies)} alerts")
+    return summary
@@ -0,0 +1,97 @@
+# pylint: disable=W0718, W1203
+
+"""This script matches earthquakes against topics with a polygon or
+multipolygon region, using an STRtree of prepared geometries"""
+
+import logging
+import numpy as np
+import shapely
+from shapely import wkt, STRtree
+from rules import get_topic_predicates, evaluate_predicate
+
+WARM_INDEX = {}
+
+
+def get_region_geometry(region: str) -> shapely.Geometry | None:
+    """
+    Parses a topic's WKT region (lon/lat order) into a prepared geometry.
+    Regions crossing the antimeridian should be stored as a MULTIPOLYGON
+    split at 180 degrees.
+    """
+    try:
+        geometry = wkt.loads(region)
+        if geometry.geom_type not in ('Polygon', 'MultiPolygon') or not geometry.is_valid:
+            raise ValueError(f"expected a valid polygon or multipolygon, got {geometry.geom_type}")
+        shapely.prepare(geometry)
+        return geometry
+    except Exception as e:
+        logging.error(f"Error parsing topic region: {e}")
+        return None
+
+
+class GeofenceIndex:
+    """
+    An in-memory R-tree over topic regions. Each earthquake is first matched
+    against region bounding boxes, then point-in-polygon tested against the
+    prepared geometries of those candidates only.
+    """
+
+    def __init__(self, topics: list[dict]):
+        self.topics = []
+        self.predicates = []
+        geometries = []
+        for topic, predicates in zip(*get_topic_predicates(topics)):
+            geometry = get_region_geometry(topic['region'])
+            if geometry is None:
+                logging.error(f"Skipping topic {topic.get('topic_id')} with an invalid region")
+                continue
+            self.topics.append(topic)
+            self.predicates.append(predicates)
+            geometries.append(geometry)
+        self.geometries = np.array(geometries, dtype=object)
+        self.tree = STRtree(self.geometries)
+        self.min_magnitudes = np.array([float(topic['min_magnitude']) for topic in self.topics])
+
+    def match_earthquake(self, earthquake: dict) -> list[dict]:
+        """
+        Finds the topics whose region contains the earthquake's epicentre
+        """
+        point = shapely.Point(float(earthquake['lon']), float(earthquake['lat']))
+        candidates = self.tree.query(point)
+        candidates = candidates[self.min_magnitudes[candidates] <= earthquake['magnitude']]
+        if candidates.size == 0:
+            return []
+        inside = candidates[shapely.covers(self.geometries[candidates], point)]
+        return [{'earthquake': earthquake, 'topic': self.topics[candidate], 'distance': 0}
+                for candidate in inside
+                if all(evaluate_predicate(predicate, earthquake)
+                       for predicate in self.predicates[candidate])]
+
+    def match(self, earthquakes: list[dict]) -> list[dict]:
+        """
+        Finds every (earthquake, topic) match for a batch
+        """
+        matches = []
+        for earthquake in earthquakes:
+            if earthquake.get('magnitude') is None:
+                continue
+            try:
+                matches.extend(self.match_earthquake(earthquake))
+            except Exception as e:
+                logging.error(
+                    f"An unexpected error occurred matching regions for "
+                    f"{earthquake.get('earthquake_id')}: {e}")
+        return matches
+
+
+def get_geofence_index(topics: list[dict]) -> GeofenceIndex:
+    """
+    Gets the index for a set of region topics, reusing the last one built
+    while the topics are unchanged so a long lived process keeps it warm
+    """
+    signature = tuple((topic['topic_id'], topic['min_magnitude'], topic['region'],
+                       repr(topic.get('rules'))) for topic in topics)
+    if WARM_INDEX.get('signature') != signature:
+        WARM_INDEX['signature'] = signature
+        WARM_INDEX['index'] = GeofenceIndex(topics)
+    return WARM_INDEX['index']
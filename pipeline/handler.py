@@ -9,10 +9,11 @@ def handler(event=None, context=None) -> dict:  # pylint: disable=unused-argumen
     Handler function required for lambda
     """
     try:
-        run_pipeline()
+        stages = run_pipeline()
 
         return {
-            'status': 'Pipeline ran successfully'
+            'status': 'Pipeline ran successfully',
+            'stages': stages
         }
     except Exception as e:  # pylint: disable=broad-exception-caught
         return {
@@ -0,0 +1,88 @@
+# pylint: disable=W0718, W1203
+
+"""This script predicts shaking intensity (MMI) at topic locations so topics
+can be alerted on how strongly they are likely to feel an earthquake"""
+
+import logging
+import numpy as np
+from matching import get_coordinate_arrays, get_value_array, calculate_distance_matrix
+from rules import get_topic_predicates, evaluate_predicate
+
+# Atkinson & Wald (2007) MMI attenuation coefficients for California
+C1, C2, C3, C4, C5, C6, C7 = 12.27, 2.270, 0.1304, -1.30, -0.0007070, 1.95, -0.577
+NEAR_SOURCE_TERM_KM = 14.0
+TRANSITION_DISTANCE_KM = 30.0
+MIN_MMI = 1.0
+MAX_MMI = 10.0
+MIN_TOPIC_INTENSITY = 2.0
+REACH_SEARCH_KM = 1000
+# Half the Earth's circumference, beyond which nothing is further away
+MAX_REACH_KM = 20000
+
+
+def predict_intensity(magnitude: float | np.ndarray, depth: float | np.ndarray,
+                      epicentral_distance: np.ndarray) -> np.ndarray:
+    """
+    Predicts the MMI felt at each epicentral distance (km) from an earthquake
+    of the given magnitude and depth (km). Arrays broadcast against each other.
+    """
+    hypocentral_distance = np.hypot(epicentral_distance, depth)
+    r = np.sqrt(hypocentral_distance ** 2 + NEAR_SOURCE_TERM_KM ** 2)
+    log_r = np.log10(r)
+    b = np.maximum(0, np.log10(r / TRANSITION_DISTANCE_KM))
+    mmi = (C1 + C2 * (magnitude - 6) + C3 * (magnitude - 6) ** 2 + C4 * log_r
+           + C5 * r + C6 * b + C7 * magnitude * log_r)
+    return np.clip(mmi, MIN_MMI, MAX_MMI)
+
+
+def get_intensity_reach(magnitude: float, depth: float | None,
+                        min_intensity: float = MIN_TOPIC_INTENSITY) -> int | None:
+    """
+    Gets the furthest epicentral distance, in whole km, at which the earthquake
+    is predicted to reach min_intensity. Predicted intensity falls with
+    distance, so the search starts at REACH_SEARCH_KM and doubles, up to
+    MAX_REACH_KM, while the intensity is still reached at its edge; great
+    earthquakes (M8.5+) are felt well beyond 1000km.
+    """
+    search_km = REACH_SEARCH_KM
+    while True:
+        distances = np.arange(search_km + 1)
+        reached = np.nonzero(
+            predict_intensity(magnitude, depth or 0, distances) >= min_intensity)[0]
+        if not reached.size:
+            return None
+        if reached[-1] < search_km or search_km >= MAX_REACH_KM:
+            return int(distances[reached[-1]])
+        search_km = min(2 * search_km, MAX_REACH_KM)
+
+
+def match_intensity(earthquakes: list[dict], topics: list[dict]) -> list[dict]:
+    """
+    Finds every (earthquake, topic) pair where the shaking predicted at the
+    topic reaches its min_intensity, computed for all topics at once per
+    earthquake. Missing depths are treated as surface earthquakes.
+    """
+    topics, predicates = get_topic_predicates(topics)
+    topic_lats, topic_lons = get_coordinate_arrays(topics)
+    min_intensities = get_value_array(topics, 'min_intensity')
+    min_magnitudes = get_value_array(topics, 'min_magnitude')
+
+    matches = []
+    for earthquake in earthquakes:
+        magnitude = earthquake.get('magnitude')
+        if magnitude is None:
+            continue
+        distances = calculate_distance_matrix(
+            np.array([float(earthquake['lat'])]), np.array([float(earthquake['lon'])]),
+            topic_lats, topic_lons)[0]
+        intensities = predict_intensity(magnitude, earthquake.get('depth') or 0, distances)
+        with np.errstate(invalid='ignore'):
+            fired = (intensities >= min_intensities) & (magnitude >= min_magnitudes)
+        for topic_index in np.nonzero(fired)[0]:
+            if all(evaluate_predicate(predicate, earthquake)
+                   for predicate in predicates[topic_index]):
+                matches.append({'earthquake': earthquake, 'topic': topics[topic_index],
+                                'distance': int(distances[topic_index]),
+                                'intensity': round(float(intensities[topic_index]), 1)})
+    logging.info(f"Predicted intensity at {len(topics)} topics for {len(earthquakes)} earthquakes")
+    return matches
@@ -0,0 +1,115 @@
+# pylint: disable=W0718, W1203
+
+"""This script keeps a ledger of the alerts sent for each earthquake and topic"""
+
+import logging
+from psycopg2.extensions import connection
+import psycopg2.extras
+
+
+def get_previous_deliveries(conn: connection, earthquake_ids: list[str]) -> dict[tuple, dict]:
+    """
+    Gets the alerts already sent for the earthquakes, keyed by
+    (earthquake_id, topic_id), using a single query for the whole batch
+    """
+    try:
+        if not earthquake_ids:
+            return {}
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+            query = """
+            SELECT earthquake_id, topic_id, magnitude, event_time, detected_at, published_at
+            FROM alert_deliveries
+            WHERE earthquake_id = ANY(%s);
+            """
+            cur.execute(query, (list(earthquake_ids),))
+            rows = cur.fetchall()
+        return {(row['earthquake_id'], row['topic_id']): row for row in rows}
+    except Exception as e:
+        logging.error(
+            f"An unexpected error occurred getting previous alert deliveries: {e}")
+        return {}
+
+
+def get_delivery_records(matches: list[dict], results: list[dict], detected_at) -> list[tuple]:
+    """
+    Gets the ledger rows for every match whose alert was delivered
+    """
+    delivered = {result['key']: result for result in results if result['delivered']}
+    records = []
+    for match in matches:
+        earthquake = match['earthquake']
+        key = (earthquake['earthquake_id'], match['topic']['topic_id'])
+        if key in delivered:
+            records.append((*key, earthquake['magnitude'], earthquake['time'],
+                            detected_at, delivered[key]['published_at']))
+    return records
+
+
+def get_held_records(matches: list[dict], detected_at) -> list[tuple]:
+    """
+    Gets the ledger rows for matches held back for a digest. They have no
+    publish time until the digest is published, but are already in the
+    ledger so revisions of the earthquake are not treated as new alerts.
+    """
+    return [(match['earthquake']['earthquake_id'], match['topic']['topic_id'],
+             match['earthquake']['magnitude'], match['earthquake']['time'], detected_at, None)
+            for match in matches]
+
+
+def get_digest_records(digests: list[dict], results: list[dict]) -> list[tuple]:
+    """
+    Gets the (earthquake_id, topic_id, published_at) of every event in a
+    digest which was published
+    """
+    published = {result['key'][1]: result['published_at'] for result in results
+                 if result['delivered'] and result['key'][0] == 'digest'}
+    return [(event['earthquake_id'], digest['topic_id'], published[digest['topic_id']])
+            for digest in digests if digest['topic_id'] in published
+            for event in digest['pending']]
+
+
+def record_deliveries(conn: connection, records: list[tuple]) -> None:
+    """
+    Writes the delivered alerts to the ledger in one statement,
+    replacing any earlier delivery for the same earthquake and topic
+    """
+    if not records:
+        return
+    try:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, """
+                INSERT INTO alert_deliveries
+                    (earthquake_id, topic_id, magnitude, event_time, detected_at, published_at)
+                VALUES %s
+                ON CONFLICT (earthquake_id, topic_id) DO UPDATE SET
+                    magnitude = EXCLUDED.magnitude,
+                    event_time = EXCLUDED.event_time,
+                    detected_at = EXCLUDED.detected_at,
+                    published_at = EXCLUDED.published_at;
+                """, records)
+        conn.commit()
+    except Exception as e:
+        logging.error(
+            f"An unexpected error occurred recording alert deliveries: {e}")
+        conn.rollback()
+
+
+def record_digest_deliveries(conn: connection, records: list[tuple]) -> None:
+    """
+    Sets the publish time of the ledger rows for events sent in a digest
+    """
+    if not records:
+        return
+    try:
+        with conn.cursor() as cur:
+            psycopg2.extras.execute_values(cur, """
+                UPDATE alert_deliveries AS d
+                SET published_at = r.published_at
+                FROM (VALUES %s) AS r (earthquake_id, topic_id, published_at)
+                WHERE d.earthquake_id = r.earthquake_id AND d.topic_id = r.topic_id;
+                """, records, template="(%s, %s::smallint, %s::timestamp)")
+        conn.commit()
+    except Exception as e:
+        logging.error(
+            f"An unexpected error occurred recording digest deliveries: {e}")
+        conn.rollback()
@@ -3,11 +3,14 @@
 
 import os
 import logging
+import time
 
 from psycopg2.extensions import connection, cursor
 from psycopg2 import OperationalError
 from dotenv import load_dotenv
 import psycopg2.extras
+import reverse_geocode as rg
+import pycountry_convert as pc
 
 load_dotenv()
 
@@ -21,6 +24,18 @@ STATUS = "status"
 NETWORK_ID = "network_id"
 MAGTYPE_ID = "magtype_id"
 TYPE_ID = "type_id"
+US_COUNTRY_CODE = "US"
+DATA_LOAD_CHANNEL = "data_loads"
+# Countries reverse_geocode can return that pycountry_convert has no continent for
+CONTINENT_CODE_OVERRIDES = {"EH": "AF", "PN": "OC", "SX": "NA",
+                            "TF": "AQ", "TL": "AS", "VA": "EU"}
+EARTHQUAKE_COLUMNS = ("magnitude", "lon", "lat", "depth", "time", "felt", "cdi", "mmi",
+                      "significance", "nst", "dmin", "gap", "title")
+REGION_COLUMNS = ("country_code", "continent_code", "state")
+INSERT_EARTHQUAKE_QUERY = f"""INSERT INTO earthquakes
+    (earthquake_id, alert_id, status_id, network_id, magtype_id, type_id,
+     {", ".join(EARTHQUAKE_COLUMNS)}, {", ".join(REGION_COLUMNS)})
+    VALUES ({", ".join(["%s"] * (6 + len(EARTHQUAKE_COLUMNS) + len(REGION_COLUMNS)))})"""
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s %(levelname)s %(message)s")
@@ -167,37 +182,95 @@ def get_type_id(conn: connection, cursor: cursor, earthquake_type: str, all_type
     return get_or_add_id(earthquake_type, all_types, lambda value_to_add: add_type_to_db(conn, cursor, value_to_add))
 
 
-def add_earthquake_data_to_rds(conn: connection, cursor: cursor, earthquake_data: list[dict], all_alerts: dict, all_statuses: dict, all_networks: dict, all_magtypes: dict, all_types: dict) -> None:
-    """Adds the provided data to the 'earthquakes' table"""
+def get_continent_code(country_code: str) -> str | None:
+    """Gets the continent code for a country code, or None if it has no continent"""
+    if country_code in CONTINENT_CODE_OVERRIDES:
+        return CONTINENT_CODE_OVERRIDES[country_code]
     try:
-        for earthquake in earthquake_data:
-            alert_id = all_alerts.get(earthquake.get(ALERT))
-            status_id = all_statuses.get(earthquake["status"])
-            network_id = get_network_id(
-                conn, cursor, earthquake["network"], all_networks)
-            magtype_id = get_magtype_id(
-                conn, cursor, earthquake["magtype"], all_magtypes)
-            type_id = get_type_id(
-                conn, cursor, earthquake["earthquake_type"], all_types)
-
-            cursor.execute("""INSERT INTO earthquakes (earthquake_id, alert_id, status_id, network_id, magtype_id, type_id, magnitude, lon, lat, depth, time, felt, cdi, mmi, significance, nst, dmin, gap, title)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                            """, (earthquake["earthquake_id"], alert_id, status_id, network_id, magtype_id, type_id,
-                                  earthquake["magnitude"], earthquake["lon"], earthquake["lat"], earthquake["depth"],
-                                  earthquake["time"], earthquake["felt"], earthquake["cdi"], earthquake["mmi"],
-                                  earthquake["significance"], earthquake["nst"], earthquake["dmin"], earthquake["gap"], earthquake["title"]))
+        return pc.country_alpha2_to_continent_code(country_code)
+    except KeyError:
+        return None
+
+
+def get_regions(earthquake_data: list[dict]) -> list[dict]:
+    """Reverse geocodes a batch of earthquakes in one lookup, giving the country code,
+    continent code and (for US events) state of each"""
+    try:
+        locations = rg.search([(float(earthquake["lat"]), float(earthquake["lon"]))
+                               for earthquake in earthquake_data]) if earthquake_data else []
+    except Exception as e:
+        logging.error(f"Unable to reverse geocode earthquakes: {e}")
+        return [{"country_code": None, "continent_code": None, "state": None}
+                for _ in earthquake_data]
+    return [{"country_code": location.get("country_code"),
+             "continent_code": get_continent_code(location.get("country_code")),
+             "state": location.get("state")
+             if location.get("country_code") == US_COUNTRY_CODE else None}
+            for location in locations]
+
+
+def get_earthquake_row(earthquake: dict, lookup_ids: tuple, region: dict) -> tuple:
+    """Puts an earthquake's values in the column order of INSERT_EARTHQUAKE_QUERY, with
+    lookup_ids holding its alert, status, network, magtype and type IDs"""
+    return (earthquake["earthquake_id"], *lookup_ids,
+            *(earthquake[column] for column in EARTHQUAKE_COLUMNS),
+            *(region[column] for column in REGION_COLUMNS))
+
+
+def add_earthquake_data_to_rds(conn: connection, cursor: cursor, earthquake_data: list[dict],
+                               all_alerts: dict, all_statuses: dict, all_networks: dict,
+                               all_magtypes: dict, all_types: dict, deadline: float = None) -> int:
+    """Adds the provided data to the 'earthquakes' table, returning how many earthquakes were added.
+    Stops before the next earthquake once the time.monotonic() deadline has passed"""
+    added = 0
+    try:
+        regions = get_regions(earthquake_data)
+        for earthquake, region in zip(earthquake_data, regions):
+            if deadline is not None and time.monotonic() >= deadline:
+                logging.error(
+                    f"Load deadline passed, {len(earthquake_data) - added} earthquakes not added")
+                break
+            lookup_ids = (all_alerts.get(earthquake.get(ALERT)),
+                          all_statuses.get(earthquake["status"]),
+                          get_network_id(conn, cursor, earthquake["network"], all_networks),
+                          get_magtype_id(conn, cursor, earthquake["magtype"], all_magtypes),
+                          get_type_id(conn, cursor, earthquake["earthquake_type"], all_types))
+
+            cursor.execute(INSERT_EARTHQUAKE_QUERY,
+                           get_earthquake_row(earthquake, lookup_ids, region))
 
             conn.commit()
-            logging.info(f"Successfully added earthquake {earthquake['earthquake_id']} to the database")
+            added += 1
+            logging.info(
+                f"Successfully added earthquake {earthquake['earthquake_id']} to the database")
     except (psycopg2.IntegrityError, psycopg2.OperationalError, psycopg2.DatabaseError) as e:
         logging.error(f"Database error: {e}")
         conn.rollback()
     except Exception as e:
         logging.error(f"Unexpected error while adding earthquake data: {e}")
         conn.rollback()
+    return added
+
+
+def record_data_load(conn: connection, cursor: cursor, earthquake_count: int) -> int | None:
+    """Records a load in the 'data_loads' table, moving the watermark the API's
+    conditional responses are based on, and notifies listening APIs so they can
+    clear their result caches. Returns the new load_id"""
+    try:
+        cursor.execute("""INSERT INTO data_loads (earthquake_count)
+                          VALUES (%s) RETURNING load_id""", (earthquake_count,))
+        load_id = cursor.fetchone()["load_id"]
+        cursor.execute("SELECT pg_notify(%s, %s)", (DATA_LOAD_CHANNEL, str(load_id)))
+        conn.commit()
+        logging.info(f"Recorded data load {load_id} of {earthquake_count} earthquakes")
+        return load_id
+    except Exception as e:
+        logging.error(f"Unable to record data load: {e}")
+        conn.rollback()
+        return None
 
 
-def load_process(transformed_data: list[dict]) -> None:
+def load_process(transformed_data: list[dict], deadline: float = None) -> None:
     conn = get_connection(DB_HOST, DB_NAME, DB_USERNAME, DB_PASSWORD, DB_PORT)
     if conn:
         cur = get_cursor(conn)
@@ -207,8 +280,11 @@ def load_process(transformed_data: list[dict]) -> None:
             all_statuses = get_all_statuses(cur)
             all_magtypes = get_all_magtypes(cur)
             all_types = get_all_types(cur)
-            add_earthquake_data_to_rds(
-                conn, cur, transformed_data, all_alerts, all_statuses, all_networks, all_magtypes, all_types)
+            added = add_earthquake_data_to_rds(
+                conn, cur, transformed_data, all_alerts, all_statuses, all_networks,
+                all_magtypes, all_types, deadline)
+            if added:
+                record_data_load(conn, cur, added)
     cur.close()
     conn.close()
 
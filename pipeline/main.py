@@ -2,13 +2,75 @@
 
 """Main file to run the entire ETL process"""
 
+from os import environ as ENV
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import logging
+import time
+from publisher import has_passed
 from extract import extract_process
 from transform import transform_process
 from load import load_process
 from sns import sns_alert_system
 
-def run_pipeline():
+DEFAULT_STAGE_TIMEOUT = 40
+
+
+def run_stage(stage_function, transformed_data: list[dict], error_message: str,
+              deadline: float = None) -> dict:
+    """
+    Runs a pipeline stage, returning whether it succeeded and how long it took.
+    The stage is given the deadline to check between batches of work
+    """
+    start = time.monotonic()
+    try:
+        stage_function(transformed_data, deadline=deadline)
+        return {'status': 'succeeded', 'duration': time.monotonic() - start}
+    except Exception as e:
+        logging.error(f'{error_message}: {e}')
+        return {'status': 'failed', 'duration': time.monotonic() - start, 'error': str(e)}
+
+
+def run_alert_and_load_stages(transformed_data: list[dict], timeout: float) -> dict:
+    """
+    Sends SNS alerts and loads the data at the same time, so the tick takes as
+    long as the slower stage rather than both. Each stage has its own error
+    handling, and neither is waited on past the shared timeout.
+    A thread cannot be stopped from outside, so a stage still running at the
+    timeout is left behind; the stages stop themselves instead, as they check
+    the deadline before each SNS publish and each earthquake insert. The work
+    already in flight finishes, e.g. the ledger records alerts that were sent.
+    """
+    start = time.monotonic()
+    deadline = start + timeout
+    executor = ThreadPoolExecutor(max_workers=2)
+    futures = {
+        'alerts': executor.submit(run_stage, sns_alert_system, transformed_data,
+                                  'Error when sending SNS alerts', deadline),
+        'load': executor.submit(run_stage, load_process, transformed_data,
+                                'Error during load', deadline)
+    }
+
+    stages = {}
+    for stage, future in futures.items():
+        try:
+            stages[stage] = future.result(timeout=max(0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            logging.error(f'The {stage} stage did not finish within {timeout}s')
+            stages[stage] = {'status': 'timed out', 'duration': time.monotonic() - start}
+    executor.shutdown(wait=False, cancel_futures=True)
+    if has_passed(deadline):
+        logging.warning('Stages still running past the deadline will stop before their next batch')
+
+    for stage, result in stages.items():
+        logging.info(f"{stage} stage {result['status']} in {result['duration']:.2f}s")
+    return stages
+
+
+def run_pipeline() -> dict | None:
+    """
+    Runs extract and transform, then the alert and load stages concurrently.
+    Returns the status and duration of the alert and load stages.
+    """
     logging.basicConfig(level=logging.INFO,
                         format='%(asctime)s - %(levelname)s - %(message)s')
     logging.info('Starting pipeline')
@@ -17,30 +79,23 @@ def run_pipeline():
         extracted_data = extract_process()
     except Exception as e:
         logging.error(f'Error during extraction: {e}')
-        return
-    
+        return None
+
     if extracted_data:
         try:
             transformed_data = transform_process(extracted_data)
         except Exception as e:
             logging.error(f'Error during transform: {e}')
-            return
-
-        try:
-            sns_alert_system(transformed_data)
+            return None
 
-        except Exception as e:
-            logging.error(f'Error when sending SNS alerts: {e}')
-        
-        try:
-            load_process(transformed_data)
+        stages = run_alert_and_load_stages(
+            transformed_data, float(ENV.get('STAGE_TIMEOUT_SECONDS', DEFAULT_STAGE_TIMEOUT)))
+        if stages['load']['status'] == 'succeeded':
             logging.info('Pipeline completed running')
+        return stages
 
-        except Exception as e:
-            logging.error(f'Error during load: {e}')
+    return None
 
-    else:
-        return
 
 if __name__ == "__main__":
     run_pipeline()
@@ -0,0 +1,84 @@
+"""This file holds the vectorised distance maths used to match earthquakes to topics"""
+
+import math
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = 111.19
+MAX_LAT = 90.0
+MIN_LON = -180.0
+MAX_LON = 180.0
+
+
+def get_coordinate_arrays(locations: list[dict]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Gets the latitudes and longitudes of a list of topics or earthquakes
+    as float arrays
+    """
+    lats = np.array([float(location['lat']) for location in locations], dtype=float)
+    lons = np.array([float(location['lon']) for location in locations], dtype=float)
+    return lats, lons
+
+
+def get_value_array(items: list[dict], key: str) -> np.ndarray:
+    """
+    Gets a numeric value from every item as a float array, with
+    missing values stored as NaN
+    """
+    return np.array([np.nan if item.get(key) is None else float(item[key])
+                     for item in items], dtype=float)
+
+
+def calculate_distance_matrix(eq_lats: np.ndarray, eq_lons: np.ndarray,
+                              topic_lats: np.ndarray, topic_lons: np.ndarray) -> np.ndarray:
+    """
+    Calculates the haversine distance in km between every earthquake (rows)
+    and every topic (columns)
+    """
+    eq_lats = np.radians(eq_lats)[:, np.newaxis]
+    eq_lons = np.radians(eq_lons)[:, np.newaxis]
+    topic_lats = np.radians(topic_lats)[np.newaxis, :]
+    topic_lons = np.radians(topic_lons)[np.newaxis, :]
+
+    d = (np.sin((topic_lats - eq_lats) * 0.5) ** 2
+         + np.cos(eq_lats) * np.cos(topic_lats) * np.sin((topic_lons - eq_lons) * 0.5) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(d, 0, 1)))
+
+
+def get_match_matrix(distances: np.ndarray, radii: np.ndarray,
+                     magnitudes: np.ndarray, min_magnitudes: np.ndarray) -> np.ndarray:
+    """
+    Gets a boolean matrix of which topics are interested in which earthquakes,
+    i.e. the topic is within the earthquake's radius and its magnitude is high enough
+    """
+    with np.errstate(invalid='ignore'):
+        in_range = np.floor(distances) <= radii[:, np.newaxis]
+        strong_enough = magnitudes[:, np.newaxis] >= min_magnitudes[np.newaxis, :]
+    return in_range & strong_enough
+
+
+def get_bounding_boxes(lat: float, lon: float, radius_km: float) -> list[tuple]:
+    """
+    Gets the (min_lat, max_lat, min_lon, max_lon) boxes which cover every point
+    within radius_km of a coordinate, split in two if it crosses the antimeridian
+    """
+    lat_delta = radius_km / KM_PER_DEGREE_LAT
+    min_lat = max(lat - lat_delta, -MAX_LAT)
+    max_lat = min(lat + lat_delta, MAX_LAT)
+    widest_lat = max(abs(min_lat), abs(max_lat))
+    if widest_lat >= MAX_LAT:
+        return [(min_lat, max_lat, MIN_LON, MAX_LON)]
+
+    lon_delta = lat_delta / math.cos(math.radians(widest_lat))
+    if lon_delta >= MAX_LON:
+        return [(min_lat, max_lat, MIN_LON, MAX_LON)]
+
+    min_lon = lon - lon_delta
+    max_lon = lon + lon_delta
+    if min_lon < MIN_LON:
+        return [(min_lat, max_lat, min_lon + 360, MAX_LON),
+                (min_lat, max_lat, MIN_LON, max_lon)]
+    if max_lon > MAX_LON:
+        return [(min_lat, max_lat, min_lon, MAX_LON),
+                (min_lat, max_lat, MIN_LON, max_lon - 360)]
+    return [(min_lat, max_lat, min_lon, max_lon)]
@@ -0,0 +1,201 @@
+# pylint: disable=W0718, W1203, R0903, R0913, R0917
+
+"""This script publishes SNS messages concurrently while staying within the account's rate limits.
+Its rate limiter and retry helpers are also used by the dashboard's bulk import"""
+
+from os import environ as ENV
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import logging
+import random
+import threading
+import time
+import math
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+DEFAULT_MAX_WORKERS = 10
+DEFAULT_PUBLISH_RATE = 100.0
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BASE_DELAY = 0.1
+MAX_DELAY = 5.0
+THROTTLING_ERROR_CODES = {"Throttling", "ThrottlingException", "ThrottledException",
+                          "TooManyRequestsException", "RequestLimitExceeded",
+                          "KMSThrottlingException"}
+# publish_with_retry does the retrying, so botocore should make one attempt per call
+SNS_CLIENT_CONFIG = Config(retries={'total_max_attempts': 1})
+
+
+class TokenBucket:
+    """
+    A thread safe token bucket which allows `rate` acquisitions per second
+    on average, with bursts of up to `capacity`
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        if not rate > 0:
+            raise ValueError(f"Token bucket rate must be positive, got {rate}")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Blocks until a token is available, returning how long it waited
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+def get_publish_rate() -> float:
+    """
+    Gets SNS_PUBLISH_RATE, falling back to the default if it is not a
+    positive number
+    """
+    value = ENV.get("SNS_PUBLISH_RATE", DEFAULT_PUBLISH_RATE)
+    try:
+        rate = float(value)
+        if rate > 0 and math.isfinite(rate):
+            return rate
+    except ValueError:
+        pass
+    logging.error(f"Invalid SNS_PUBLISH_RATE {value!r}, using {DEFAULT_PUBLISH_RATE}")
+    return DEFAULT_PUBLISH_RATE
+
+
+def get_error_code(error: Exception) -> str | None:
+    """
+    Gets the AWS error code from a botocore ClientError
+    """
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code')
+    return None
+
+
+def get_backoff_delay(attempt: int, base_delay: float) -> float:
+    """
+    Gets a 'full jitter' exponential backoff delay for a retry attempt
+    """
+    return random.uniform(0, min(MAX_DELAY, base_delay * 2 ** attempt))
+
+
+def has_passed(deadline: float | None) -> bool:
+    """
+    Checks whether a time.monotonic() deadline has passed
+    """
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def call_with_retry(function, request: dict, rate_limiter: TokenBucket,
+                    max_retries: int, base_delay: float, deadline: float = None) -> dict:
+    """
+    Makes a rate limited AWS call, retrying throttling errors with jittered
+    backoff, and returns its response or the exception it last raised.
+    No attempt is started once the deadline has passed
+    """
+    outcome = {'response': None, 'error': None, 'attempts': 0, 'throttled': 0}
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire()
+        if has_passed(deadline):
+            outcome['error'] = TimeoutError("deadline passed before the call was made")
+            break
+        outcome['attempts'] += 1
+        try:
+            outcome['response'] = function(**request)
+            outcome['error'] = None
+            return outcome
+        except Exception as e:
+            outcome['error'] = e
+            if get_error_code(e) not in THROTTLING_ERROR_CODES:
+                break
+            outcome['throttled'] += 1
+            if attempt < max_retries:
+                time.sleep(get_backoff_delay(attempt, base_delay))
+    return outcome
+
+
+def map_concurrently(function, items: list, max_workers: int) -> list:
+    """
+    Calls the function on every item through a bounded thread pool, returning
+    the results in order
+    """
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(function, items))
+
+
+def publish_with_retry(sns_client: boto3.client, message: dict, rate_limiter: TokenBucket,
+                       max_retries: int, base_delay: float, deadline: float = None) -> dict:
+    """
+    Publishes a single message, retrying throttling errors with jittered backoff
+    """
+    outcome = call_with_retry(sns_client.publish,
+                              {'TargetArn': message['arn'], 'Message': message['message'],
+                               'Subject': message['subject']},
+                              rate_limiter, max_retries, base_delay, deadline)
+    result = {'key': message.get('key'), 'delivered': outcome['error'] is None,
+              'message_id': None, 'attempts': outcome['attempts'],
+              'throttled': outcome['throttled'], 'published_at': None, 'latency': None,
+              'error': None}
+    if result['delivered']:
+        result['message_id'] = outcome['response'].get('MessageId')
+        result['published_at'] = datetime.now(timezone.utc)
+        if message.get('event_time') is not None:
+            result['latency'] = (result['published_at']
+                                 - message['event_time']).total_seconds()
+        return result
+
+    result['error'] = get_error_code(outcome['error']) or str(outcome['error'])
+    logging.error(
+        f"Failed to publish message to {message['arn']}: {result['error']}")
+    return result
+
+
+def publish_messages(sns_client: boto3.client, messages: list[dict], max_workers: int = None,
+                     publish_rate: float = None, max_retries: int = None,
+                     base_delay: float = DEFAULT_BASE_DELAY, deadline: float = None) -> dict:
+    """
+    Publishes messages through a bounded thread pool and a shared rate limiter,
+    returning a summary of the deliveries. Each message is a dict with an arn,
+    subject, message and an optional key used to identify its result.
+    Messages not yet sent when the time.monotonic() deadline passes are
+    reported as failed rather than published late.
+    """
+    max_workers = max_workers or int(ENV.get("SNS_MAX_WORKERS", DEFAULT_MAX_WORKERS))
+    publish_rate = publish_rate or get_publish_rate()
+    if max_retries is None:
+        max_retries = int(ENV.get("SNS_MAX_RETRIES", DEFAULT_MAX_RETRIES))
+
+    rate_limiter = TokenBucket(publish_rate)
+    start = time.monotonic()
+    results = map_concurrently(
+        lambda message: publish_with_retry(
+            sns_client, message, rate_limiter, max_retries, base_delay, deadline),
+        messages, max_workers)
+
+    summary = {
+        'attempted': len(results),
+        'delivered': sum(result['delivered'] for result in results),
+        'failed': sum(not result['delivered'] for result in results),
+        'throttled': sum(result['throttled'] for result in results),
+        'duration': time.monotonic() - start,
+        'results': results
+    }
+    logging.info(f"Published {summary['delivered']}/{summary['attempted']} messages "
+                 f"in {summary['duration']:.2f}s ({summary['throttled']} throttled)")
+    return summary
@@ -0,0 +1,232 @@
+# pylint: disable=W0718, W1203, R0903
+
+"""This script compiles declarative subscription rules into an index that
+matches earthquakes against topics without checking every topic"""
+
+import bisect
+import logging
+import math
+import numpy as np
+from matching import get_bounding_boxes, calculate_distance_matrix
+from transform import PAGER_ALERT_LEVELS
+
+BUCKET_DEGREES = 2.0
+BITS_PER_WORD = 64
+
+
+def get_rule_predicates(rules: dict | None) -> list[tuple]:
+    """
+    Turns a topic's declarative rules into hashable predicates, e.g.
+    {"max_depth": 70, "types": ["earthquake"]} becomes
+    [('max_depth', 70.0), ('types', frozenset({'earthquake'}))]
+    """
+    predicates = []
+    for field, value in (rules or {}).items():
+        if value is None:
+            continue
+        if field in ('min_depth', 'max_depth', 'min_mmi'):
+            predicates.append((field, float(value)))
+        elif field == 'min_felt':
+            predicates.append((field, int(value)))
+        elif field == 'min_alert':
+            if value not in PAGER_ALERT_LEVELS:
+                raise ValueError(f"Unknown PAGER alert level: {value}")
+            predicates.append((field, PAGER_ALERT_LEVELS.index(value)))
+        elif field == 'types':
+            if not isinstance(value, list):
+                raise ValueError(f"Subscription rule types must be a list, got {value!r}")
+            predicates.append((field, frozenset(value)))
+        else:
+            raise ValueError(f"Unknown subscription rule: {field}")
+    return predicates
+
+
+def get_topic_predicates(topics: list[dict]) -> tuple[list[dict], list[list[tuple]]]:
+    """
+    Compiles every topic's rules, skipping topics whose rules are malformed
+    so that one bad row cannot stop alerts for every other topic
+    """
+    valid_topics = []
+    predicates = []
+    for topic in topics:
+        try:
+            predicates.append(get_rule_predicates(topic.get('rules')))
+        except (ValueError, TypeError) as e:
+            logging.error(f"Skipping topic {topic.get('topic_id')} with invalid rules: {e}")
+            continue
+        valid_topics.append(topic)
+    return valid_topics, predicates
+
+
+def is_at_least(earthquake_field: str):
+    """
+    Makes a check that an earthquake value is present and at least the predicate's value
+    """
+    return lambda earthquake, value: (earthquake.get(earthquake_field) is not None
+                                      and earthquake[earthquake_field] >= value)
+
+
+def is_at_most(earthquake_field: str):
+    """
+    Makes a check that an earthquake value is present and at most the predicate's value
+    """
+    return lambda earthquake, value: (earthquake.get(earthquake_field) is not None
+                                      and earthquake[earthquake_field] <= value)
+
+
+def meets_alert_level(earthquake: dict, value: int) -> bool:
+    """
+    Checks that an earthquake's PAGER alert is at least the given level
+    """
+    return (earthquake.get('alert') in PAGER_ALERT_LEVELS
+            and PAGER_ALERT_LEVELS.index(earthquake['alert']) >= value)
+
+
+PREDICATE_CHECKS = {
+    'min_depth': is_at_least('depth'),
+    'max_depth': is_at_most('depth'),
+    'min_mmi': is_at_least('mmi'),
+    'min_felt': is_at_least('felt'),
+    'min_alert': meets_alert_level,
+    'types': lambda earthquake, value: earthquake.get('earthquake_type') in value
+}
+
+
+def evaluate_predicate(predicate: tuple, earthquake: dict) -> bool:
+    """
+    Checks whether an earthquake satisfies a single predicate. Missing
+    earthquake values never satisfy a predicate.
+    """
+    field, value = predicate
+    check = PREDICATE_CHECKS.get(field)
+    return check is not None and check(earthquake, value)
+
+
+def get_candidates(bucket: dict, magnitude: float, missing_predicates: np.ndarray) -> np.ndarray:
+    """
+    Gets the positions in a bucket of the topics whose min_magnitude and
+    rules the earthquake satisfies, before checking their distance
+    """
+    candidates = bisect.bisect_right(bucket['min_magnitudes'], magnitude)
+    satisfied = ~np.any(bucket['masks'][:candidates] & missing_predicates, axis=1)
+    return np.nonzero(satisfied)[0]
+
+
+def get_bucket(lat: float, lon: float) -> tuple[int, int]:
+    """
+    Gets the spatial bucket a coordinate falls in
+    """
+    return (math.floor(lat / BUCKET_DEGREES), math.floor(lon / BUCKET_DEGREES))
+
+
+def get_buckets_in_radius(lat: float, lon: float, radius_km: float) -> set[tuple[int, int]]:
+    """
+    Gets every spatial bucket which overlaps the radius around a coordinate
+    """
+    buckets = set()
+    for min_lat, max_lat, min_lon, max_lon in get_bounding_boxes(lat, lon, radius_km):
+        min_bucket = get_bucket(min_lat, min_lon)
+        max_bucket = get_bucket(max_lat, max_lon)
+        buckets.update((lat_bucket, lon_bucket)
+                       for lat_bucket in range(min_bucket[0], max_bucket[0] + 1)
+                       for lon_bucket in range(min_bucket[1], max_bucket[1] + 1))
+    return buckets
+
+
+class RuleIndex:
+    """
+    A compiled decision structure for subscription rules:
+    spatial bucket -> topics sorted by min_magnitude -> predicate bitmasks.
+    Every distinct predicate is given a bit; a topic matches an earthquake when
+    every bit in its mask is also set in the earthquake's mask.
+    """
+
+    def __init__(self, topics: list[dict]):
+        topics, rule_predicates = get_topic_predicates(topics)
+        self.topics = topics
+        self.predicates = []
+        predicate_bits = {}
+        topic_predicates = []
+        for predicates in rule_predicates:
+            bits = []
+            for predicate in predicates:
+                if predicate not in predicate_bits:
+                    predicate_bits[predicate] = len(self.predicates)
+                    self.predicates.append(predicate)
+                bits.append(predicate_bits[predicate])
+            topic_predicates.append(bits)
+
+        self.words = max(1, math.ceil(len(self.predicates) / BITS_PER_WORD))
+        masks = np.zeros((len(topics), self.words), dtype=np.uint64)
+        for topic_index, bits in enumerate(topic_predicates):
+            for bit in bits:
+                masks[topic_index, bit // BITS_PER_WORD] |= np.uint64(1 << (bit % BITS_PER_WORD))
+
+        bucket_members = {}
+        for topic_index, topic in enumerate(topics):
+            bucket_members.setdefault(
+                get_bucket(float(topic['lat']), float(topic['lon'])), []).append(topic_index)
+
+        self.buckets = {}
+        for bucket, members in bucket_members.items():
+            members.sort(key=lambda topic_index: float(topics[topic_index]['min_magnitude']))
+            self.buckets[bucket] = {
+                'topic_indices': np.array(members),
+                'min_magnitudes': [float(topics[index]['min_magnitude']) for index in members],
+                'lats': np.array([float(topics[index]['lat']) for index in members]),
+                'lons': np.array([float(topics[index]['lon']) for index in members]),
+                'masks': masks[members]
+            }
+
+    def get_earthquake_mask(self, earthquake: dict) -> np.ndarray:
+        """
+        Gets the bitmask of every predicate the earthquake satisfies
+        """
+        mask = np.zeros(self.words, dtype=np.uint64)
+        for bit, predicate in enumerate(self.predicates):
+            if evaluate_predicate(predicate, earthquake):
+                mask[bit // BITS_PER_WORD] |= np.uint64(1 << (bit % BITS_PER_WORD))
+        return mask
+
+    def match_earthquake(self, earthquake: dict, radius: float) -> list[dict]:
+        """
+        Finds the topics interested in one earthquake within the given radius
+        """
+        magnitude = earthquake['magnitude']
+        lat, lon = float(earthquake['lat']), float(earthquake['lon'])
+        missing_predicates = ~self.get_earthquake_mask(earthquake)
+        matches = []
+        # distances are floored before comparing, so look up to 1km further
+        for bucket_key in get_buckets_in_radius(lat, lon, radius + 1):
+            bucket = self.buckets.get(bucket_key)
+            if bucket is None:
+                continue
+            candidate_indices = get_candidates(bucket, magnitude, missing_predicates)
+            if candidate_indices.size == 0:
+                continue
+            distances = calculate_distance_matrix(
+                np.array([lat]), np.array([lon]),
+                bucket['lats'][candidate_indices], bucket['lons'][candidate_indices])[0]
+            for candidate, distance in zip(candidate_indices, distances):
+                if math.floor(distance) <= radius:
+                    matches.append({'earthquake': earthquake,
+                                    'topic': self.topics[bucket['topic_indices'][candidate]],
+                                    'distance': int(distance)})
+        return matches
+
+    def match(self, earthquakes: list[dict], radii: list[float | None]) -> list[dict]:
+        """
+        Finds every (earthquake, topic) match for a batch, given each
+        earthquake's alert radius in km
+        """
+        matches = []
+        for earthquake, radius in zip(earthquakes, radii):
+            if radius is None or earthquake.get('magnitude') is None:
+                continue
+            try:
+                matches.extend(self.match_earthquake(earthquake, radius))
+            except Exception as e:
+                logging.error(
+                    f"An unexpected error occurred matching rules for "
+                    f"{earthquake.get('earthquake_id')}: {e}")
+        return matches
@@ -0,0 +1,322 @@
+# pylint: disable=W0718, W1203, R0903
+
+"""This script shards alert matching across worker processes by geohash
+prefix. A coordinator routes each earthquake only to the workers holding
+shards within its maximum alert distance and merges their matches."""
+
+from os import environ as ENV
+import logging
+import math
+import multiprocessing
+import queue
+import time
+from dotenv import load_dotenv
+import psycopg2.extras
+from matching import get_bounding_boxes
+from rules import RuleIndex
+from geofence import get_region_geometry, get_geofence_index
+from intensity import get_intensity_reach, match_intensity
+from sns import (get_connection, get_notification_distance, split_topics,
+                 find_geofence_matches, sns_alert_system)
+
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+DEFAULT_SHARD_PRECISION = 2
+DEFAULT_SHARD_WORKERS = 4
+DEFAULT_MATCH_TIMEOUT = 30
+
+
+def encode_geohash(lat: float, lon: float, precision: int) -> str:
+    """
+    Encodes a coordinate as a geohash of the given length
+    """
+    lat_range, lon_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash, bits, character, even_bit = [], 0, 0, True
+    while len(geohash) < precision:
+        value, value_range = (lon, lon_range) if even_bit else (lat, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        character <<= 1
+        if value >= middle:
+            character |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        even_bit = not even_bit
+        bits += 1
+        if bits == 5:
+            geohash.append(GEOHASH_ALPHABET[character])
+            bits, character = 0, 0
+    return "".join(geohash)
+
+
+def get_geohash_cell_size(precision: int) -> tuple[float, float]:
+    """
+    Gets the (height, width) in degrees of a geohash cell
+    """
+    lon_bits = math.ceil(5 * precision / 2)
+    lat_bits = math.floor(5 * precision / 2)
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def get_prefixes_in_box(min_lat: float, max_lat: float, min_lon: float, max_lon: float,
+                        precision: int) -> set[str]:
+    """
+    Gets every geohash prefix whose cell overlaps a bounding box
+    """
+    height, width = get_geohash_cell_size(precision)
+    first_row = math.floor((min_lat + 90) / height)
+    last_row = min(math.floor((max_lat + 90) / height), round(180 / height) - 1)
+    first_column = math.floor((min_lon + 180) / width)
+    last_column = min(math.floor((max_lon + 180) / width), round(360 / width) - 1)
+    return {encode_geohash(-90 + (row + 0.5) * height, -180 + (column + 0.5) * width, precision)
+            for row in range(first_row, last_row + 1)
+            for column in range(first_column, last_column + 1)}
+
+
+def get_topic_prefixes(topic: dict, precision: int) -> set[str]:
+    """
+    Gets the shards a topic belongs to: the cell of its location, or every
+    cell its region's bounding box overlaps
+    """
+    if topic.get('region'):
+        geometry = get_region_geometry(topic['region'])
+        if geometry is None:
+            return set()
+        min_lon, min_lat, max_lon, max_lat = geometry.bounds
+        return get_prefixes_in_box(min_lat, max_lat, min_lon, max_lon, precision)
+    return {encode_geohash(float(topic['lat']), float(topic['lon']), precision)}
+
+
+def get_max_alert_distance(earthquake: dict) -> float | None:
+    """
+    Gets the furthest any topic could be alerted about an earthquake, by
+    radius or predicted intensity
+    """
+    magnitude = earthquake.get('magnitude')
+    if not isinstance(magnitude, (int, float)):
+        return None
+    return max(get_notification_distance(magnitude) or 0,
+               get_intensity_reach(magnitude, earthquake.get('depth')) or 0) + 1
+
+
+def get_earthquake_prefixes(earthquake: dict, precision: int) -> set[str]:
+    """
+    Gets every shard within an earthquake's maximum alert distance
+    """
+    distance = get_max_alert_distance(earthquake)
+    if distance is None:
+        return set()
+    prefixes = set()
+    for box in get_bounding_boxes(float(earthquake['lat']), float(earthquake['lon']), distance):
+        prefixes.update(get_prefixes_in_box(*box, precision))
+    return prefixes
+
+
+def assign_shards(shard_sizes: dict[str, int], worker_count: int) -> dict[str, int]:
+    """
+    Assigns shards to workers, largest first onto the least loaded worker,
+    so dense regions are spread out
+    """
+    loads = [0] * worker_count
+    assignments = {}
+    for prefix, size in sorted(shard_sizes.items(), key=lambda shard: (-shard[1], shard[0])):
+        worker = loads.index(min(loads))
+        assignments[prefix] = worker
+        loads[worker] += size
+    return assignments
+
+
+class ShardMatcher:
+    """
+    The indexes for one worker's topics, built once when the worker starts
+    """
+
+    def __init__(self, topics: list[dict]):
+        point_topics, self.region_topics, self.intensity_topics = split_topics(topics)
+        self.rule_index = RuleIndex(point_topics)
+        if self.region_topics:
+            get_geofence_index(self.region_topics)
+
+    def match(self, earthquakes: list[dict]) -> list[dict]:
+        """
+        Finds the matches between earthquakes and this worker's topics
+        """
+        radii = [get_notification_distance(earthquake.get('magnitude'))
+                 for earthquake in earthquakes]
+        matches = self.rule_index.match(earthquakes, radii)
+        matches.extend(find_geofence_matches(earthquakes, self.region_topics))
+        if self.intensity_topics:
+            matches.extend(match_intensity(earthquakes, self.intensity_topics))
+        return matches
+
+
+def run_worker(worker_id: int, topics: list[dict],
+               requests: multiprocessing.Queue, results: multiprocessing.Queue) -> None:
+    """
+    Runs an alert worker: matches each batch of earthquakes from its request
+    queue against its shards, until it is sent None
+    """
+    matcher = ShardMatcher(topics)
+    results.put(('ready', worker_id, len(topics)))
+    while (request := requests.get()) is not None:
+        batch_id, earthquakes = request
+        try:
+            matches = [{'earthquake_id': match['earthquake']['earthquake_id'],
+                        **{key: value for key, value in match.items() if key != 'earthquake'}}
+                       for match in matcher.match(earthquakes)]
+            results.put((batch_id, worker_id, matches))
+        except Exception as e:
+            logging.error(f"An unexpected error occurred in alert worker {worker_id}: {e}")
+            results.put((batch_id, worker_id, []))
+
+
+def merge_matches(earthquakes: list[dict], worker_matches: list[list[dict]]) -> list[dict]:
+    """
+    Merges the workers' matches, dropping duplicates for region topics held
+    by several shards and putting each earthquake back in its matches
+    """
+    earthquakes_by_id = {earthquake['earthquake_id']: earthquake for earthquake in earthquakes}
+    merged, seen = [], set()
+    for matches in worker_matches:
+        for match in matches:
+            key = (match['earthquake_id'], match['topic']['topic_id'])
+            if key not in seen:
+                seen.add(key)
+                merged.append({'earthquake': earthquakes_by_id[match.pop('earthquake_id')],
+                               **match})
+    return merged
+
+
+class ShardCoordinator:
+    """
+    Partitions topics by geohash prefix across worker processes, using
+    multiprocessing queues as a local stand-in for a message queue
+    """
+
+    def __init__(self, topics: list[dict], worker_count: int,
+                 precision: int = DEFAULT_SHARD_PRECISION):
+        self.precision = precision
+        shard_topics = {}
+        for topic in topics:
+            for prefix in get_topic_prefixes(topic, precision):
+                shard_topics.setdefault(prefix, []).append(topic)
+        self.shard_workers = assign_shards(
+            {prefix: len(members) for prefix, members in shard_topics.items()}, worker_count)
+
+        worker_topics = [{} for _ in range(worker_count)]
+        for prefix, members in shard_topics.items():
+            worker_topics[self.shard_workers[prefix]].update(
+                (topic['topic_id'], topic) for topic in members)
+
+        self.results = multiprocessing.Queue()
+        self.requests = [multiprocessing.Queue() for _ in range(worker_count)]
+        self.workers = [multiprocessing.Process(
+            target=run_worker, args=(worker_id, list(worker_topics[worker_id].values()),
+                                     self.requests[worker_id], self.results), daemon=True)
+            for worker_id in range(worker_count)]
+        self.batches = 0
+
+    def start(self, timeout: float = DEFAULT_MATCH_TIMEOUT) -> None:
+        """
+        Starts the workers and waits for each to build its indexes
+        """
+        for worker in self.workers:
+            worker.start()
+        for _ in self.workers:
+            self.results.get(timeout=timeout)
+
+    def close(self) -> None:
+        """
+        Stops the workers
+        """
+        for requests in self.requests:
+            requests.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def route(self, earthquakes: list[dict]) -> dict[int, list[dict]]:
+        """
+        Gets the earthquakes each worker needs to see
+        """
+        routes = {}
+        for earthquake in earthquakes:
+            workers = {self.shard_workers[prefix]
+                       for prefix in get_earthquake_prefixes(earthquake, self.precision)
+                       if prefix in self.shard_workers}
+            for worker in workers:
+                routes.setdefault(worker, []).append(earthquake)
+        return routes
+
+    def send(self, earthquakes: list[dict]) -> tuple[int, set[int]]:
+        """
+        Sends each earthquake to the workers whose shards it could reach,
+        returning the batch ID and the workers to wait for
+        """
+        self.batches += 1
+        routes = self.route(earthquakes)
+        for worker, routed_earthquakes in routes.items():
+            self.requests[worker].put((self.batches, routed_earthquakes))
+        return self.batches, set(routes)
+
+    def collect(self, batch_id: int, waiting: set[int], timeout: float) -> list[list[dict]]:
+        """
+        Gets each waiting worker's matches for a batch, ignoring late replies
+        to earlier batches. Workers which do not reply within the timeout are
+        logged and skipped.
+        """
+        deadline = time.monotonic() + timeout
+        worker_matches = []
+        while waiting:
+            try:
+                result_batch, worker, matches = self.results.get(
+                    timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                logging.error(f"Alert workers {sorted(waiting)} did not reply within {timeout}s")
+                break
+            if result_batch == batch_id:
+                waiting.discard(worker)
+                worker_matches.append(matches)
+        return worker_matches
+
+    def match(self, earthquakes: list[dict],
+              timeout: float = DEFAULT_MATCH_TIMEOUT) -> list[dict]:
+        """
+        Sends each earthquake to the workers whose shards it could reach and
+        merges their matches
+        """
+        batch_id, waiting = self.send(earthquakes)
+        return merge_matches(earthquakes, self.collect(batch_id, waiting, timeout))
+
+
+def get_all_topics(conn) -> list[dict]:
+    """
+    Gets every topic for the workers to hold in memory
+    """
+    with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
+        cur.execute("""SELECT topic_id, topic_arn, min_magnitude, lon, lat, rules, region,
+                              min_intensity
+                       FROM topics;""")
+        return cur.fetchall()
+
+
+if __name__ == "__main__":
+    import extract
+    import transform
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    connection = get_connection()
+    all_topics = get_all_topics(connection)
+    connection.close()
+    with ShardCoordinator(all_topics, int(ENV.get("SHARD_WORKERS", DEFAULT_SHARD_WORKERS)),
+                          int(ENV.get("SHARD_PRECISION", DEFAULT_SHARD_PRECISION))) as coordinator:
+        transform_data = transform.transform_process(extract.extract_process())
+        if transform_data:
+            sns_alert_system(transform_data, coordinator.match)
@@ -3,15 +3,34 @@
 """This script sends sns alerts to interested users"""
 
 from os import environ as ENV
+from datetime import datetime, timezone
 import logging
 import boto3
 from dotenv import load_dotenv
 from haversine import haversine
+import numpy as np
 from psycopg2.extensions import connection, cursor
 import psycopg2.extras
+from publisher import SNS_CLIENT_CONFIG, publish_messages
+from ledger import (get_previous_deliveries, get_delivery_records, get_held_records,
+                    get_digest_records, record_deliveries, record_digest_deliveries)
+from digest import (MemoryDigestStore, DatabaseDigestStore, run_digest, close_digests,
+                    get_delivered_digests)
+from dispatch import get_event_time, get_alert_priority, prioritise_messages, summarise_latencies
+from matching import (get_coordinate_arrays, get_value_array, get_bounding_boxes,
+                      calculate_distance_matrix, get_match_matrix)
+from rules import RuleIndex
+from geofence import get_geofence_index
+from intensity import get_intensity_reach, match_intensity
 
 load_dotenv()
 
+ALERT_SUBJECT = "EARTHQUAKE WARNING"
+DIGEST_SUBJECT = "EARTHQUAKE ACTIVITY SUMMARY"
+DEFAULT_DIGEST_MAX_IMMEDIATE = 3
+MAX_DIGEST_TITLES = 10
+MEMORY_DIGEST_STORE = MemoryDigestStore()
+
 def get_sns_client():
     """
     Gets connection to the boto3 sns client
@@ -19,7 +38,8 @@ def get_sns_client():
     try:
         return boto3.client('sns',
                                 aws_access_key_id=ENV.get("ACCESS_KEY"),
-                                aws_secret_access_key=ENV.get("SECRET_ACCESS_KEY"))
+                                aws_secret_access_key=ENV.get("SECRET_ACCESS_KEY"),
+                                config=SNS_CLIENT_CONFIG)
     except Exception as e:
         logging.error(
             f"An unexpected error occurred in getting sns client: {e}")
@@ -65,14 +85,59 @@ def calculate_distance(coordinate_1: tuple, coordinate_2: tuple) -> int | None:
         logging.error(f"Error calculating distance: {e}")
         return None
 
-def get_topics(conn: connection)-> list[dict]:
+def get_topic_filters(earthquakes: list[dict]) -> tuple[list[str], list]:
+    """
+    Gets the WHERE conditions and parameters which select topics that
+    could be within the alert radius of at least one earthquake, any region
+    topics the strongest earthquake is big enough for, and any intensity
+    topics within the distance an earthquake could be felt
+    """
+    conditions = []
+    params = []
+    magnitudes = [earthquake['magnitude'] for earthquake in earthquakes
+                  if isinstance(earthquake.get('magnitude'), (int, float))]
+    if magnitudes:
+        conditions.append("(region IS NOT NULL AND min_magnitude <= %s)")
+        params.append(max(magnitudes))
+    for earthquake in earthquakes:
+        radius = get_notification_distance(earthquake.get('magnitude'))
+        if radius is None:
+            continue
+        for min_lat, max_lat, min_lon, max_lon in get_bounding_boxes(
+                earthquake['lat'], earthquake['lon'], radius):
+            conditions.append(
+                "(min_magnitude <= %s AND lat BETWEEN %s AND %s AND lon BETWEEN %s AND %s)")
+            params.extend([earthquake['magnitude'],
+                          min_lat, max_lat, min_lon, max_lon])
+    for earthquake in earthquakes:
+        if not isinstance(earthquake.get('magnitude'), (int, float)):
+            continue
+        reach = get_intensity_reach(earthquake['magnitude'], earthquake.get('depth'))
+        if reach is None:
+            continue
+        for min_lat, max_lat, min_lon, max_lon in get_bounding_boxes(
+                earthquake['lat'], earthquake['lon'], reach + 1):
+            conditions.append(
+                "(min_intensity IS NOT NULL AND lat BETWEEN %s AND %s AND lon BETWEEN %s AND %s)")
+            params.extend([min_lat, max_lat, min_lon, max_lon])
+    return conditions, params
+
+
+def get_topics(conn: connection, earthquakes: list[dict]) -> list[dict]:
     """
-    Gets all topics from database
+    Gets the topics from the database that could be interested in the
+    earthquakes, using the topics(lat, lon) index to skip distant topics
     """
     try:
+        conditions, params = get_topic_filters(earthquakes)
+        if not conditions:
+            return []
         with get_cursor(conn) as cur:
-            query = """SELECT * FROM topics;"""
-            cur.execute(query)
+            query = f"""SELECT topic_id, topic_arn, min_magnitude, lon, lat, rules, region,
+                               min_intensity
+                        FROM topics
+                        WHERE {" OR ".join(conditions)};"""
+            cur.execute(query, params)
             topic_coordinates = cur.fetchall()
         return topic_coordinates
     except Exception as e:
@@ -169,30 +234,137 @@ def find_related_topics(earthquake: dict, topics) -> list:
             f"An unexpected error occurred getting related topics: {e}")
         return []
 
-def get_subscribed_users(conn: connection, related_topics: list) -> list:
+def find_alert_matches(earthquakes: list[dict], topics: list[dict]) -> list[dict]:
+    """
+    Finds every (earthquake, topic) pair where the topic is interested in the
+    earthquake, matching the whole batch with one vectorised distance matrix.
+    Alerts are matched with find_rule_matches, whose RuleIndex replaced this;
+    it is kept as the brute force baseline for tests and benchmarks
+    """
+    try:
+        if not earthquakes or not topics:
+            return []
+        eq_lats, eq_lons = get_coordinate_arrays(earthquakes)
+        topic_lats, topic_lons = get_coordinate_arrays(topics)
+        magnitudes = get_value_array(earthquakes, 'magnitude')
+        min_magnitudes = get_value_array(topics, 'min_magnitude')
+        radii = np.array([get_notification_distance(earthquake['magnitude']) or np.nan
+                          for earthquake in earthquakes], dtype=float)
+
+        distances = calculate_distance_matrix(
+            eq_lats, eq_lons, topic_lats, topic_lons)
+        matches = get_match_matrix(distances, radii, magnitudes, min_magnitudes)
+
+        return [{'earthquake': earthquakes[eq_index],
+                 'topic': topics[topic_index],
+                 'distance': int(distances[eq_index, topic_index])}
+                for eq_index, topic_index in zip(*np.nonzero(matches))]
+    except Exception as e:
+        logging.error(
+            f"An unexpected error occurred matching earthquakes to topics: {e}")
+        return []
+
+
+def find_rule_matches(earthquakes: list[dict], topics: list[dict]) -> list[dict]:
+    """
+    Finds every (earthquake, topic) pair where the earthquake is close enough,
+    strong enough and satisfies the topic's subscription rules, using a
+    compiled RuleIndex so only nearby topics are checked
+    """
+    try:
+        if not earthquakes or not topics:
+            return []
+        radii = [get_notification_distance(earthquake.get('magnitude'))
+                 for earthquake in earthquakes]
+        return RuleIndex(topics).match(earthquakes, radii)
+    except Exception as e:
+        logging.error(
+            f"An unexpected error occurred matching earthquakes to topic rules: {e}")
+        return []
+
+
+def find_geofence_matches(earthquakes: list[dict], topics: list[dict]) -> list[dict]:
+    """
+    Finds every (earthquake, topic) pair where the earthquake's epicentre is
+    inside the topic's region and satisfies its subscription rules
+    """
+    try:
+        if not earthquakes or not topics:
+            return []
+        return get_geofence_index(topics).match(earthquakes)
+    except Exception as e:
+        logging.error(
+            f"An unexpected error occurred matching earthquakes to topic regions: {e}")
+        return []
+
+
+def find_intensity_matches(earthquakes: list[dict], topics: list[dict]) -> list[dict]:
+    """
+    Finds every (earthquake, topic) pair where the shaking predicted at the
+    topic's location reaches the topic's min_intensity
+    """
+    try:
+        if not earthquakes or not topics:
+            return []
+        return match_intensity(earthquakes, topics)
+    except Exception as e:
+        logging.error(
+            f"An unexpected error occurred matching earthquakes by intensity: {e}")
+        return []
+
+
+def split_topics(topics: list[dict]) -> tuple[list[dict], list[dict], list[dict]]:
+    """
+    Splits topics into radius, region and intensity topics
+    """
+    region_topics = [topic for topic in topics if topic.get('region')]
+    intensity_topics = [topic for topic in topics
+                        if not topic.get('region') and topic.get('min_intensity') is not None]
+    point_topics = [topic for topic in topics
+                    if not topic.get('region') and topic.get('min_intensity') is None]
+    return point_topics, region_topics, intensity_topics
+
+
+def find_topic_matches(earthquakes: list[dict], topics: list[dict]) -> list[dict]:
+    """
+    Matches earthquakes against region topics by point-in-polygon, intensity
+    topics by predicted shaking and all other topics by distance
+    """
+    point_topics, region_topics, intensity_topics = split_topics(topics)
+    return (find_rule_matches(earthquakes, point_topics)
+            + find_geofence_matches(earthquakes, region_topics)
+            + find_intensity_matches(earthquakes, intensity_topics))
+
+
+def get_subscribed_users(conn: connection, topic_ids: list[int]) -> dict[int, list[dict]]:
     """
-    Gets all user details for users who have subscribed to interested 
-    topics
+    Gets all user details for users who have subscribed to interested
+    topics, grouped by topic_id, using a single query for every topic
     """
     try:
+        if not topic_ids:
+            return {}
         with get_cursor(conn) as cur:
-            for topic in related_topics:
-                query = """
-                SELECT uta.user_id, u.email_address, u.phone_number, t.topic_arn, t.min_magnitude, t.lat, t.lon
-                FROM user_topic_assignments AS uta
-                JOIN users AS u ON u.user_id = uta.user_id
-                JOIN topics AS t ON uta.topic_id = t.topic_id
-                WHERE uta.topic_id = %s;
-                """
-                cur.execute(query, (topic['topic_id'],))
-                rows = cur.fetchall()
-
-                return [get_user_information(row) for row in rows]
+            query = """
+            SELECT uta.topic_id, uta.user_id, u.email_address, u.phone_number, t.topic_arn, t.min_magnitude, t.lat, t.lon
+            FROM user_topic_assignments AS uta
+            JOIN users AS u ON u.user_id = uta.user_id
+            JOIN topics AS t ON uta.topic_id = t.topic_id
+            WHERE uta.topic_id = ANY(%s);
+            """
+            cur.execute(query, (list(topic_ids),))
+            rows = cur.fetchall()
+
+        subscribed_users = {}
+        for row in rows:
+            subscribed_users.setdefault(row['topic_id'], []).append(
+                get_user_information(row))
+        return subscribed_users
 
     except Exception as e:
         logging.error(
             f"An unexpected error occurred getting subscribed users: {e}")
-        return []
+        return {}
 
 
 def send_message(sns_client: boto3.client, arn: str, subject: str, message: str):
@@ -210,27 +382,13 @@ def send_message(sns_client: boto3.client, arn: str, subject: str, message: str)
             f"An unexpected error occurred when sending messages: {e}")
 
 
-def sns_alert_system(earthquakes: list[dict]):
+def build_alert_message(earthquake: dict, distance: int) -> str:
     """
-    This is the main function which runs through the functions to
-    get all users interested in relevant earthquakes, and sends a
-    message to all interested users.
+    Builds the warning message sent to a topic about an earthquake
     """
-    sns_client = get_sns_client()
-    conn = get_connection()
-
-    topics = get_topics(conn)
-    for earthquake in earthquakes:
-        related_topics = find_related_topics(earthquake, topics)
-        subscribed_users = get_subscribed_users(conn, related_topics)
-        if subscribed_users:
-            for user in subscribed_users:
-                magnitude = earthquake['magnitude']
-                eq_coordinates = (earthquake['lon'], earthquake['lat'])
-                topic_coordinates = (user['lon'], user['lat'])
-                title = earthquake['title'].split(' - ')[1]
-                distance = calculate_distance(topic_coordinates, eq_coordinates)
-                message = (
+    magnitude = earthquake['magnitude']
+    title = earthquake['title'].split(' - ', 1)[-1]
+    return (
 f"""
 **EARTHQUAKE WARNING!**
 
@@ -250,11 +408,167 @@ SAFETY TIPS:
 
 Stay safe and follow these guidelines until the shaking subsides. Be aware of potential aftershocks.
 """
-                )
-                subject = "EARTHQUAKE WARNING"
-                send_message(
-                    sns_client, user['topic_arn'], subject, message
-                )
+    )
+
+
+def build_digest_message(digest: dict) -> str:
+    """
+    Builds the consolidated message sent to a topic about the earthquakes
+    held back during its digest window
+    """
+    events = sorted(digest['pending'], key=lambda event: event['magnitude'], reverse=True)
+    event_lines = "\n".join(
+        f"- M {event['magnitude']}, {event['distance']}km away: "
+        f"{event['title'].split(' - ', 1)[-1]}"
+        for event in events[:MAX_DIGEST_TITLES])
+    if len(events) > MAX_DIGEST_TITLES:
+        event_lines += f"\n- and {len(events) - MAX_DIGEST_TITLES} more"
+    return (
+f"""
+**EARTHQUAKE ACTIVITY SUMMARY**
+
+Since your last warning, {len(events)} further earthquakes have been detected near your area:
+
+{event_lines}
+
+Be aware of potential aftershocks and follow the safety tips from your earlier warning.
+"""
+    )
+
+
+def get_digest_store(conn: connection) -> MemoryDigestStore | DatabaseDigestStore:
+    """
+    Gets where digest state is kept: in memory when running as a long lived
+    process (DIGEST_STORE=memory), otherwise in the alert_digests table
+    """
+    if ENV.get("DIGEST_STORE") == "memory":
+        return MEMORY_DIGEST_STORE
+    return DatabaseDigestStore(conn)
+
+
+def get_subscribed_matches(matches: list[dict], users_by_topic: dict[int, list[dict]]) -> list[dict]:
+    """
+    Gets one match per (earthquake, topic) pair, dropping topics with no subscribers.
+    SNS fans each publish out to every subscriber of the topic.
+    """
+    seen = set()
+    subscribed_matches = []
+    for match in matches:
+        key = (match['earthquake']['earthquake_id'], match['topic']['topic_id'])
+        if key in seen or not users_by_topic.get(match['topic']['topic_id']):
+            continue
+        seen.add(key)
+        subscribed_matches.append(match)
+    return subscribed_matches
+
+
+def is_material_change(previous_magnitude: float, magnitude: float) -> bool:
+    """
+    Checks whether a revised earthquake has changed enough to alert the same
+    topic again: its magnitude has moved up a notification tier, or risen by
+    at least REALERT_MAGNITUDE_DELTA if that is set
+    """
+    if magnitude <= previous_magnitude:
+        return False
+    if get_notification_distance(magnitude) != get_notification_distance(previous_magnitude):
+        return True
+    magnitude_delta = ENV.get("REALERT_MAGNITUDE_DELTA")
+    return magnitude_delta is not None and magnitude - previous_magnitude >= float(magnitude_delta)
+
+
+def get_new_alert_matches(matches: list[dict], previous_deliveries: dict[tuple, dict]) -> list[dict]:
+    """
+    Gets the matches which have not been alerted before, or whose earthquake
+    has been revised with a material change since the last alert
+    """
+    new_matches = []
+    for match in matches:
+        previous = previous_deliveries.get(
+            (match['earthquake']['earthquake_id'], match['topic']['topic_id']))
+        if previous is None or is_material_change(previous['magnitude'],
+                                                  match['earthquake']['magnitude']):
+            new_matches.append(match)
+    return new_matches
+
+
+def get_alert_messages(alert_matches: list[dict], digests: list[dict]) -> list[dict]:
+    """
+    Gets the messages to publish for the immediate alerts and closed digests,
+    with the biggest and closest earthquakes first
+    """
+    messages = [{'key': (match['earthquake']['earthquake_id'], match['topic']['topic_id']),
+                 'arn': match['topic']['topic_arn'],
+                 'subject': ALERT_SUBJECT,
+                 'message': build_alert_message(match['earthquake'], match['distance']),
+                 'priority': get_alert_priority(match['earthquake']['magnitude'],
+                                                match['distance']),
+                 'event_time': get_event_time(match['earthquake'])}
+                for match in alert_matches]
+    messages.extend({'key': ('digest', digest['topic_id']),
+                     'arn': digest['topic_arn'],
+                     'subject': DIGEST_SUBJECT,
+                     'message': build_digest_message(digest)}
+                    for digest in digests)
+    return prioritise_messages(messages)
+
+
+def sns_alert_system(earthquakes: list[dict], match_topics=None, deadline: float = None):
+    """
+    This is the main function which runs through the functions to
+    get all topics interested in relevant earthquakes, and publishes
+    one message to each topic, which SNS sends to all subscribed users.
+    When DIGEST_WINDOW_MINUTES is set, swarms are batched into digests.
+    match_topics can replace fetching and matching topics, e.g. with a
+    sharding.ShardCoordinator's match method.
+    No alert is published once the time.monotonic() deadline has passed, so
+    a run that overruns its stage timeout stops instead of racing the next.
+    Returns a summary of the deliveries made during the run, including
+    the digests attempted and delivered and the origin-to-publish latency
+    percentiles.
+    """
+    detected_at = datetime.now(timezone.utc)
+    conn = get_connection()
+
+    if match_topics is None:
+        matches = find_topic_matches(earthquakes, get_topics(conn, earthquakes))
+    else:
+        matches = match_topics(earthquakes)
+    users_by_topic = get_subscribed_users(
+        conn, {match['topic']['topic_id'] for match in matches})
+    previous_deliveries = get_previous_deliveries(
+        conn, [earthquake['earthquake_id'] for earthquake in earthquakes])
+    alert_matches = get_new_alert_matches(
+        get_subscribed_matches(matches, users_by_topic), previous_deliveries)
+
+    digest_store, digests, suppressed_matches, digest_states = None, [], [], {}
+    digest_window = float(ENV.get("DIGEST_WINDOW_MINUTES", 0))
+    if digest_window > 0:
+        digest_store = get_digest_store(conn)
+        alert_matches, digests, suppressed_matches, digest_states = run_digest(
+            digest_store,
+            sorted(alert_matches, key=lambda match: match['earthquake']['magnitude'], reverse=True),
+            detected_at, digest_window,
+            int(ENV.get("DIGEST_MAX_IMMEDIATE", DEFAULT_DIGEST_MAX_IMMEDIATE)))
+
+    delivery_summary = publish_messages(get_sns_client(),
+                                        get_alert_messages(alert_matches, digests),
+                                        deadline=deadline)
+    delivery_summary['suppressed'] = len(suppressed_matches)
+    delivery_summary['digests_attempted'] = len(digests)
+    delivery_summary['digests_delivered'] = 0
+    if digest_store is not None:
+        delivery_summary['digests_delivered'] = close_digests(
+            digest_store, digests, digest_states,
+            get_delivered_digests(delivery_summary['results']))
+    delivery_summary['latency'] = summarise_latencies(delivery_summary['results'])
+    record_deliveries(conn, get_delivery_records(alert_matches, delivery_summary['results'],
+                                                 detected_at)
+                      + get_held_records(suppressed_matches, detected_at))
+    record_digest_deliveries(conn, get_digest_records(digests, delivery_summary['results']))
+
+    if conn is not None:
+        conn.close()
+    return delivery_summary
 
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+# pylint: skip-file
+
+"""A local stand-in for the SNS API, shared by the pipeline and dashboard tests.
+It answers Publish, CreateTopic, Subscribe and Unsubscribe calls, injecting
+latency, throttling errors and rejected endpoints"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import threading
+import time
+import uuid
+import pytest
+
+SNS_NAMESPACE = 'xmlns="http://sns.amazonaws.com/doc/2010-03-31/"'
+
+
+class StubSNSHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = parse_qs(self.rfile.read(
+            int(self.headers['Content-Length'])).decode())
+        call = {key: values[0] for key, values in body.items()}
+        with stub['lock']:
+            stub['requests'] += 1
+            request_number = stub['requests']
+            stub['in_flight'] += 1
+            stub['max_in_flight'] = max(stub['max_in_flight'], stub['in_flight'])
+        time.sleep(stub['latency'])
+        with stub['lock']:
+            stub['in_flight'] -= 1
+
+        throttle_every = stub['throttle_every']
+        if throttle_every and request_number % throttle_every == 0:
+            self.send_error_xml('Throttling', 'Rate exceeded')
+            return
+        if call.get('Endpoint') in stub['rejected_endpoints']:
+            self.send_error_xml('InvalidParameter', 'Invalid parameter: Endpoint')
+            return
+
+        action = call['Action']
+        with stub['lock']:
+            stub['calls'].append(call)
+            if action == 'Publish':
+                stub['published'].append(body)
+        if action == 'Publish':
+            result = f"<MessageId>{uuid.uuid4()}</MessageId>"
+        elif action == 'CreateTopic':
+            result = f"<TopicArn>arn:aws:sns:eu-west-2:123456789012:{call['Name']}</TopicArn>"
+        elif action == 'Subscribe':
+            arn = 'pending confirmation' if call['Protocol'] == 'email' else \
+                f"{call['TopicArn']}:{uuid.uuid4()}"
+            result = f"<SubscriptionArn>{arn}</SubscriptionArn>"
+        else:
+            result = ""
+        self.send_xml(200, f"""<{action}Response {SNS_NAMESPACE}>
+<{action}Result>{result}</{action}Result>
+<ResponseMetadata><RequestId>{uuid.uuid4()}</RequestId></ResponseMetadata></{action}Response>""")
+
+    def send_error_xml(self, code, message):
+        self.send_xml(400, f"""<ErrorResponse {SNS_NAMESPACE}>
+<Error><Type>Sender</Type><Code>{code}</Code><Message>{message}</Message></Error>
+<RequestId>{uuid.uuid4()}</RequestId></ErrorResponse>""")
+
+    def send_xml(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body.encode())))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_sns():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubSNSHandler)
+    server.stub = {'lock': threading.Lock(), 'requests': 0, 'in_flight': 0,
+                   'max_in_flight': 0, 'latency': 0.0, 'throttle_every': 0,
+                   'rejected_endpoints': set(), 'calls': [], 'published': []}
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    server.stub['url'] = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server.stub
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def stub_sns_client(stub_sns):
+    import boto3
+    from botocore.config import Config
+    return boto3.client('sns', endpoint_url=stub_sns['url'], region_name='eu-west-2',
+                        aws_access_key_id='fake_access_key',
+                        aws_secret_access_key='fake_secret_key',
+                        config=Config(retries={'total_max_attempts': 1, 'mode': 'standard'},
+                                      max_pool_connections=20))
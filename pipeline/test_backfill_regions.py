@@ -0,0 +1,43 @@
+import logging
+from unittest.mock import MagicMock, patch
+from backfill_regions import backfill_regions, get_unenriched_batch
+
+
+def test_get_unenriched_batch(mock_cursor):
+    mock_cursor.fetchall.return_value = [{"earthquake_id": "a"}]
+
+    assert get_unenriched_batch(mock_cursor, None, 10) == [{"earthquake_id": "a"}]
+    assert mock_cursor.execute.call_args[0][1] == ("", 10)
+
+
+def test_backfill_regions():
+    conn = MagicMock()
+    first_batch = [{"earthquake_id": "a", "lat": 38.8, "lon": -122.8},
+                   {"earthquake_id": "b", "lat": 35.6, "lon": 139.7}]
+    second_batch = [{"earthquake_id": "c", "lat": 51.5, "lon": -0.1}]
+
+    with patch("backfill_regions.get_unenriched_batch",
+               side_effect=[first_batch, second_batch, []]) as mock_batch, \
+            patch("backfill_regions.psycopg2.extras.execute_values") as mock_execute_values, \
+            patch("backfill_regions.record_data_load") as mock_record_load:
+        assert backfill_regions(conn, 2) == 3
+
+    assert mock_record_load.call_args[0][2] == 3
+    assert [call[0][1] for call in mock_batch.call_args_list] == [None, "b", "c"]
+    assert mock_execute_values.call_args_list[0][0][2] == [
+        ("a", "US", "NA", "California"), ("b", "JP", "AS", None)]
+    assert mock_execute_values.call_args_list[1][0][2] == [("c", "GB", "EU", None)]
+    assert conn.commit.call_count == 2
+
+
+def test_backfill_regions_error(caplog):
+    conn = MagicMock()
+
+    with patch("backfill_regions.get_unenriched_batch", side_effect=Exception("Example error")), \
+            patch("backfill_regions.record_data_load") as mock_record_load:
+        with caplog.at_level(logging.ERROR):
+            assert backfill_regions(conn) == 0
+
+    mock_record_load.assert_not_called()
+    conn.rollback.assert_called_once()
+    assert "An unexpected error occurred while backfilling regions" in caplog.text
@@ -0,0 +1,183 @@
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+from digest import (MemoryDigestStore, DatabaseDigestStore, open_digest_window,
+                    add_pending_event, apply_digest, run_digest, close_digests,
+                    get_delivered_digests)
+
+NOW = datetime(2024, 6, 24, 12, 0, tzinfo=timezone.utc)
+
+
+def make_match(topic, earthquake_id, magnitude, distance=10):
+    return {'earthquake': {'earthquake_id': earthquake_id, 'magnitude': magnitude,
+                           'title': f'M {magnitude} - 5 km N of Ridgecrest, CA'},
+            'topic': topic, 'distance': distance}
+
+
+def test_apply_digest_bounds_immediate_alerts(example_topic):
+    matches = [make_match(example_topic, f'eq{index}', 3.0 + index / 10) for index in range(40)]
+    states = {}
+
+    immediate, suppressed = apply_digest(matches, states, NOW, max_immediate=3)
+
+    assert [match['earthquake']['earthquake_id'] for match in immediate] == ['eq0', 'eq1', 'eq2']
+    assert len(suppressed) == 37
+    assert states[12]['immediate_count'] == 3
+    assert len(states[12]['pending']) == 37
+
+
+def test_apply_digest_largest_event_alerts_immediately(example_topic):
+    states = {12: {**open_digest_window(make_match(example_topic, 'eq0', 4.0), NOW)}}
+    matches = [make_match(example_topic, 'eq1', 3.5), make_match(example_topic, 'eq2', 4.6)]
+
+    immediate, suppressed = apply_digest(matches, states, NOW, max_immediate=3)
+
+    assert [match['earthquake']['earthquake_id'] for match in immediate] == ['eq2']
+    assert [match['earthquake']['earthquake_id'] for match in suppressed] == ['eq1']
+    assert states[12]['largest_magnitude'] == 4.6
+
+
+def test_add_pending_event_replaces_revisions(example_topic):
+    state = open_digest_window(make_match(example_topic, 'eq0', 4.0), NOW)
+
+    add_pending_event(state, make_match(example_topic, 'eq1', 3.0))
+    add_pending_event(state, make_match(example_topic, 'eq1', 3.2))
+
+    assert state['pending'] == [{'earthquake_id': 'eq1', 'magnitude': 3.2,
+                                 'title': 'M 3.2 - 5 km N of Ridgecrest, CA', 'distance': 10}]
+
+
+def test_memory_digest_store(example_topic):
+    store = MemoryDigestStore()
+    state = open_digest_window(make_match(example_topic, 'eq0', 4.0), NOW)
+
+    store.save({12: state})
+
+    assert store.load({12, 13}) == {12: state}
+    assert store.load_expired(NOW) == {}
+    assert store.load_expired(NOW + timedelta(minutes=1)) == {12: state}
+    store.delete({12})
+    assert store.load({12}) == {}
+
+
+def test_run_digest_closes_expired_windows(example_topic):
+    store = MemoryDigestStore()
+    state = open_digest_window(make_match(example_topic, 'eq0', 4.0), NOW - timedelta(minutes=90))
+    add_pending_event(state, make_match(example_topic, 'eq1', 3.0))
+    store.save({12: state})
+
+    immediate, digests, suppressed, states = run_digest(
+        store, [make_match(example_topic, 'eq2', 3.1)], NOW, 60, 3)
+
+    assert [digest['pending'][0]['earthquake_id'] for digest in digests] == ['eq1']
+    assert [match['earthquake']['earthquake_id'] for match in immediate] == ['eq2']
+    assert suppressed == []
+    assert states[12]['window_start'] == NOW
+    assert store.load({12})[12] is state
+
+    close_digests(store, digests, states, {12})
+
+    assert store.load({12})[12]['window_start'] == NOW
+    assert store.load({12})[12]['pending'] == []
+
+
+def test_run_digest_skips_empty_digests(example_topic):
+    store = MemoryDigestStore()
+    store.save({12: open_digest_window(make_match(example_topic, 'eq0', 4.0), NOW - timedelta(minutes=90))})
+
+    _, digests, _, _ = run_digest(store, [], NOW, 60, 3)
+
+    assert digests == []
+    assert store.states == {}
+
+
+def make_expired_digest(store, topic):
+    state = open_digest_window(make_match(topic, 'eq0', 4.0), NOW - timedelta(minutes=90))
+    add_pending_event(state, make_match(topic, 'eq1', 3.0))
+    store.save({topic['topic_id']: state})
+    return state
+
+
+def test_close_digests_deletes_published_digests(example_topic):
+    store = MemoryDigestStore()
+    make_expired_digest(store, example_topic)
+    _, digests, _, states = run_digest(store, [], NOW, 60, 3)
+
+    assert close_digests(store, digests, states, {12}) == 1
+    assert store.states == {}
+
+
+def test_close_digests_keeps_unpublished_digests(example_topic, caplog):
+    store = MemoryDigestStore()
+    state = make_expired_digest(store, example_topic)
+    _, digests, _, states = run_digest(store, [], NOW, 60, 3)
+
+    assert close_digests(store, digests, states, set()) == 0
+    assert store.states == {12: state}
+    assert "Digest for topic 12 was not published, keeping it to retry" in caplog.text
+    assert run_digest(store, [], NOW, 60, 3)[1] == [state]
+
+
+def test_close_digests_carries_unpublished_events_into_new_window(example_topic):
+    store = MemoryDigestStore()
+    make_expired_digest(store, example_topic)
+    _, digests, _, states = run_digest(
+        store, [make_match(example_topic, 'eq2', 3.5), make_match(example_topic, 'eq3', 3.2)],
+        NOW, 60, 3)
+
+    close_digests(store, digests, states, set())
+
+    state = store.load({12})[12]
+    assert state['window_start'] == NOW
+    assert [event['earthquake_id'] for event in state['pending']] == ['eq1', 'eq3']
+
+
+def test_get_delivered_digests():
+    results = [{'key': ('digest', 12), 'delivered': True},
+               {'key': ('digest', 13), 'delivered': False},
+               {'key': ('eq1', 14), 'delivered': True}]
+
+    assert get_delivered_digests(results) == {12}
+
+
+def test_database_digest_store_load():
+    conn = MagicMock()
+    cursor = MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cursor
+    cursor.fetchall.return_value = [{'topic_id': 12, 'pending': []}]
+
+    assert DatabaseDigestStore(conn).load({12}) == {12: {'topic_id': 12, 'pending': []}}
+    query, params = cursor.execute.call_args[0]
+    assert "topic_id = ANY(%s)" in query
+    assert params == ([12],)
+
+
+def test_database_digest_store_load_error(caplog):
+    conn = MagicMock()
+    conn.cursor.side_effect = Exception("Database connection error")
+
+    assert DatabaseDigestStore(conn).load_expired(NOW) == {}
+    assert "An unexpected error occurred fetching alert digests" in caplog.text
+
+
+@patch('digest.psycopg2.extras.execute_values')
+def test_database_digest_store_save(mock_execute_values, example_topic):
+    conn = MagicMock()
+    state = open_digest_window(make_match(example_topic, 'eq0', 4.0), NOW)
+
+    DatabaseDigestStore(conn).save({12: state})
+
+    assert "ON CONFLICT (topic_id) DO UPDATE" in mock_execute_values.call_args[0][1]
+    row = mock_execute_values.call_args[0][2][0]
+    assert row[:5] == (12, example_topic['topic_arn'], NOW, 4.0, 1)
+    conn.commit.assert_called_once()
+
+
+def test_database_digest_store_delete():
+    conn = MagicMock()
+    cursor = MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cursor
+
+    DatabaseDigestStore(conn).delete({12})
+
+    assert cursor.execute.call_args[0][1] == ([12],)
+    conn.commit.assert_called_once()
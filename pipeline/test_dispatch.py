@@ -0,0 +1,51 @@
+from datetime import datetime, timezone
+import logging
+import pytest
+from dispatch import get_event_time, get_alert_priority, prioritise_messages, get_percentile, summarise_latencies
+
+
+def test_get_event_time(example_single_earthquake):
+    example_single_earthquake['time'] = '2024/06/24 12:22:22'
+
+    assert get_event_time(example_single_earthquake) == datetime(
+        2024, 6, 24, 12, 22, 22, tzinfo=timezone.utc)
+
+
+def test_get_event_time_invalid(liverpool_earthquake, caplog):
+    assert get_event_time(liverpool_earthquake) is None
+    assert "Error getting earthquake origin time" in caplog.text
+
+
+def test_prioritise_messages():
+    messages = [{'key': 'small', 'priority': get_alert_priority(1.2, 5)},
+                {'key': 'digest'},
+                {'key': 'big_far', 'priority': get_alert_priority(6.5, 180)},
+                {'key': 'big_close', 'priority': get_alert_priority(6.5, 20)},
+                {'key': 'small_too', 'priority': get_alert_priority(1.2, 5)}]
+
+    assert [message['key'] for message in prioritise_messages(messages)] == [
+        'big_close', 'big_far', 'small', 'small_too', 'digest']
+
+
+@pytest.mark.parametrize("percentile, expected", [(50, 50), (95, 95), (99, 99), (100, 100), (1, 1)])
+def test_get_percentile(percentile, expected):
+    assert get_percentile(list(range(1, 101)), percentile) == expected
+
+
+def test_get_percentile_empty():
+    assert get_percentile([], 50) is None
+
+
+def test_summarise_latencies(caplog):
+    results = [{'latency': float(latency)} for latency in range(20, 0, -1)]
+    results.append({'latency': None})
+
+    with caplog.at_level(logging.INFO):
+        summary = summarise_latencies(results)
+
+    assert summary == {'p50': 10.0, 'p95': 19.0, 'p99': 20.0, 'count': 20, 'max': 20.0}
+    assert "Alert latency p50=10.0s" in caplog.text
+
+
+def test_summarise_latencies_no_deliveries():
+    assert summarise_latencies([]) == {'p50': None, 'p95': None, 'p99': None, 'count': 0, 'max': None}
@@ -0,0 +1,79 @@
+from geofence import get_region_geometry, GeofenceIndex, get_geofence_index, WARM_INDEX
+
+CORRIDOR = 'POLYGON ((-3 53, -2.9 53, -2.9 54, -3 54, -3 53))'
+SERVICE_AREAS = ('MULTIPOLYGON (((-4 53, -3.5 53, -3.5 53.5, -4 53.5, -4 53)), '
+                 '((140 38, 140.1 38, 140.1 38.3, 140 38.3, 140 38)))')
+
+
+def test_get_region_geometry():
+    geometry = get_region_geometry(SERVICE_AREAS)
+
+    assert geometry.geom_type == 'MultiPolygon'
+
+
+def test_get_region_geometry_invalid(caplog):
+    assert get_region_geometry('POINT (1 2)') is None
+    assert get_region_geometry('not wkt') is None
+    assert "Error parsing topic region" in caplog.text
+
+
+def test_geofence_index_matches_point_in_polygon(liverpool_earthquake, example_topic):
+    topics = [{**example_topic, 'topic_id': 1, 'region': CORRIDOR},
+              {**example_topic, 'topic_id': 2, 'region': SERVICE_AREAS}]
+    japan_earthquake = {**liverpool_earthquake, 'earthquake_id': 'jp',
+                        'lat': 38.2, 'lon': 140.05}
+
+    matches = GeofenceIndex(topics).match([liverpool_earthquake, japan_earthquake])
+
+    assert [(match['earthquake']['earthquake_id'], match['topic']['topic_id'])
+            for match in matches] == [('ak0247tc2ogk', 1), ('jp', 2)]
+    assert matches[0]['distance'] == 0
+
+
+def test_geofence_index_bounding_box_is_not_enough(liverpool_earthquake, example_topic):
+    triangle = 'POLYGON ((-2.9 53, -2.9 54, -3 54, -2.9 53))'
+    topics = [{**example_topic, 'region': triangle}]
+
+    assert GeofenceIndex(topics).match([liverpool_earthquake]) == []
+
+
+def test_geofence_index_applies_magnitude_and_rules(liverpool_earthquake, example_topic):
+    topics = [{**example_topic, 'topic_id': 1, 'region': CORRIDOR, 'min_magnitude': 7},
+              {**example_topic, 'topic_id': 2, 'region': CORRIDOR,
+               'rules': {'min_alert': 'red'}},
+              {**example_topic, 'topic_id': 3, 'region': CORRIDOR,
+               'rules': {'max_depth': 10}}]
+
+    matches = GeofenceIndex(topics).match([liverpool_earthquake])
+
+    assert [match['topic']['topic_id'] for match in matches] == [3]
+
+
+def test_geofence_index_skips_invalid_regions(liverpool_earthquake, example_topic, caplog):
+    topics = [{**example_topic, 'topic_id': 1, 'region': 'POLYGON ((0 0, 1 1))'},
+              {**example_topic, 'topic_id': 2, 'region': CORRIDOR}]
+
+    index = GeofenceIndex(topics)
+
+    assert [topic['topic_id'] for topic in index.topics] == [2]
+    assert "Skipping topic 1 with an invalid region" in caplog.text
+
+
+def test_geofence_index_skips_invalid_rules(liverpool_earthquake, example_topic, caplog):
+    topics = [{**example_topic, 'topic_id': 1, 'region': CORRIDOR, 'rules': {'max_dpeth': 70}},
+              {**example_topic, 'topic_id': 2, 'region': CORRIDOR}]
+
+    matches = GeofenceIndex(topics).match([liverpool_earthquake])
+
+    assert [match['topic']['topic_id'] for match in matches] == [2]
+    assert "Skipping topic 1 with invalid rules" in caplog.text
+
+
+def test_get_geofence_index_kept_warm(example_topic):
+    WARM_INDEX.clear()
+    topics = [{**example_topic, 'region': CORRIDOR}]
+
+    index = get_geofence_index(topics)
+
+    assert get_geofence_index([dict(topic) for topic in topics]) is index
+    assert get_geofence_index([{**example_topic, 'region': SERVICE_AREAS}]) is not index
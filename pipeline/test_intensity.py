@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from intensity import predict_intensity, get_intensity_reach, match_intensity, MAX_REACH_KM
+
+
+def test_predict_intensity_known_value():
+    # M6 at 10km depth: R = sqrt(10^2 + 14^2), inside the 30km transition distance
+    r = np.sqrt(10 ** 2 + 14 ** 2)
+    expected = 12.27 - 1.30 * np.log10(r) - 0.000707 * r - 0.577 * 6 * np.log10(r)
+
+    assert predict_intensity(6.0, 10, np.array([0.0]))[0] == pytest.approx(expected)
+
+
+def test_predict_intensity_falls_with_distance_and_depth():
+    distances = np.array([0, 10, 50, 100, 300])
+
+    shallow = predict_intensity(6.5, 5, distances)
+    deep = predict_intensity(6.5, 300, distances)
+
+    assert np.all(np.diff(shallow) < 0)
+    assert np.all(deep < shallow)
+
+
+def test_predict_intensity_vectorised_over_earthquakes():
+    intensities = predict_intensity(np.array([[4.0], [7.0]]), np.array([[10], [10]]),
+                                    np.array([0, 100, 200]))
+
+    assert intensities.shape == (2, 3)
+    assert np.all(intensities[1] > intensities[0])
+
+
+def test_predict_intensity_clipped():
+    assert predict_intensity(9.5, 0, np.array([0.0]))[0] == 10.0
+    assert predict_intensity(2.0, 0, np.array([900.0]))[0] == 1.0
+
+
+def test_get_intensity_reach():
+    reach = get_intensity_reach(6.0, 0, 4.0)
+
+    assert predict_intensity(6.0, 0, np.array([reach]))[0] >= 4.0
+    assert predict_intensity(6.0, 0, np.array([reach + 1]))[0] < 4.0
+
+
+def test_get_intensity_reach_deep_earthquakes_reach_less():
+    assert get_intensity_reach(6.0, 300, 4.0) is None
+    assert get_intensity_reach(6.0, None, 4.0) == get_intensity_reach(6.0, 0, 4.0)
+
+
+def test_get_intensity_reach_great_earthquakes_beyond_1000km():
+    reach = get_intensity_reach(9.0, 0, 2.0)
+
+    assert reach > 1000
+    assert predict_intensity(9.0, 0, np.array([reach]))[0] >= 2.0
+    assert predict_intensity(9.0, 0, np.array([reach + 1]))[0] < 2.0
+
+
+def test_get_intensity_reach_capped():
+    assert get_intensity_reach(9.0, 0, 1.0) == MAX_REACH_KM
+
+
+def test_match_intensity(liverpool_earthquake, example_topic):
+    topics = [{**example_topic, 'topic_id': 1, 'min_intensity': 6.5, 'min_magnitude': 0},
+              {**example_topic, 'topic_id': 2, 'min_intensity': 7.5, 'min_magnitude': 0},
+              {**example_topic, 'topic_id': 3, 'min_intensity': 3.0, 'min_magnitude': 6.5},
+              {**example_topic, 'topic_id': 4, 'min_intensity': 3.0, 'min_magnitude': 0,
+               'rules': {'min_alert': 'red'}}]
+
+    matches = match_intensity([liverpool_earthquake], topics)
+
+    assert [match['topic']['topic_id'] for match in matches] == [1]
+    assert matches[0]['intensity'] == 6.8
+
+
+def test_match_intensity_skips_missing_magnitude(example_topic):
+    earthquake = {'earthquake_id': 'eq', 'magnitude': None, 'lat': 0, 'lon': 0}
+
+    assert match_intensity([earthquake], [{**example_topic, 'min_intensity': 2}]) == []
+
+
+def test_match_intensity_skips_invalid_rules(liverpool_earthquake, example_topic):
+    topics = [{**example_topic, 'topic_id': 1, 'min_intensity': 3.0, 'rules': {'max_dpeth': 70}},
+              {**example_topic, 'topic_id': 2, 'min_intensity': 3.0}]
+
+    matches = match_intensity([liverpool_earthquake], topics)
+
+    assert [match['topic']['topic_id'] for match in matches] == [2]
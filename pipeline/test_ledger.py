@@ -0,0 +1,118 @@
+from datetime import datetime, timezone
+from unittest.mock import MagicMock, patch
+from ledger import (get_previous_deliveries, get_delivery_records, get_held_records,
+                    get_digest_records, record_deliveries, record_digest_deliveries)
+
+
+def test_get_previous_deliveries():
+    conn = MagicMock()
+    cursor = MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cursor
+    cursor.fetchall.return_value = [
+        {'earthquake_id': 'ak0247tc2ogk', 'topic_id': 12, 'magnitude': 3.2}]
+
+    deliveries = get_previous_deliveries(conn, ['ak0247tc2ogk', 'ak0247tbx02t'])
+
+    cursor.execute.assert_called_once()
+    query, params = cursor.execute.call_args[0]
+    assert "earthquake_id = ANY(%s)" in query
+    assert params == (['ak0247tc2ogk', 'ak0247tbx02t'],)
+    assert deliveries == {('ak0247tc2ogk', 12): {
+        'earthquake_id': 'ak0247tc2ogk', 'topic_id': 12, 'magnitude': 3.2}}
+
+
+def test_get_previous_deliveries_no_earthquakes():
+    conn = MagicMock()
+
+    assert get_previous_deliveries(conn, []) == {}
+    conn.cursor.assert_not_called()
+
+
+def test_get_previous_deliveries_error(caplog):
+    conn = MagicMock()
+    conn.cursor.side_effect = Exception("Database connection error")
+
+    assert get_previous_deliveries(conn, ['ak0247tc2ogk']) == {}
+    assert "An unexpected error occurred getting previous alert deliveries" in caplog.text
+
+
+def test_get_delivery_records(liverpool_earthquake, example_topics):
+    detected_at = datetime(2024, 6, 24, 12, 22, 30, tzinfo=timezone.utc)
+    published_at = datetime(2024, 6, 24, 12, 22, 31, tzinfo=timezone.utc)
+    matches = [{'earthquake': liverpool_earthquake, 'topic': topic, 'distance': 0}
+               for topic in example_topics[3:]]
+    results = [{'key': ('ak0247tc2ogk', 11), 'delivered': False, 'published_at': None},
+               {'key': ('ak0247tc2ogk', 12), 'delivered': True, 'published_at': published_at}]
+
+    assert get_delivery_records(matches, results, detected_at) == [
+        ('ak0247tc2ogk', 12, 6.0, '2024-06-24 12: 22: 22', detected_at, published_at)]
+
+
+def test_get_held_records(liverpool_earthquake, example_topic):
+    detected_at = datetime(2024, 6, 24, 12, 22, 30, tzinfo=timezone.utc)
+    matches = [{'earthquake': liverpool_earthquake, 'topic': example_topic, 'distance': 0}]
+
+    assert get_held_records(matches, detected_at) == [
+        ('ak0247tc2ogk', 12, 6.0, '2024-06-24 12: 22: 22', detected_at, None)]
+
+
+def test_get_digest_records():
+    published_at = datetime(2024, 6, 24, 12, 22, 31, tzinfo=timezone.utc)
+    digests = [{'topic_id': 12, 'pending': [{'earthquake_id': 'eq1'}, {'earthquake_id': 'eq2'}]},
+               {'topic_id': 13, 'pending': [{'earthquake_id': 'eq1'}]}]
+    results = [{'key': ('digest', 12), 'delivered': True, 'published_at': published_at},
+               {'key': ('digest', 13), 'delivered': False, 'published_at': None}]
+
+    assert get_digest_records(digests, results) == [('eq1', 12, published_at),
+                                                     ('eq2', 12, published_at)]
+
+
+@patch('ledger.psycopg2.extras.execute_values')
+def test_record_digest_deliveries(mock_execute_values):
+    conn = MagicMock()
+    records = [('eq1', 12, datetime(2024, 6, 24, 12, 22, 31, tzinfo=timezone.utc))]
+
+    record_digest_deliveries(conn, records)
+
+    assert "UPDATE alert_deliveries" in mock_execute_values.call_args[0][1]
+    assert mock_execute_values.call_args[0][2] == records
+    conn.commit.assert_called_once()
+
+
+def test_record_digest_deliveries_nothing_to_record():
+    conn = MagicMock()
+
+    record_digest_deliveries(conn, [])
+
+    conn.cursor.assert_not_called()
+
+
+@patch('ledger.psycopg2.extras.execute_values')
+def test_record_deliveries(mock_execute_values):
+    conn = MagicMock()
+    records = [('ak0247tc2ogk', 12, 6.0, '2024/06/24 12:22:22', None, None)]
+
+    record_deliveries(conn, records)
+
+    mock_execute_values.assert_called_once()
+    assert "ON CONFLICT (earthquake_id, topic_id) DO UPDATE" in mock_execute_values.call_args[0][1]
+    assert mock_execute_values.call_args[0][2] == records
+    conn.commit.assert_called_once()
+
+
+def test_record_deliveries_nothing_to_record():
+    conn = MagicMock()
+
+    record_deliveries(conn, [])
+
+    conn.cursor.assert_not_called()
+
+
+@patch('ledger.psycopg2.extras.execute_values', side_effect=Exception("Insert failed"))
+def test_record_deliveries_error(mock_execute_values, caplog):
+    conn = MagicMock()
+
+    record_deliveries(conn, [('ak0247tc2ogk', 12, 6.0, None, None, None)])
+
+    conn.rollback.assert_called_once()
+    assert "An unexpected error occurred recording alert deliveries" in caplog.text
@@ -1,8 +1,9 @@
+import time
 import pytest
 import logging
 from psycopg2 import OperationalError
 from unittest.mock import MagicMock, patch
-from load import execute_query, execute_insert, fetch_all, get_or_add_id, add_earthquake_data_to_rds
+from load import execute_query, execute_insert, fetch_all, get_or_add_id, add_earthquake_data_to_rds, get_earthquake_row, INSERT_EARTHQUAKE_QUERY, get_regions, get_continent_code, record_data_load, load_process
 
 
 def test_execute_query(mock_cursor):
@@ -116,9 +117,11 @@ def test_add_earthquake_data_to_rds(mock_connection, mock_cursor, example_transf
             patch("load.get_type_id", return_value=1) as mock_get_type_id:
 
         with caplog.at_level(logging.INFO):
-            add_earthquake_data_to_rds(mock_connection, mock_cursor, example_transformed_data,
-                                       all_alerts, all_statuses, all_networks, all_magtypes, all_types)
+            added = add_earthquake_data_to_rds(mock_connection, mock_cursor, example_transformed_data,
+                                               all_alerts, all_statuses, all_networks, all_magtypes, all_types)
+        assert added == 1
         mock_cursor.execute.assert_called_once()
+        assert mock_cursor.execute.call_args[0][1][-3:] == ("US", "NA", "Alaska")
         mock_connection.commit.assert_called_once()
         mock_get_network_id.assert_called_once_with(
             mock_connection, mock_cursor, "ak", all_networks)
@@ -130,6 +133,27 @@ def test_add_earthquake_data_to_rds(mock_connection, mock_cursor, example_transf
             "Successfully added earthquake" in message for message in caplog.text.splitlines())
 
 
+def test_get_earthquake_row_matches_insert_columns(example_transformed_data):
+    region = {"country_code": "US", "continent_code": "NA", "state": "Alaska"}
+
+    row = get_earthquake_row(example_transformed_data[0], (1, 2, 3, 4, 5), region)
+
+    assert len(row) == INSERT_EARTHQUAKE_QUERY.count("%s")
+    assert row[:6] == (example_transformed_data[0]["earthquake_id"], 1, 2, 3, 4, 5)
+    assert row[6] == example_transformed_data[0]["magnitude"]
+    assert row[-3:] == ("US", "NA", "Alaska")
+
+
+def test_add_earthquake_data_to_rds_stops_at_deadline(mock_connection, mock_cursor, example_transformed_data, caplog, example_id_tables):
+    with patch("load.get_network_id", return_value=1), patch("load.get_magtype_id", return_value=1), patch("load.get_type_id", return_value=1):
+        added = add_earthquake_data_to_rds(mock_connection, mock_cursor, example_transformed_data,
+                                           *example_id_tables, deadline=time.monotonic() - 1)
+
+    assert added == 0
+    mock_cursor.execute.assert_not_called()
+    assert "Load deadline passed, 1 earthquakes not added" in caplog.text
+
+
 def test_add_earthquake_data_with_db_error(mock_connection, mock_cursor, example_transformed_data, caplog, example_id_tables):
     all_alerts, all_statuses, all_networks, all_magtypes, all_types = example_id_tables
     mock_cursor.execute = MagicMock(
@@ -154,3 +178,61 @@ def test_add_earthquake_data_with_generic_error(mock_connection, mock_cursor, ex
                                        all_alerts, all_statuses, all_networks, all_magtypes, all_types)
         assert any(
             "Unexpected error while adding earthquake data" in message for message in caplog.text.splitlines())
+
+
+def test_get_regions():
+    earthquakes = [{"lat": 38.8, "lon": -122.8}, {"lat": 35.6, "lon": 139.7}]
+
+    with patch("load.rg.search", wraps=__import__("reverse_geocode").search) as mock_search:
+        regions = get_regions(earthquakes)
+
+    mock_search.assert_called_once()
+    assert regions == [{"country_code": "US", "continent_code": "NA", "state": "California"},
+                       {"country_code": "JP", "continent_code": "AS", "state": None}]
+
+
+def test_get_regions_empty():
+    assert get_regions([]) == []
+
+
+def test_get_regions_error(caplog):
+    with patch("load.rg.search", side_effect=Exception("Example error")):
+        with caplog.at_level(logging.ERROR):
+            regions = get_regions([{"lat": 38.8, "lon": -122.8}])
+
+    assert regions == [{"country_code": None, "continent_code": None, "state": None}]
+    assert "Unable to reverse geocode earthquakes" in caplog.text
+
+
+@pytest.mark.parametrize("country_code, continent_code", [("GB", "EU"), ("TL", "AS"), ("XX", None)])
+def test_get_continent_code(country_code, continent_code):
+    assert get_continent_code(country_code) == continent_code
+
+
+def test_record_data_load(mock_connection, mock_cursor):
+    mock_cursor.fetchone.return_value = {"load_id": 7}
+
+    assert record_data_load(mock_connection, mock_cursor, 3) == 7
+    assert mock_cursor.execute.call_args_list[0][0][1] == (3,)
+    assert mock_cursor.execute.call_args_list[1][0][1] == ("data_loads", "7")
+    mock_connection.commit.assert_called_once()
+
+
+def test_record_data_load_error(mock_connection, mock_cursor, caplog):
+    mock_cursor.execute.side_effect = OperationalError("Example operational error")
+
+    with caplog.at_level(logging.ERROR):
+        assert record_data_load(mock_connection, mock_cursor, 3) is None
+    mock_connection.rollback.assert_called_once()
+    assert "Unable to record data load" in caplog.text
+
+
+@pytest.mark.parametrize("added, recorded", [(2, True), (0, False)])
+def test_load_process_records_data_load(added, recorded):
+    with patch("load.get_connection"), patch("load.get_cursor"), \
+            patch("load.fetch_all", return_value={}), \
+            patch("load.add_earthquake_data_to_rds", return_value=added), \
+            patch("load.record_data_load") as mock_record_load:
+        load_process([{}])
+
+    assert mock_record_load.called == recorded
@@ -0,0 +1,78 @@
+import time
+from unittest.mock import patch
+from main import run_stage, run_alert_and_load_stages, run_pipeline
+
+
+def test_run_stage_success():
+    result = run_stage(lambda data, deadline: None, [], 'Error')
+
+    assert result['status'] == 'succeeded'
+    assert result['duration'] >= 0
+
+
+def test_run_stage_failure(caplog):
+    def failing_stage(data, deadline):
+        raise ValueError('Database unavailable')
+
+    result = run_stage(failing_stage, [], 'Error during load')
+
+    assert result['status'] == 'failed'
+    assert result['error'] == 'Database unavailable'
+    assert "Error during load: Database unavailable" in caplog.text
+
+
+@patch('main.load_process', side_effect=lambda data, deadline: time.sleep(0.2))
+@patch('main.sns_alert_system', side_effect=lambda data, deadline: time.sleep(0.2))
+def test_run_alert_and_load_stages_concurrently(mock_sns, mock_load):
+    start = time.monotonic()
+
+    stages = run_alert_and_load_stages([{'earthquake_id': 'test'}], 5)
+
+    assert time.monotonic() - start < 0.35
+    assert stages['alerts']['status'] == 'succeeded'
+    assert stages['load']['status'] == 'succeeded'
+    deadline = mock_sns.call_args.kwargs['deadline']
+    assert 5 <= deadline - start < 5.5
+    mock_sns.assert_called_once_with([{'earthquake_id': 'test'}], deadline=deadline)
+    mock_load.assert_called_once_with([{'earthquake_id': 'test'}], deadline=deadline)
+
+
+@patch('main.load_process')
+@patch('main.sns_alert_system', side_effect=Exception('SNS unavailable'))
+def test_run_alert_and_load_stages_failure_is_isolated(mock_sns, mock_load, caplog):
+    stages = run_alert_and_load_stages([], 5)
+
+    assert stages['alerts']['status'] == 'failed'
+    assert stages['load']['status'] == 'succeeded'
+    assert "Error when sending SNS alerts: SNS unavailable" in caplog.text
+
+
+@patch('main.load_process')
+@patch('main.sns_alert_system', side_effect=lambda data, deadline: time.sleep(1))
+def test_run_alert_and_load_stages_timeout(mock_sns, mock_load, caplog):
+    start = time.monotonic()
+
+    stages = run_alert_and_load_stages([], 0.2)
+
+    assert time.monotonic() - start < 0.5
+    assert stages['alerts']['status'] == 'timed out'
+    assert stages['load']['status'] == 'succeeded'
+    assert "The alerts stage did not finish within 0.2s" in caplog.text
+
+
+@patch('main.run_alert_and_load_stages')
+@patch('main.transform_process')
+@patch('main.extract_process', return_value=[])
+def test_run_pipeline_no_data(mock_extract, mock_transform, mock_stages):
+    assert run_pipeline() is None
+    mock_transform.assert_not_called()
+    mock_stages.assert_not_called()
+
+
+@patch('main.run_alert_and_load_stages', return_value={'alerts': {'status': 'succeeded', 'duration': 1},
+                                                        'load': {'status': 'succeeded', 'duration': 2}})
+@patch('main.transform_process', return_value=[{'earthquake_id': 'test'}])
+@patch('main.extract_process', return_value=[{'id': 'test'}])
+def test_run_pipeline(mock_extract, mock_transform, mock_stages):
+    assert run_pipeline()['load']['duration'] == 2
+    assert mock_stages.call_args[0][0] == [{'earthquake_id': 'test'}]
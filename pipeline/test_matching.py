@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from haversine import haversine
+from matching import get_coordinate_arrays, get_value_array, calculate_distance_matrix, get_match_matrix
+
+
+def test_get_coordinate_arrays(example_topics):
+    lats, lons = get_coordinate_arrays(example_topics)
+
+    assert lats.shape == (5,)
+    assert lats[0] == pytest.approx(40.730610)
+    assert lons[4] == pytest.approx(-2.964996)
+
+
+def test_get_value_array_missing_values():
+    values = get_value_array([{'magnitude': 3}, {'magnitude': None}, {}], 'magnitude')
+
+    assert values[0] == 3.0
+    assert np.isnan(values[1])
+    assert np.isnan(values[2])
+
+
+def test_calculate_distance_matrix_matches_haversine():
+    eq_lats, eq_lons = np.array([40.7128, 35.6895]), np.array([-74.0060, 139.6917])
+    topic_lats, topic_lons = np.array([51.5074, 22.3193, 40.7128]), np.array([-0.1278, 114.1694, -74.0060])
+
+    distances = calculate_distance_matrix(eq_lats, eq_lons, topic_lats, topic_lons)
+
+    assert distances.shape == (2, 3)
+    for i in range(2):
+        for j in range(3):
+            assert distances[i, j] == pytest.approx(
+                haversine((eq_lats[i], eq_lons[i]), (topic_lats[j], topic_lons[j])))
+    assert distances[0, 2] == 0
+
+
+def test_get_match_matrix():
+    distances = np.array([[10.5, 50.9, 51.0],
+                          [10.5, 50.9, 51.0]])
+    radii = np.array([50, np.nan])
+    magnitudes = np.array([3.5, 6.0])
+    min_magnitudes = np.array([3.0, 3.5, 3.0])
+
+    matches = get_match_matrix(distances, radii, magnitudes, min_magnitudes)
+
+    assert matches.tolist() == [[True, True, False],
+                                [False, False, False]]
@@ -0,0 +1,190 @@
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+import pytest
+from botocore.exceptions import ClientError
+from publisher import (TokenBucket, get_publish_rate, get_error_code, get_backoff_delay,
+                       call_with_retry, map_concurrently, publish_with_retry, publish_messages,
+                       DEFAULT_PUBLISH_RATE)
+
+
+def make_messages(count):
+    return [{'key': index, 'arn': f'arn:aws:sns:eu-west-2:123456789012:topic-{index}',
+             'subject': 'EARTHQUAKE WARNING', 'message': f'Test message {index}'}
+            for index in range(count)]
+
+
+def throttling_error():
+    return ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, 'Publish')
+
+
+def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=50, capacity=1)
+    start = time.monotonic()
+    for _ in range(11):
+        bucket.acquire()
+    assert time.monotonic() - start >= 0.19
+
+
+def test_token_bucket_allows_burst():
+    bucket = TokenBucket(rate=1, capacity=5)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    assert time.monotonic() - start < 0.1
+
+
+@pytest.mark.parametrize("rate", [0, -5])
+def test_token_bucket_rejects_non_positive_rate(rate):
+    with pytest.raises(ValueError):
+        TokenBucket(rate)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("250", 250.0), ("0.5", 0.5), ("0", DEFAULT_PUBLISH_RATE), ("-1", DEFAULT_PUBLISH_RATE),
+    ("fast", DEFAULT_PUBLISH_RATE), ("inf", DEFAULT_PUBLISH_RATE)])
+def test_get_publish_rate(value, expected):
+    with patch.dict('publisher.ENV', {'SNS_PUBLISH_RATE': value}):
+        assert get_publish_rate() == expected
+
+
+def test_get_publish_rate_default():
+    with patch.dict('publisher.ENV', clear=True):
+        assert get_publish_rate() == DEFAULT_PUBLISH_RATE
+
+
+def test_get_error_code():
+    assert get_error_code(throttling_error()) == 'Throttling'
+    assert get_error_code(ValueError('test')) is None
+
+
+@pytest.mark.parametrize("attempt", [0, 1, 5, 20])
+def test_get_backoff_delay(attempt):
+    assert 0 <= get_backoff_delay(attempt, 0.1) <= min(5.0, 0.1 * 2 ** attempt)
+
+
+def test_call_with_retry_returns_last_error():
+    function = MagicMock(side_effect=[throttling_error(), ValueError('bad request')])
+
+    outcome = call_with_retry(function, {'Name': 'topic'}, TokenBucket(1000), 3, 0.001)
+
+    assert outcome['response'] is None
+    assert str(outcome['error']) == 'bad request'
+    assert outcome['attempts'] == 2
+    assert outcome['throttled'] == 1
+    function.assert_called_with(Name='topic')
+
+
+def test_call_with_retry_stops_at_deadline():
+    function = MagicMock(side_effect=throttling_error())
+
+    outcome = call_with_retry(function, {}, TokenBucket(1000), 5, 0.05,
+                              deadline=time.monotonic() + 0.03)
+
+    assert isinstance(outcome['error'], TimeoutError)
+    assert outcome['attempts'] < 6
+
+
+def test_publish_messages_not_sent_after_deadline(stub_sns, stub_sns_client):
+    summary = publish_messages(stub_sns_client, make_messages(5), publish_rate=1000,
+                               deadline=time.monotonic() - 1)
+
+    assert summary['delivered'] == 0
+    assert stub_sns['published'] == []
+    assert all(result['error'] == 'deadline passed before the call was made'
+               for result in summary['results'])
+
+
+def test_map_concurrently_keeps_order():
+    assert map_concurrently(lambda number: number * 2, [3, 1, 2], 2) == [6, 2, 4]
+    assert map_concurrently(lambda number: number, [], 2) == []
+
+
+def test_publish_with_retry_retries_throttling():
+    sns_client = MagicMock()
+    sns_client.publish.side_effect = [throttling_error(), {'MessageId': 'abc'}]
+
+    result = publish_with_retry(sns_client, make_messages(1)[0], TokenBucket(1000), 3, 0.001)
+
+    assert result['delivered']
+    assert result['attempts'] == 2
+    assert result['throttled'] == 1
+    assert result['message_id'] == 'abc'
+
+
+def test_publish_with_retry_does_not_retry_other_errors(caplog):
+    sns_client = MagicMock()
+    sns_client.publish.side_effect = ClientError(
+        {'Error': {'Code': 'NotFound', 'Message': 'Topic does not exist'}}, 'Publish')
+
+    result = publish_with_retry(sns_client, make_messages(1)[0], TokenBucket(1000), 3, 0.001)
+
+    assert not result['delivered']
+    assert result['attempts'] == 1
+    assert result['error'] == 'NotFound'
+    assert "Failed to publish message" in caplog.text
+
+
+def test_publish_messages_no_messages():
+    summary = publish_messages(MagicMock(), [])
+
+    assert summary['attempted'] == 0
+    assert summary['results'] == []
+
+
+def test_publish_messages_concurrently(stub_sns, stub_sns_client):
+    stub_sns['latency'] = 0.05
+
+    summary = publish_messages(stub_sns_client, make_messages(20),
+                               max_workers=10, publish_rate=1000)
+
+    assert summary['delivered'] == 20
+    assert summary['failed'] == 0
+    assert [result['key'] for result in summary['results']] == list(range(20))
+    assert stub_sns['max_in_flight'] > 1
+    assert summary['duration'] < 20 * 0.05
+
+
+def test_publish_messages_retries_throttling(stub_sns, stub_sns_client):
+    stub_sns['throttle_every'] = 3
+
+    summary = publish_messages(stub_sns_client, make_messages(12), max_workers=4,
+                               publish_rate=1000, max_retries=5, base_delay=0.001)
+
+    assert summary['delivered'] == 12
+    assert summary['throttled'] > 0
+    assert len(stub_sns['published']) == 12
+    assert {body['Message'][0] for body in stub_sns['published']} == {
+        f'Test message {index}' for index in range(12)}
+
+
+def test_publish_messages_reports_exhausted_retries(stub_sns, stub_sns_client):
+    stub_sns['throttle_every'] = 1
+
+    summary = publish_messages(stub_sns_client, make_messages(3), max_workers=3,
+                               publish_rate=1000, max_retries=2, base_delay=0.001)
+
+    assert summary['delivered'] == 0
+    assert summary['failed'] == 3
+    assert summary['throttled'] == 9
+    assert all(result['error'] == 'Throttling' for result in summary['results'])
+
+
+def test_publish_messages_respects_rate_limit(stub_sns, stub_sns_client):
+    start = time.monotonic()
+
+    summary = publish_messages(stub_sns_client, make_messages(30), max_workers=10, publish_rate=20)
+
+    assert summary['delivered'] == 30
+    assert time.monotonic() - start >= 0.45
+
+
+def test_publish_with_retry_records_latency():
+    sns_client = MagicMock()
+    sns_client.publish.return_value = {'MessageId': 'abc'}
+    message = {**make_messages(1)[0],
+               'event_time': datetime.now(timezone.utc) - timedelta(seconds=30)}
+
+    result = publish_with_retry(sns_client, message, TokenBucket(1000), 0, 0.001)
+
+    assert 30 <= result['latency'] < 31
@@ -0,0 +1,168 @@
+import numpy as np
+import pytest
+from haversine import haversine
+from rules import (get_rule_predicates, get_topic_predicates, evaluate_predicate, get_bucket,
+                   get_buckets_in_radius, get_candidates, RuleIndex)
+
+
+def test_get_rule_predicates():
+    predicates = get_rule_predicates({'max_depth': 70, 'min_alert': 'orange',
+                                      'types': ['earthquake'], 'min_felt': None})
+
+    assert predicates == [('max_depth', 70.0), ('min_alert', 2),
+                          ('types', frozenset({'earthquake'}))]
+
+
+def test_get_rule_predicates_no_rules():
+    assert get_rule_predicates(None) == []
+    assert get_rule_predicates({}) == []
+
+
+@pytest.mark.parametrize("rules", [{'max_wind': 10}, {'min_alert': 'purple'},
+                                   {'types': 'earthquake'}, {'max_depth': 'shallow'}])
+def test_get_rule_predicates_invalid(rules):
+    with pytest.raises(ValueError):
+        get_rule_predicates(rules)
+
+
+def test_get_topic_predicates_skips_invalid_topics(caplog):
+    topics = [{'topic_id': 1, 'rules': {'max_dpeth': 70}},
+              {'topic_id': 2, 'rules': {'max_depth': 70}},
+              {'topic_id': 3, 'rules': None}]
+
+    valid_topics, predicates = get_topic_predicates(topics)
+
+    assert [topic['topic_id'] for topic in valid_topics] == [2, 3]
+    assert predicates == [[('max_depth', 70.0)], []]
+    assert "Skipping topic 1 with invalid rules" in caplog.text
+
+
+@pytest.mark.parametrize("predicate, expected", [
+    (('min_depth', 10.0), True),
+    (('max_depth', 10.0), False),
+    (('min_mmi', 4.0), True),
+    (('min_felt', 100), False),
+    (('min_alert', 1), True),
+    (('min_alert', 2), False),
+    (('types', frozenset({'earthquake', 'explosion'})), True),
+    (('types', frozenset({'quarry blast'})), False)
+])
+def test_evaluate_predicate(predicate, expected):
+    earthquake = {'depth': 35.2, 'mmi': 4.4, 'felt': 12,
+                  'alert': 'yellow', 'earthquake_type': 'earthquake'}
+
+    assert evaluate_predicate(predicate, earthquake) == expected
+
+
+def test_evaluate_predicate_missing_value():
+    earthquake = {'depth': None, 'mmi': None, 'felt': None, 'alert': None}
+
+    assert not evaluate_predicate(('max_depth', 10.0), earthquake)
+    assert not evaluate_predicate(('min_felt', 0), earthquake)
+    assert not evaluate_predicate(('min_alert', 0), earthquake)
+
+
+def test_evaluate_predicate_unknown_field():
+    assert not evaluate_predicate(('max_wind', 10.0), {'max_wind': 5.0})
+
+
+def test_get_candidates_filters_magnitude_and_rules():
+    index = RuleIndex([{'topic_id': 1, 'min_magnitude': 2.0, 'lat': 0, 'lon': 0, 'rules': None},
+                       {'topic_id': 2, 'min_magnitude': 3.0, 'lat': 0, 'lon': 0,
+                        'rules': {'min_felt': 10}},
+                       {'topic_id': 3, 'min_magnitude': 4.0, 'lat': 0, 'lon': 0,
+                        'rules': {'min_felt': 10}},
+                       {'topic_id': 4, 'min_magnitude': 5.0, 'lat': 0, 'lon': 0, 'rules': None}])
+    bucket = index.buckets[get_bucket(0, 0)]
+
+    felt = get_candidates(bucket, 4.5, ~index.get_earthquake_mask({'felt': 20}))
+    not_felt = get_candidates(bucket, 4.5, ~index.get_earthquake_mask({'felt': 0}))
+
+    assert [index.topics[bucket['topic_indices'][i]]['topic_id'] for i in felt] == [1, 2, 3]
+    assert [index.topics[bucket['topic_indices'][i]]['topic_id'] for i in not_felt] == [1]
+    assert get_candidates(bucket, 1.0, ~index.get_earthquake_mask({})).size == 0
+
+
+def test_get_bucket():
+    assert get_bucket(53.4, -2.96) == (26, -2)
+    assert get_bucket(-0.5, 179.9) == (-1, 89)
+
+
+def test_get_buckets_in_radius_crosses_antimeridian():
+    buckets = get_buckets_in_radius(0.5, 179.9, 50)
+
+    assert (0, 89) in buckets
+    assert (0, -90) in buckets
+
+
+def test_rule_index_masks_beyond_one_word():
+    topics = [{'topic_id': i, 'min_magnitude': 0, 'lat': 0, 'lon': 0,
+               'rules': {'min_felt': i}} for i in range(100)]
+
+    index = RuleIndex(topics)
+    matches = index.match([{'earthquake_id': 'eq', 'magnitude': 3.0, 'lat': 0, 'lon': 0,
+                            'felt': 70}], [50])
+
+    assert index.words == 2
+    assert sorted(match['topic']['topic_id'] for match in matches) == list(range(71))
+
+
+def test_rule_index_filters_magnitude_and_distance(liverpool_earthquake, example_topics):
+    matches = RuleIndex(example_topics).match([liverpool_earthquake], [200])
+
+    assert [match['topic']['topic_id'] for match in matches] == [12]
+    assert matches[0]['distance'] == 0
+
+
+def test_rule_index_combines_rules(liverpool_earthquake, example_topic):
+    topics = [{**example_topic, 'topic_id': 1, 'rules': {'max_depth': 10, 'min_alert': 'green'}},
+              {**example_topic, 'topic_id': 2, 'rules': {'max_depth': 10, 'min_alert': 'red'}},
+              {**example_topic, 'topic_id': 3, 'rules': {'types': ['explosion']}},
+              {**example_topic, 'topic_id': 4}]
+
+    matches = RuleIndex(topics).match([liverpool_earthquake], [200])
+
+    assert sorted(match['topic']['topic_id'] for match in matches) == [1, 4]
+
+
+def test_rule_index_skips_topics_with_invalid_rules(liverpool_earthquake, example_topic):
+    topics = [{**example_topic, 'topic_id': 1, 'rules': {'max_dpeth': 70}},
+              {**example_topic, 'topic_id': 2, 'rules': {'types': 'earthquake'}},
+              {**example_topic, 'topic_id': 3}]
+
+    matches = RuleIndex(topics).match([liverpool_earthquake], [200])
+
+    assert [match['topic']['topic_id'] for match in matches] == [3]
+
+
+def test_rule_index_skips_earthquakes_without_radius(liverpool_earthquake, example_topics):
+    assert RuleIndex(example_topics).match([liverpool_earthquake], [None]) == []
+
+
+def test_rule_index_parity_with_brute_force():
+    rng = np.random.default_rng(36)
+    alerts = ['green', 'yellow', 'orange', 'red']
+    earthquakes = [{'earthquake_id': f'eq{i}',
+                    'magnitude': round(float(rng.uniform(2, 7)), 1),
+                    'lat': float(rng.uniform(30, 40)), 'lon': float(rng.uniform(-125, -115)),
+                    'depth': float(rng.uniform(0, 100)), 'felt': int(rng.integers(0, 50)),
+                    'alert': alerts[rng.integers(0, 4)],
+                    'earthquake_type': 'earthquake'} for i in range(30)]
+    topics = [{'topic_id': i, 'min_magnitude': float(rng.integers(2, 7)),
+               'lat': float(rng.uniform(30, 40)), 'lon': float(rng.uniform(-125, -115)),
+               'rules': {'max_depth': float(rng.choice([10, 50, 100])),
+                         'min_alert': alerts[rng.integers(0, 4)]}} for i in range(500)]
+    radius = 200
+
+    brute_force = {(earthquake['earthquake_id'], topic['topic_id'])
+                   for earthquake in earthquakes for topic in topics
+                   if earthquake['magnitude'] >= topic['min_magnitude']
+                   and int(haversine((earthquake['lat'], earthquake['lon']),
+                                     (topic['lat'], topic['lon']))) <= radius
+                   and all(evaluate_predicate(predicate, earthquake)
+                           for predicate in get_rule_predicates(topic['rules']))}
+    matches = {(match['earthquake']['earthquake_id'], match['topic']['topic_id'])
+               for match in RuleIndex(topics).match(earthquakes, [radius] * len(earthquakes))}
+
+    assert brute_force
+    assert matches == brute_force
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+from sharding import (encode_geohash, get_geohash_cell_size, get_prefixes_in_box,
+                      get_topic_prefixes, get_max_alert_distance, get_earthquake_prefixes,
+                      assign_shards, merge_matches, ShardMatcher, ShardCoordinator)
+from sns import find_topic_matches
+
+
+def test_encode_geohash():
+    assert encode_geohash(57.64911, 10.40744, 11) == 'u4pruydqqvj'
+    assert encode_geohash(53.407624, -2.964996, 2) == 'gc'
+
+
+def test_get_geohash_cell_size():
+    assert get_geohash_cell_size(1) == (45.0, 45.0)
+    assert get_geohash_cell_size(2) == (5.625, 11.25)
+
+
+def test_get_prefixes_in_box():
+    prefixes = get_prefixes_in_box(52, 54, -3, -2, 2)
+
+    assert prefixes == {'gc'}
+    assert len(get_prefixes_in_box(-90, 90, -180, 180, 1)) == 32
+
+
+def test_get_topic_prefixes(example_topic):
+    region_topic = {**example_topic, 'region': 'POLYGON ((-3 53, 1 53, 1 54, -3 54, -3 53))'}
+
+    assert get_topic_prefixes(example_topic, 2) == {'gc'}
+    assert get_topic_prefixes(region_topic, 2) == {'gc', 'u1'}
+    assert get_topic_prefixes({**example_topic, 'region': 'invalid'}, 2) == set()
+
+
+def test_get_max_alert_distance(liverpool_earthquake):
+    assert get_max_alert_distance(liverpool_earthquake) > 200
+    assert get_max_alert_distance({**liverpool_earthquake, 'magnitude': None}) is None
+
+
+def test_get_earthquake_prefixes_reach_beyond_1000km_for_great_earthquakes(liverpool_earthquake):
+    earthquake = {**liverpool_earthquake, 'lat': 38.3, 'lon': 142.4, 'magnitude': 9.0, 'depth': 0}
+
+    prefixes = get_earthquake_prefixes(earthquake, 3)
+
+    assert get_max_alert_distance(earthquake) > 1000
+    # Sapporo to Okinawa, both about 1300km from the epicentre
+    assert encode_geohash(43.06, 141.35, 3) in prefixes
+    assert encode_geohash(26.2, 127.7, 3) in prefixes
+
+
+def test_get_earthquake_prefixes_crosses_antimeridian(liverpool_earthquake):
+    earthquake = {**liverpool_earthquake, 'lat': 51.0, 'lon': 179.9, 'magnitude': 3.0}
+
+    prefixes = get_earthquake_prefixes(earthquake, 2)
+
+    assert encode_geohash(51.0, 179.9, 2) in prefixes
+    assert encode_geohash(51.0, -179.9, 2) in prefixes
+
+
+def test_assign_shards_balances_load():
+    assignments = assign_shards({'gc': 10, 'u1': 6, '9q': 5, 'xn': 1}, 2)
+
+    assert assignments == {'gc': 0, 'u1': 1, '9q': 1, 'xn': 0}
+
+
+def test_merge_matches_drops_duplicates(liverpool_earthquake, example_topic):
+    worker_matches = [[{'earthquake_id': 'ak0247tc2ogk', 'topic': example_topic, 'distance': 5}],
+                      [{'earthquake_id': 'ak0247tc2ogk', 'topic': example_topic, 'distance': 5}],
+                      []]
+
+    matches = merge_matches([liverpool_earthquake], worker_matches)
+
+    assert matches == [{'earthquake': liverpool_earthquake, 'topic': example_topic,
+                        'distance': 5}]
+
+
+def test_shard_matcher(liverpool_earthquake, example_topics):
+    assert [match['topic']['topic_id']
+            for match in ShardMatcher(example_topics).match([liverpool_earthquake])] == [12]
+
+
+def get_random_topics(rng, count):
+    return [{'topic_id': i, 'topic_arn': f'arn-{i}', 'min_magnitude': float(rng.integers(0, 6)),
+             'lat': float(rng.uniform(30, 60)), 'lon': float(rng.uniform(-20, 40)),
+             'min_intensity': 3.0 if i % 5 == 0 else None,
+             'region': 'POLYGON ((-5 50, 5 50, 5 60, -5 60, -5 50))' if i % 50 == 0 else None,
+             'rules': {}} for i in range(count)]
+
+
+@pytest.mark.parametrize("worker_count", [1, 3])
+def test_shard_coordinator_parity(worker_count):
+    rng = np.random.default_rng(39)
+    topics = get_random_topics(rng, 2000)
+    earthquakes = [{'earthquake_id': f'eq{i}', 'magnitude': round(float(rng.uniform(2, 7)), 1),
+                    'lat': float(rng.uniform(30, 60)), 'lon': float(rng.uniform(-20, 40)),
+                    'depth': float(rng.uniform(0, 50))} for i in range(40)]
+    expected = {(match['earthquake']['earthquake_id'], match['topic']['topic_id'])
+                for match in find_topic_matches(earthquakes, topics)}
+
+    with ShardCoordinator(topics, worker_count) as coordinator:
+        matches = coordinator.match(earthquakes)
+        second_batch = coordinator.match(earthquakes[:5])
+
+    assert expected
+    assert len(matches) == len(expected)
+    assert {(match['earthquake']['earthquake_id'], match['topic']['topic_id'])
+            for match in matches} == expected
+    assert {match['earthquake']['earthquake_id'] for match in second_batch} <= {
+        f'eq{i}' for i in range(5)}
+
+
+def test_shard_coordinator_routes_only_nearby_workers(liverpool_earthquake, example_topics):
+    coordinator = ShardCoordinator(example_topics, 5)
+
+    routes = coordinator.route([{**liverpool_earthquake, 'magnitude': 3.0},
+                                {**liverpool_earthquake, 'magnitude': None}])
+
+    assert list(routes) == [coordinator.shard_workers['gc']]
+    assert len(routes[coordinator.shard_workers['gc']]) == 1
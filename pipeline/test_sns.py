@@ -3,6 +3,8 @@ from sns import *
 from unittest.mock import patch, MagicMock
 import boto3
 import pytest
+from decimal import Decimal
+import numpy as np
 
 def mock_env_get(key):
     if key == "ACCESS_KEY":
@@ -33,8 +35,10 @@ def test_get_sns_client_success(mock_env_get, mock_boto_client):
     mock_env_get.assert_any_call("SECRET_ACCESS_KEY")
     mock_boto_client.assert_called_once_with('sns',
                                              aws_access_key_id='fake_access_key',
-                                             aws_secret_access_key='fake_secret_key')
-    
+                                             aws_secret_access_key='fake_secret_key',
+                                             config=SNS_CLIENT_CONFIG)
+    assert SNS_CLIENT_CONFIG.retries == {'total_max_attempts': 1}
+
     assert client == mock_client
 
 
@@ -144,7 +148,7 @@ def test_calculate_distance_error(topic_coordinates, earthquake_coordinates, cap
     assert "Error calculating distance:" in caplog.text
 
 
-def test_get_topics_success():
+def test_get_topics_success(example_transformed_data):
 
     mock_conn = MagicMock()
     mock_cursor = MagicMock()
@@ -154,18 +158,83 @@ def test_get_topics_success():
                        ('Topic 2', 'Description 2')]
     mock_cursor.fetchall.return_value = mock_topic_data
 
-    topic_coordinates = get_topics(mock_conn)
+    topic_coordinates = get_topics(mock_conn, example_transformed_data)
 
     mock_conn.cursor.assert_called_once()
-    mock_cursor.execute.assert_called_once_with("SELECT * FROM topics;")
+    query, params = mock_cursor.execute.call_args[0]
+    assert "FROM topics" in query
+    assert "min_magnitude <= %s AND lat BETWEEN %s AND %s" in query
+    assert params[0] == 3.2
     assert topic_coordinates == mock_topic_data
 
+
+def test_get_topics_no_valid_earthquakes():
+    mock_conn = MagicMock()
+
+    assert get_topics(mock_conn, [{'magnitude': None, 'lat': 0, 'lon': 0}]) == []
+    mock_conn.cursor.assert_not_called()
+
+
+def test_get_bounding_boxes():
+    boxes = get_bounding_boxes(53.4, -2.96, 50)
+
+    assert len(boxes) == 1
+    min_lat, max_lat, min_lon, max_lon = boxes[0]
+    assert min_lat < 53.4 < max_lat
+    assert min_lon < -2.96 < max_lon
+    assert calculate_distance((53.4, -2.96), (53.4, min_lon)) >= 50
+    assert calculate_distance((53.4, -2.96), (max_lat, -2.96)) >= 49
+
+
+def test_get_bounding_boxes_crosses_antimeridian():
+    boxes = get_bounding_boxes(51.0, 179.5, 150)
+
+    assert len(boxes) == 2
+    assert boxes[0][3] == 180.0
+    assert boxes[1][2] == -180.0
+    assert boxes[1][3] > -180.0
+
+
+def test_get_bounding_boxes_near_pole():
+    assert get_bounding_boxes(89.5, 10, 200) == [(89.5 - 200 / 111.19, 90.0, -180.0, 180.0)]
+
+
+def test_get_topic_filters(example_transformed_data, liverpool_earthquake):
+    conditions, params = get_topic_filters(
+        example_transformed_data + [liverpool_earthquake])
+
+    assert len(conditions) == 5
+    assert conditions[0] == "(region IS NOT NULL AND min_magnitude <= %s)"
+    assert conditions[3].startswith("(min_intensity IS NOT NULL")
+    assert len(params) == 19
+    assert params[0] == 6.0
+    assert params[6] == 6.0
+
+
+def test_get_topic_filters_intensity_reaches_further(liverpool_earthquake):
+    conditions, params = get_topic_filters([liverpool_earthquake])
+
+    radius_min_lat = params[2]
+    intensity_min_lat = params[6]
+    assert conditions[2].startswith("(min_intensity IS NOT NULL")
+    assert intensity_min_lat < radius_min_lat
+
+
+def test_get_topic_filters_intensity_beyond_1000km_for_great_earthquakes(liverpool_earthquake):
+    _, params = get_topic_filters([{**liverpool_earthquake, 'magnitude': 9.0, 'depth': 0}])
+
+    intensity_min_lat, intensity_max_lat = params[6], params[7]
+    assert haversine((intensity_min_lat, liverpool_earthquake['lon']),
+                     (liverpool_earthquake['lat'], liverpool_earthquake['lon'])) > 1200
+    assert intensity_max_lat - liverpool_earthquake['lat'] > 1200 / 111.2
+
+
 @patch("sns.get_cursor")
 def test_get_topics_exception(mock_get_cursor, caplog):
     mock_get_cursor.side_effect = Exception("Database connection error")
 
     conn = MagicMock()
-    topics = get_topics(conn)
+    topics = get_topics(conn, [{'magnitude': 4.2, 'lat': 53.4, 'lon': -2.96}])
 
     assert topics == []
     assert "Error fetching topics: Database connection error" in caplog.text
@@ -237,10 +306,34 @@ def test_get_subscribed_users(example_users, example_topics):
     conn = MagicMock()
     cursor = MagicMock()
     conn.cursor.return_value.__enter__.return_value = cursor
-    cursor.execute.return_value = example_users
-    cursor.fetchall.return_value = example_users
-    assert get_subscribed_users(conn, example_topics) == [{'user_id': 22, 'email_address': 'trainee.joe.lam@sigmalabs.co.uk', 'phone_number': '447482569206', 'topic_arn': 'arn:aws:sns:eu-west-2:129033205317:c11-poseidon-test_email', 'min_magnitude': 4.5, 'lon': -2.964996, 'lat': 53.407624}, {
-        'user_id': 21, 'email_address': 'trainee.ella.jepsen@sigmalabs.co.uk', 'phone_number': '07552224539', 'topic_arn': 'arn:aws:sns:eu-west-2:129033205317:c11-poseidon-test', 'min_magnitude': 3, 'lon': -2.964996, 'lat': 53.407624}]
+    rows = [{**user, 'topic_id': topic_id}
+            for user, topic_id in zip(example_users, (12, 11))]
+    cursor.fetchall.return_value = rows
+
+    assert get_subscribed_users(conn, [12, 11]) == {
+        12: [{'user_id': 22, 'email_address': 'trainee.joe.lam@sigmalabs.co.uk', 'phone_number': '447482569206', 'topic_arn': 'arn:aws:sns:eu-west-2:129033205317:c11-poseidon-test_email', 'min_magnitude': 4.5, 'lon': -2.964996, 'lat': 53.407624}],
+        11: [{'user_id': 21, 'email_address': 'trainee.ella.jepsen@sigmalabs.co.uk', 'phone_number': '07552224539', 'topic_arn': 'arn:aws:sns:eu-west-2:129033205317:c11-poseidon-test', 'min_magnitude': 3, 'lon': -2.964996, 'lat': 53.407624}]}
+
+
+def test_get_subscribed_users_single_query(example_topics):
+    conn = MagicMock()
+    cursor = MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cursor
+    cursor.fetchall.return_value = []
+
+    get_subscribed_users(conn, [topic['topic_id'] for topic in example_topics])
+
+    cursor.execute.assert_called_once()
+    query, params = cursor.execute.call_args[0]
+    assert "uta.topic_id = ANY(%s)" in query
+    assert params == ([8, 9, 10, 11, 12],)
+
+
+def test_get_subscribed_users_no_topics():
+    conn = MagicMock()
+
+    assert get_subscribed_users(conn, []) == {}
+    conn.cursor.assert_not_called()
 
 def test_get_subscribed_users_error(example_users, caplog):
     conn = MagicMock()
@@ -289,3 +382,396 @@ def test_send_message_exception(caplog):
     )
 
     assert "An unexpected error occurred when sending messages:" in caplog.text
+
+
+def test_find_alert_matches(liverpool_earthquake, example_topics):
+    matches = find_alert_matches([liverpool_earthquake], example_topics)
+
+    assert len(matches) == 1
+    assert matches[0]['earthquake'] == liverpool_earthquake
+    assert matches[0]['topic']['topic_id'] == 12
+    assert matches[0]['distance'] == 0
+
+
+def test_find_alert_matches_no_topics(liverpool_earthquake):
+    assert find_alert_matches([liverpool_earthquake], []) == []
+
+
+def test_find_alert_matches_error(caplog):
+    assert find_alert_matches([{'lat': 'invalid', 'lon': 0}], [{'lat': 0, 'lon': 0}]) == []
+    assert "An unexpected error occurred matching earthquakes to topics" in caplog.text
+
+
+def test_find_alert_matches_parity_with_scalar_path():
+    rng = np.random.default_rng(26)
+    earthquakes = [{'earthquake_id': f'eq{i}',
+                    'magnitude': round(float(rng.uniform(0, 7)), 1),
+                    'lat': float(rng.uniform(33, 38)),
+                    'lon': float(rng.uniform(-123, -115))} for i in range(40)]
+    topics = [{'topic_id': i,
+               'min_magnitude': float(rng.integers(0, 7)),
+               'lat': Decimal(f"{rng.uniform(33, 38):.6f}"),
+               'lon': Decimal(f"{rng.uniform(-123, -115):.6f}")} for i in range(300)]
+
+    scalar_matches = {(earthquake['earthquake_id'], topic['topic_id'])
+                      for earthquake in earthquakes
+                      for topic in find_related_topics(earthquake, topics)}
+    vectorised_matches = {(match['earthquake']['earthquake_id'], match['topic']['topic_id'])
+                          for match in find_alert_matches(earthquakes, topics)}
+
+    assert scalar_matches
+    assert vectorised_matches == scalar_matches
+
+
+def test_find_rule_matches_parity_without_rules():
+    rng = np.random.default_rng(36)
+    earthquakes = [{'earthquake_id': f'eq{i}',
+                    'magnitude': round(float(rng.uniform(0, 7)), 1),
+                    'lat': float(rng.uniform(33, 38)),
+                    'lon': float(rng.uniform(-123, -115))} for i in range(40)]
+    topics = [{'topic_id': i,
+               'min_magnitude': float(rng.integers(0, 7)),
+               'lat': Decimal(f"{rng.uniform(33, 38):.6f}"),
+               'lon': Decimal(f"{rng.uniform(-123, -115):.6f}"),
+               'rules': {}} for i in range(300)]
+
+    vectorised_matches = {(match['earthquake']['earthquake_id'], match['topic']['topic_id'],
+                           match['distance'])
+                          for match in find_alert_matches(earthquakes, topics)}
+    rule_matches = {(match['earthquake']['earthquake_id'], match['topic']['topic_id'],
+                     match['distance'])
+                    for match in find_rule_matches(earthquakes, topics)}
+
+    assert vectorised_matches
+    assert rule_matches == vectorised_matches
+
+
+def test_find_rule_matches_parity_with_scalar_path():
+    rng = np.random.default_rng(27)
+    earthquakes = [{'earthquake_id': f'eq{i}',
+                    'magnitude': round(float(rng.uniform(0, 7)), 1),
+                    'lat': float(rng.uniform(33, 38)),
+                    'lon': float(rng.uniform(-123, -115))} for i in range(40)]
+    topics = [{'topic_id': i,
+               'min_magnitude': float(rng.integers(0, 7)),
+               'lat': Decimal(f"{rng.uniform(33, 38):.6f}"),
+               'lon': Decimal(f"{rng.uniform(-123, -115):.6f}"),
+               'rules': {}} for i in range(300)]
+
+    scalar_matches = {(earthquake['earthquake_id'], topic['topic_id'])
+                      for earthquake in earthquakes
+                      for topic in find_related_topics(earthquake, topics)}
+    rule_matches = {(match['earthquake']['earthquake_id'], match['topic']['topic_id'])
+                    for match in find_rule_matches(earthquakes, topics)}
+
+    assert scalar_matches
+    assert rule_matches == scalar_matches
+
+
+def test_find_rule_matches_applies_rules(liverpool_earthquake, example_topic):
+    shallow_topic = {**example_topic, 'rules': {'max_depth': 10}}
+    deep_topic = {**example_topic, 'topic_id': 13, 'rules': {'min_depth': 100}}
+
+    matches = find_rule_matches([liverpool_earthquake], [shallow_topic, deep_topic])
+
+    assert [match['topic']['topic_id'] for match in matches] == [12]
+
+
+def test_find_topic_matches_splits_region_topics(liverpool_earthquake, example_topic):
+    region_topic = {**example_topic, 'topic_id': 13, 'lat': 0, 'lon': 0,
+                    'region': 'POLYGON ((-3.5 53, -2.5 53, -2.5 54, -3.5 54, -3.5 53))'}
+    far_region_topic = {**example_topic, 'topic_id': 14,
+                        'region': 'POLYGON ((10 10, 11 10, 11 11, 10 11, 10 10))'}
+
+    matches = find_topic_matches([liverpool_earthquake],
+                                 [example_topic, region_topic, far_region_topic])
+
+    assert sorted(match['topic']['topic_id'] for match in matches) == [12, 13]
+
+
+def test_find_topic_matches_intensity_topics(liverpool_earthquake, example_topic):
+    felt_topic = {**example_topic, 'topic_id': 13, 'min_intensity': 3.0, 'min_magnitude': 0,
+                  'lat': 53.4, 'lon': -5.0}
+    strong_topic = {**example_topic, 'topic_id': 14, 'min_intensity': 9.0, 'min_magnitude': 0}
+
+    matches = find_topic_matches([liverpool_earthquake], [felt_topic, strong_topic])
+
+    assert [match['topic']['topic_id'] for match in matches] == [13]
+    assert matches[0]['distance'] == 134
+    assert matches[0]['intensity'] >= 3.0
+
+
+def test_find_intensity_matches_error(caplog):
+    assert find_intensity_matches([{'magnitude': 5}], [{'topic_id': 1}]) == []
+    assert "An unexpected error occurred matching earthquakes by intensity" in caplog.text
+
+
+def test_find_geofence_matches_error(caplog):
+    assert find_geofence_matches([{'magnitude': 5}], [{'topic_id': 1}]) == []
+    assert "An unexpected error occurred matching earthquakes to topic regions" in caplog.text
+
+
+def test_find_rule_matches_invalid_rule(liverpool_earthquake, example_topic, caplog):
+    topics = [{**example_topic, 'topic_id': 1, 'rules': {'max_wind': 10}},
+              {**example_topic, 'topic_id': 2}]
+
+    matches = find_rule_matches([liverpool_earthquake], topics)
+
+    assert [match['topic']['topic_id'] for match in matches] == [2]
+    assert "Skipping topic 1 with invalid rules" in caplog.text
+
+
+@patch('sns.publish_messages')
+@patch('sns.get_subscribed_users')
+@patch('sns.get_topics')
+@patch('sns.get_connection')
+@patch('sns.get_sns_client')
+def test_sns_alert_system_fetches_subscribers_once(mock_client, mock_conn, mock_topics, mock_users,
+                                                   mock_send, liverpool_earthquake, example_topics, example_user):
+    second_earthquake = {**liverpool_earthquake, 'earthquake_id': 'ak0247tc2ogz',
+                         'lon': 140.053711, 'lat': 38.203655}
+    mock_topics.return_value = example_topics
+    mock_users.return_value = {12: [example_user]}
+
+    sns_alert_system([liverpool_earthquake, second_earthquake])
+
+    mock_users.assert_called_once()
+    assert mock_users.call_args[0][1] == {11, 12}
+    assert len(mock_send.call_args[0][1]) == 1
+
+
+@patch('sns.publish_messages')
+@patch('sns.get_subscribed_users')
+@patch('sns.get_topics')
+@patch('sns.get_connection')
+@patch('sns.get_sns_client')
+def test_sns_alert_system_publishes_once_per_topic(mock_client, mock_conn, mock_topics, mock_users,
+                                                   mock_send, liverpool_earthquake, example_topic, example_users):
+    mock_topics.return_value = [example_topic]
+    mock_users.return_value = {12: example_users * 250}
+
+    sns_alert_system([liverpool_earthquake], deadline=123.0)
+
+    mock_send.assert_called_once()
+    assert mock_send.call_args.kwargs['deadline'] == 123.0
+    client, messages = mock_send.call_args[0]
+    assert len(messages) == 1
+    assert messages[0]['key'] == ('ak0247tc2ogk', 12)
+    assert messages[0]['arn'] == example_topic['topic_arn']
+    assert messages[0]['subject'] == "EARTHQUAKE WARNING"
+    assert "A magnitude 6.0 earthquake has been detected within 0km of your area" in messages[0]['message']
+
+
+@patch('sns.publish_messages')
+@patch('sns.get_subscribed_users')
+@patch('sns.get_topics')
+@patch('sns.get_connection')
+@patch('sns.get_sns_client')
+def test_sns_alert_system_custom_matcher(mock_client, mock_conn, mock_topics, mock_users,
+                                         mock_send, liverpool_earthquake, example_topic, example_user):
+    mock_users.return_value = {12: [example_user]}
+    match_topics = MagicMock(return_value=[
+        {'earthquake': liverpool_earthquake, 'topic': example_topic, 'distance': 3}])
+
+    sns_alert_system([liverpool_earthquake], match_topics)
+
+    mock_topics.assert_not_called()
+    match_topics.assert_called_once_with([liverpool_earthquake])
+    assert mock_send.call_args[0][1][0]['key'] == ('ak0247tc2ogk', 12)
+
+
+def test_get_subscribed_matches(liverpool_earthquake, example_topics, example_user):
+    matches = [{'earthquake': liverpool_earthquake, 'topic': topic, 'distance': 10}
+               for topic in example_topics]
+
+    subscribed_matches = get_subscribed_matches(
+        matches + matches, {12: [example_user], 8: [example_user], 9: []})
+
+    assert [match['topic']['topic_id'] for match in subscribed_matches] == [8, 12]
+
+
+def test_build_alert_message(liverpool_earthquake):
+    message = build_alert_message(liverpool_earthquake, 42)
+
+    assert "A magnitude 6.0 earthquake has been detected within 42km of your area, 88 km NW of Yakutat, Alaska" in message
+    assert "SAFETY TIPS" in message
+
+
+@pytest.mark.parametrize("previous_magnitude, magnitude, expected", [
+    (3.2, 3.2, False),
+    (3.2, 3.8, False),
+    (3.9, 4.1, True),
+    (4.9, 5.0, True),
+    (5.1, 4.9, False),
+    (5.0, 7.0, False)
+])
+def test_is_material_change(previous_magnitude, magnitude, expected):
+    assert is_material_change(previous_magnitude, magnitude) == expected
+
+
+@patch.dict('sns.ENV', {'REALERT_MAGNITUDE_DELTA': '0.5'})
+def test_is_material_change_with_magnitude_delta():
+    assert is_material_change(3.0, 3.5)
+    assert not is_material_change(3.0, 3.4)
+
+
+def test_get_new_alert_matches(liverpool_earthquake, example_topics):
+    matches = [{'earthquake': liverpool_earthquake, 'topic': topic, 'distance': 0}
+               for topic in example_topics[2:]]
+    previous_deliveries = {('ak0247tc2ogk', 11): {'magnitude': 6.0},
+                           ('ak0247tc2ogk', 12): {'magnitude': 4.5}}
+
+    new_matches = get_new_alert_matches(matches, previous_deliveries)
+
+    assert [match['topic']['topic_id'] for match in new_matches] == [10, 12]
+
+
+@patch('sns.record_deliveries')
+@patch('sns.get_previous_deliveries')
+@patch('sns.publish_messages')
+@patch('sns.get_subscribed_users')
+@patch('sns.get_topics')
+@patch('sns.get_connection')
+@patch('sns.get_sns_client')
+def test_sns_alert_system_skips_already_alerted(mock_client, mock_conn, mock_topics, mock_users, mock_publish,
+                                                mock_previous, mock_record, liverpool_earthquake, example_topic, example_user):
+    mock_topics.return_value = [example_topic]
+    mock_users.return_value = {12: [example_user]}
+    mock_previous.return_value = {('ak0247tc2ogk', 12): {'magnitude': 6.0}}
+    mock_publish.return_value = {'results': []}
+
+    sns_alert_system([liverpool_earthquake])
+
+    assert mock_publish.call_args[0][1] == []
+    mock_record.assert_called_once_with(mock_conn.return_value, [])
+
+
+@pytest.mark.parametrize("digest_store", ['memory', 'database'])
+@patch('sns.get_connection', return_value=None)
+@patch('sns.get_sns_client')
+def test_sns_alert_system_without_database(mock_client, mock_conn, digest_store,
+                                           liverpool_earthquake, caplog):
+    with patch.dict('sns.ENV', {'DIGEST_WINDOW_MINUTES': '60', 'DIGEST_STORE': digest_store}):
+        summary = sns_alert_system([liverpool_earthquake])
+
+    assert summary['attempted'] == 0
+    mock_client.return_value.publish.assert_not_called()
+    assert "Error fetching topics" in caplog.text
+
+
+def test_build_digest_message():
+    digest = {'topic_id': 12, 'pending': [
+        {'earthquake_id': f'eq{index}', 'magnitude': 3.0 + index / 10, 'distance': 20,
+         'title': 'M 3.0 - 5 km N of Ridgecrest, CA'} for index in range(12)]}
+
+    message = build_digest_message(digest)
+
+    assert "12 further earthquakes have been detected" in message
+    assert message.index("M 4.1") < message.index("M 3.9")
+    assert "- and 2 more" in message
+
+
+@patch.dict('sns.ENV', {'DIGEST_STORE': 'memory'})
+def test_get_digest_store_memory():
+    assert get_digest_store(MagicMock()) is MEMORY_DIGEST_STORE
+
+
+def test_get_digest_store_database():
+    assert isinstance(get_digest_store(MagicMock()), DatabaseDigestStore)
+
+
+@patch.dict('sns.ENV', {'DIGEST_WINDOW_MINUTES': '60', 'DIGEST_STORE': 'memory'})
+@patch('sns.MEMORY_DIGEST_STORE', MemoryDigestStore())
+@patch('sns.record_deliveries')
+@patch('sns.get_previous_deliveries', return_value={})
+@patch('sns.publish_messages')
+@patch('sns.get_subscribed_users')
+@patch('sns.get_topics')
+@patch('sns.get_connection')
+@patch('sns.get_sns_client')
+def test_sns_alert_system_digest_mode(mock_client, mock_conn, mock_topics, mock_users, mock_publish,
+                                      mock_previous, mock_record, liverpool_earthquake, example_topic, example_user):
+    swarm = [{**liverpool_earthquake, 'earthquake_id': f'eq{index}', 'magnitude': 4.5 + index / 100}
+             for index in range(40)]
+    mock_topics.return_value = [example_topic]
+    mock_users.return_value = {12: [example_user]}
+    mock_publish.return_value = {'results': []}
+
+    summary = sns_alert_system(swarm)
+
+    messages = mock_publish.call_args[0][1]
+    assert len(messages) == 1
+    assert messages[0]['key'] == ('eq39', 12)
+    assert summary['suppressed'] == 39
+    records = mock_record.call_args[0][1]
+    assert len(records) == 39
+    assert all(record[5] is None for record in records)
+
+
+@patch.dict('sns.ENV', {'DIGEST_WINDOW_MINUTES': '60', 'DIGEST_STORE': 'memory'})
+@patch('sns.MEMORY_DIGEST_STORE', MemoryDigestStore())
+@patch('sns.record_deliveries')
+@patch('sns.get_previous_deliveries')
+@patch('sns.publish_messages', return_value={'results': [
+    {'key': ('eq0', 12), 'delivered': True, 'published_at': None}]})
+@patch('sns.get_subscribed_users')
+@patch('sns.get_topics')
+@patch('sns.get_connection')
+@patch('sns.get_sns_client')
+def test_sns_alert_system_held_revisions_are_not_new(mock_client, mock_conn, mock_topics, mock_users,
+                                                     mock_publish, mock_previous, mock_record,
+                                                     liverpool_earthquake, example_topic, example_user):
+    swarm = [{**liverpool_earthquake, 'earthquake_id': f'eq{index}', 'magnitude': 4.5 - index / 100}
+             for index in range(3)]
+    mock_topics.return_value = [example_topic]
+    mock_users.return_value = {12: [example_user]}
+    mock_previous.return_value = {}
+    sns_alert_system(swarm)
+    mock_previous.return_value = {record[:2]: {'magnitude': record[2]}
+                                  for record in mock_record.call_args[0][1]}
+    MEMORY_DIGEST_STORE.states.clear()
+
+    summary = sns_alert_system(swarm)
+
+    assert mock_publish.call_args[0][1] == []
+    assert summary['suppressed'] == 0
+
+
+@patch.dict('sns.ENV', {'DIGEST_WINDOW_MINUTES': '60', 'DIGEST_STORE': 'memory'})
+@patch('sns.MEMORY_DIGEST_STORE', MemoryDigestStore())
+@patch('sns.record_digest_deliveries')
+@patch('sns.record_deliveries')
+@patch('sns.get_previous_deliveries', return_value={})
+@patch('sns.publish_messages')
+@patch('sns.run_digest')
+@patch('sns.get_subscribed_users', return_value={})
+@patch('sns.get_topics', return_value=[])
+@patch('sns.get_connection')
+@patch('sns.get_sns_client')
+def test_sns_alert_system_reports_digests_delivered(mock_client, mock_conn, mock_topics, mock_users,
+                                                    mock_run_digest, mock_publish, mock_previous,
+                                                    mock_record, mock_record_digests, example_topics):
+    digests = [{'topic_id': topic['topic_id'], 'topic_arn': topic['topic_arn'], 'pending': []}
+               for topic in example_topics[:2]]
+    mock_run_digest.return_value = ([], digests, [], {})
+    mock_publish.return_value = {'results': [
+        {'key': ('digest', digests[0]['topic_id']), 'delivered': True, 'published_at': None},
+        {'key': ('digest', digests[1]['topic_id']), 'delivered': False, 'published_at': None}]}
+
+    summary = sns_alert_system([])
+
+    assert summary['digests_attempted'] == 2
+    assert summary['digests_delivered'] == 1
+
+
+def test_get_alert_messages_orders_by_priority(liverpool_earthquake, example_topics):
+    small = {**liverpool_earthquake, 'earthquake_id': 'small', 'magnitude': 1.2}
+    matches = [{'earthquake': small, 'topic': example_topics[0], 'distance': 5},
+               {'earthquake': liverpool_earthquake, 'topic': example_topics[1], 'distance': 150},
+               {'earthquake': liverpool_earthquake, 'topic': example_topics[2], 'distance': 40}]
+    digests = [{'topic_id': 11, 'topic_arn': example_topics[3]['topic_arn'], 'pending': []}]
+
+    messages = get_alert_messages(matches, digests)
+
+    assert [message['key'] for message in messages] == [
+        ('ak0247tc2ogk', 10), ('ak0247tc2ogk', 9), ('small', 8), ('digest', 11)]